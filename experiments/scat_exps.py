@@ -30,6 +30,14 @@ parser.add_argument('--seed', type=int, default=None, metavar='S',
 parser.add_argument('--batch-size', type=int, default=128)
 parser.add_argument('--smoke-test', action="store_true",
                     help="Finish quickly for testing")
+parser.add_argument('--amp', default='off', type=str,
+                    choices=['off', 'bf16', 'fp16'],
+                    help='Automatic mixed precision mode')
+parser.add_argument('--iter-size', type=int, default=1,
+                    help='mini-batch iterations between update steps. The '
+                         'gradients are accumulated over them')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='batches to load ahead in a background thread')
 parser.add_argument('--datadir', type=str, default='/scratch/share/cifar',
                     help='Default location for the dataset')
 parser.add_argument('--dataset', default='cifar100', type=str,
@@ -220,6 +228,9 @@ class TrainNET(BaseClass):
         num_gpus = config.get('num_gpus', args.num_gpus)
         if hasattr(args, 'verbose'):
             self._verbose = args.verbose
+        self._amp = getattr(args, 'amp', 'off')
+        self._iter_size = getattr(args, 'iter_size', 1)
+        self._prefetch = getattr(args, 'prefetch', 0)
 
         num_workers = 4
         if args.seed is not None:
@@ -238,7 +249,8 @@ class TrainNET(BaseClass):
         if dataset.startswith('cifar'):
             self.train_loader, self.test_loader = cifar.get_data(
                 32, args.datadir, dataset=dataset,
-                batch_size=args.batch_size, trainsize=args.trainsize,
+                batch_size=args.batch_size // self.iter_size,
+                trainsize=args.trainsize,
                 **kwargs)
             #  θ = (0.5, 0.9, 1e-4, 1.5)
             θ = (0.5, 0.85, 1e-4, 1.5)
@@ -246,7 +258,7 @@ class TrainNET(BaseClass):
             self.train_loader, self.test_loader = tiny_imagenet.get_data(
                 64, args.datadir, val_only=False,
                 batch_size=args.batch_size, trainsize=args.trainsize,
-                distributed=False, **kwargs)
+                iter_size=self.iter_size, distributed=False, **kwargs)
             #  θ = (0.2, 0.9, 1e-4, 1.5)
             θ = (0.5, 0.85, 8e-5, 1.5)
 
@@ -15,6 +15,8 @@ import os
 from math import sqrt
 
 import torch.nn.init as init
+from scatnet_learn.learn import MetricAccumulator, Prefetcher, autocast
+from scatnet_learn.learn import make_scaler
 
 
 def net_init(m, gain=1):
@@ -43,23 +45,6 @@ def get_hms(seconds):
     return h, m, s
 
 
-def num_correct(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
-    with torch.no_grad():
-        maxk = max(topk)
-        batch_size = target.size(0)
-
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-        res = []
-        for k in topk:
-            correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
-            res.append(correct_k)
-        return res, batch_size
-
-
 class BaseClass(Trainable):
     """ This class handles model training and scheduling for our networks.
 
@@ -91,6 +76,30 @@ class BaseClass(Trainable):
             self._use_cuda = torch.cuda.is_available()
         return self._use_cuda
 
+    @property
+    def amp(self):
+        """ The automatic mixed precision mode, 'off', 'bf16' or 'fp16' """
+        return getattr(self, '_amp', 'off')
+
+    @property
+    def iter_size(self):
+        """ The number of batches to accumulate the gradients over before
+        each update step """
+        return getattr(self, '_iter_size', 1)
+
+    @property
+    def prefetch(self):
+        """ The number of batches to load ahead, see
+        :class:`scatnet_learn.learn.Prefetcher` """
+        return getattr(self, '_prefetch', 0)
+
+    @property
+    def scaler(self):
+        """ GradScaler for fp16 training, None if the loss isn't scaled """
+        if not hasattr(self, '_scaler'):
+            self._scaler = make_scaler(self.amp, self.use_cuda)
+        return self._scaler
+
     @property
     def last_epoch(self):
         return self.scheduler.last_epoch
@@ -112,100 +121,109 @@ class BaseClass(Trainable):
         if hasattr(self, 'optimizer1'):
             self.optimizer1.zero_grad()
 
+    def backward(self, loss):
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
     def opt_step(self):
-        self.optimizer.step()
-        if hasattr(self, 'optimizer1'):
-            self.optimizer1.step()
+        if self.scaler is not None:
+            self.scaler.step(self.optimizer)
+            if hasattr(self, 'optimizer1'):
+                self.scaler.step(self.optimizer1)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
+            if hasattr(self, 'optimizer1'):
+                self.optimizer1.step()
 
     def _train_iteration(self):
         self.model.train()
-        top1_update = 0
-        top1_epoch = 0
-        top5_update = 0
-        top5_epoch = 0
-        loss_update = 0
-        loss_epoch = 0
-        update = 0
-        epoch = 0
+        # The metrics since the last update, and for the whole epoch. These
+        # are kept on the device so the host only waits for it at the update
+        # steps
+        update = MetricAccumulator()
+        epoch = MetricAccumulator()
         num_iter = len(self.train_loader)
         start = time.time()
         update_steps = np.linspace(
             int(1/4 * num_iter), num_iter-1, 4).astype('int')
 
-        for batch_idx, (data, target) in enumerate(self.train_loader):
+        loader = self.train_loader
+        if self.prefetch > 0:
+            loader = Prefetcher(loader, self.prefetch,
+                                device='cuda' if self.use_cuda else None,
+                                pin_memory=self.use_cuda)
+        # The time spent waiting for the loader
+        data_time = 0
+        fetch_start = time.time()
+
+        for batch_idx, (data, target) in enumerate(loader):
+            data_time += time.time() - fetch_start
             if self.use_cuda:
                 data, target = data.cuda(), target.cuda()
-            self.zero_grad()
+            # Accumulate the gradients of iter_size batches for each step,
+            # dividing the loss by the number of batches in the step
+            if batch_idx % self.iter_size == 0:
+                self.zero_grad()
+                accum = min(self.iter_size, num_iter - batch_idx)
 
-            output = self.model(data)
-            loss = func.nll_loss(output, target)
-            if torch.isnan(loss):
-                raise ValueError(
-                    "Nan found in training at epoch {}".format(self.last_epoch))
-            loss.backward()
-            self.opt_step()
-
-            corrects, bs = num_correct(output.data, target, topk=(1,5))
-            top1_epoch += corrects[0].item()
-            top5_epoch += corrects[1].item()
-            loss_epoch += loss.item()*bs
-            epoch += bs
-
-            # Plotting/Reporting
-            if self.verbose:
-                update += bs
-                top1_update += corrects[0].item()
-                top5_update += corrects[1].item()
-                loss_update += loss.item()*bs
-
-                sys.stdout.write('\r')
-                sys.stdout.write(
-                    '| Epoch [{:3d}/{:3d}] Iter[{:3d}/{:3d}]\t\t'
-                    'Loss: {:.4f}\tAcc@1: {:.3f}%\tAcc@5: {:.3f}%\t'
-                    'Elapsed Time: {:.1f}min'.format(
-                        self.last_epoch, self.final_epoch, batch_idx+1,
-                        num_iter, loss_update/update,
-                        100. * top1_update/update,
-                        100. * top5_update/update,
-                        (time.time()-start)/60))
-                sys.stdout.flush()
-                # Every update_steps, print a new line
-                if batch_idx in update_steps:
-                    top1_update = 0
-                    top5_update = 0
-                    loss_update = 0
-                    update = 0
+            with autocast(self.amp, data.device.type):
+                output = self.model(data)
+                loss = func.nll_loss(output, target)
+            self.backward(loss / accum)
+            if batch_idx % self.iter_size == self.iter_size - 1 or \
+                    batch_idx == num_iter - 1:
+                self.opt_step()
+
+            update.update(loss, output, target)
+            epoch.update(loss, output, target)
+
+            # Plotting/Reporting. A nan loss makes the running sum nan, so
+            # is caught at the next update step
+            if batch_idx in update_steps:
+                loss_update, top1_update, top5_update = update.read()
+                if not np.isfinite(loss_update):
+                    raise ValueError(
+                        "Nan found in training at epoch {}".format(
+                            self.last_epoch))
+                if self.verbose:
+                    sys.stdout.write('\r')
+                    sys.stdout.write(
+                        '| Epoch [{:3d}/{:3d}] Iter[{:3d}/{:3d}]\t\t'
+                        'Loss: {:.4f}\tAcc@1: {:.3f}%\tAcc@5: {:.3f}%\t'
+                        'Steps/s: {:.2f}\tElapsed Time: {:.1f}min'.format(
+                            self.last_epoch, self.final_epoch, batch_idx+1,
+                            num_iter, loss_update, top1_update, top5_update,
+                            update.steps_per_sec, (time.time()-start)/60))
+                    sys.stdout.flush()
                     print()
-        loss_epoch /= epoch
-        top1_epoch = 100. * top1_epoch/epoch
-        top5_epoch = 100. * top5_epoch/epoch
+                update.reset()
+            fetch_start = time.time()
+        loss_epoch, top1_epoch, top5_epoch = epoch.read()
+        total_time = max(time.time() - start, 1e-6)
+        if self.verbose:
+            print('| Data wait: {:.1f}s ({:.0f}%)\tCompute: {:.1f}s'.format(
+                data_time, 100 * data_time / total_time,
+                total_time - data_time))
         return {"mean_loss": loss_epoch, "mean_accuracy": top1_epoch, "acc5":
-                top5_epoch}
+                top5_epoch, "steps_per_sec": epoch.steps_per_sec,
+                "data_time": data_time, "compute_time": total_time - data_time}
 
     def _test(self):
         self.model.eval()
-        test_loss = 0
-        top1_correct = 0
-        top5_correct = 0
-        epoch = 0
+        metrics = MetricAccumulator()
         with torch.no_grad():
             for data, target in self.test_loader:
                 if self.use_cuda:
                     data, target = data.cuda(), target.cuda()
-                output = self.model(data)
-                # sum up batch loss
-                loss = func.nll_loss(output, target, reduction='sum')
-
-                # get the index of the max log-probability
-                corrects, bs = num_correct(output.data, target, topk=(1, 5))
-                test_loss += loss.item()
-                top1_correct += corrects[0].item()
-                top5_correct += corrects[1].item()
-                epoch += bs
-
-        test_loss /= epoch
-        acc1 = 100. * top1_correct/epoch
-        acc5 = 100. * top5_correct/epoch
+                with autocast(self.amp, data.device.type):
+                    output = self.model(data)
+                    loss = func.nll_loss(output, target)
+                metrics.update(loss, output, target)
+
+        test_loss, acc1, acc5 = metrics.read()
         if self.verbose:
             # Save checkpoint when best model
             print("|\n| Validation Epoch #{}\t\t\tLoss: {:.4f}\tAcc@1: {:.2f}%"
@@ -233,12 +251,16 @@ class BaseClass(Trainable):
             opt1 = self.optimizer1.state_dict()
         if hasattr(self, 'scheduler1'):
             sch1 = self.scheduler1.state_dict()
+        scaler = None
+        if self.scaler is not None:
+            scaler = self.scaler.state_dict()
         torch.save({
             'model_state_dict': model,
             'optimizer_state_dict': opt,
             'scheduler_state_dict': sch,
             'optimizer1_state_dict': opt1,
             'scheduler1_state_dict': sch1,
+            'scaler_state_dict': scaler,
         }, checkpoint_path)
 
         return checkpoint_path
@@ -266,3 +288,7 @@ class BaseClass(Trainable):
                                  'scheduler, but we dont have one')
             else:
                 self.scheduler1.load_state_dict(chk['scheduler1_state_dict'])
+
+        if chk.get('scaler_state_dict') is not None and \
+                self.scaler is not None:
+            self.scaler.load_state_dict(chk['scaler_state_dict'])
@@ -6,12 +6,20 @@ Generic main file for creating/loading a neural network and training it.
     step 2: loads data
     step 3: creates an optimizer and gets the parameters to optimize
     step 4: loop through train/val functions
+
+With --world_size N > 1, N processes are spawned on this machine and train
+the net with DistributedDataParallel over the gloo backend, each on its own
+shard of the data. This runs on the cpu, e.g. on cpu cluster nodes.
+Checkpoints, summaries and printing are only done by rank 0.
 """
 from __future__ import print_function
 
 import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import py3nvml
 from tensorboardX import SummaryWriter
 import time
@@ -25,8 +33,9 @@ import argparse
 import numpy as np
 
 from scatnet_learn.networks import FlexibleNet, net_init, MixedNet, ScatNet, MixedNet2
-from scatnet_learn.data import cifar, tiny_imagenet
+from scatnet_learn.data import cifar, tiny_imagenet, packed
 from scatnet_learn import learn, optim
+from scatnet_learn import checkpoint as chkpt
 
 parser = argparse.ArgumentParser(description='ICIP 2019 Invariant Layer '
                                              'Experiments')
@@ -44,6 +53,13 @@ parser.add_argument('--testOnly', '-t', action='store_true',
 parser.add_argument('--num_gpus', default=1, type=int,
                     help='number of gpus to use. if more than 1, will split '
                          'the batch across multiple gpus')
+parser.add_argument('--world_size', default=1, type=int,
+                    help='number of processes to train with. if more than 1, '
+                         'spawns them and trains on the cpu with '
+                         'DistributedDataParallel, splitting the batch '
+                         'across them')
+parser.add_argument('--dist_url', default='tcp://127.0.0.1:23456', type=str,
+                    help='url used to set up the distributed process group')
 parser.add_argument('--summary_freq', default=4, type=int,
                     help='number of updates of training info per epoch')
 parser.add_argument('--eval_period', default=2, type=int,
@@ -57,6 +73,15 @@ parser.add_argument('--no_comment', action='store_true',
                     help='Turns off prompt to enter comments about run.')
 parser.add_argument('--exist_ok', action='store_true',
                     help='If true, is ok if output directory already exists')
+parser.add_argument('--batched_data', action='store_true',
+                    help='Load and augment whole batches of images at a '
+                         'time rather than each image separately. The '
+                         'dataset is packed into uint8 arrays in data_dir '
+                         'the first time')
+parser.add_argument('--prefetch', default=2, type=int,
+                    help='number of batches to load and move to the device '
+                         'ahead of time in a background thread. 0 loads '
+                         'them in the training loop')
 parser.add_argument('--double_size', action='store_true',
                     help='Doubles the input size before processing')
 parser.add_argument('--optim', default='sgd', type=str,
@@ -73,6 +98,17 @@ parser.add_argument('--gpu_select', default=None, type=int, nargs='+',
                     help='list of gpus on which to run exps')
 parser.add_argument('--type', default='A', type=str,
                     help='Model type to build')
+parser.add_argument('--debug', action='store_true',
+                    help='Train with autograd anomaly detection on. Finds '
+                         'where nans come from but is several times slower')
+parser.add_argument('--check_freq', default=50, type=int,
+                    help='steps between checks that the loss and gradients '
+                         'are finite. 0 turns the check off')
+parser.add_argument('--amp', default='off', type=str,
+                    choices=['off', 'bf16', 'fp16'],
+                    help='Automatic mixed precision. Runs the forward pass '
+                         'under autocast with this dtype. fp16 also scales '
+                         'the loss with a GradScaler')
 
 # Core hyperparameters
 parser.add_argument('--lr', default=0.1, type=float,
@@ -101,10 +137,6 @@ parser.add_argument('--layers_per_scale', default=[1,2,2], type=int, nargs='+',
 parser.add_argument('--channels_per_scale', default=64, type=int,
                     help='number of channels for the first scale. note that '
                          'after downsampling the number of channels is doubled')
-args = parser.parse_args()
-print(args)
-
-
 def get_hms(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
@@ -112,54 +144,45 @@ def get_hms(seconds):
     return h, m, s
 
 
-# If seed was not provided, create one and seed numpy and pytorch
-if args.seed < 0:
-    args.seed = np.random.randint(1 << 16)
-np.random.seed(args.seed)
-random.seed(args.seed)
-torch.backends.cudnn.deterministic = True
-torch.manual_seed(args.seed)
+def main(rank, args):
+    """ Trains the net. Is run by every process, rank is 0 if not
+    distributed. """
+    distributed = args.world_size > 1
+    if distributed:
+        dist.init_process_group('gloo', init_method=args.dist_url,
+                                rank=rank, world_size=args.world_size)
+        # Share the cores between the processes rather than oversubscribe
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.world_size))
+        if rank > 0:
+            sys.stdout = open(os.devnull, 'w')
 
-# Hyperparameter settings
-py3nvml.grab_gpus(args.num_gpus, gpu_select=args.gpu_select, gpu_fraction=0.7,
-                  max_procs=0)
-use_cuda = torch.cuda.is_available()
-best_acc = 0
-start_epoch, batch_size = 1, args.batch_size
+    # The seed is shared, so the DistributedSampler shards agree, but offset
+    # by the rank for the augmentation. The initial weights don't need to
+    # match, DistributedDataParallel copies rank 0's to the others
+    np.random.seed(args.seed + rank)
+    random.seed(args.seed + rank)
+    torch.backends.cudnn.deterministic = True
+    torch.manual_seed(args.seed + rank)
 
+    # Hyperparameter settings
+    if distributed:
+        use_cuda = False
+    else:
+        py3nvml.grab_gpus(args.num_gpus, gpu_select=args.gpu_select,
+                          gpu_fraction=0.7, max_procs=0)
+        use_cuda = torch.cuda.is_available()
+    best_acc = 0
+    start_epoch = 1
 
-# ##############################################################################
-#  Model
-print('\n[Phase 1] : Model setup')
-if len(args.layers_per_scale) == 1:
-    args.layers_per_scale = args.layers_per_scale[0]
+    # ##########################################################################
+    #  Model
+    print('\n[Phase 1] : Model setup')
+    if len(args.layers_per_scale) == 1:
+        args.layers_per_scale = args.layers_per_scale[0]
 
-if args.resume:
-    # Load checkpoint
-    print('| Resuming from checkpoint...')
     chkpt_dir = os.path.join(args.exp_dir, 'chkpt')
-    assert os.path.isdir(chkpt_dir), 'Error: No checkpoint directory found!'
     file_name = args.conv_layer
-    if args.chkpt == 'best':
-        checkpoint = torch.load(os.path.join(chkpt_dir, file_name + '.t7'))
-    else:
-        checkpoint = torch.load(os.path.join(chkpt_dir, file_name + '_latest.t7'))
-    net = checkpoint['net']
-    best_acc = checkpoint['acc1']
-    start_epoch = checkpoint['epoch']
-elif args.testOnly:
-    print('\n[Test Phase] : Model setup')
-    chkpt_dir = os.path.join(args.exp_dir, 'chkpt')
-    assert os.path.isdir(chkpt_dir), 'Error: No checkpoint directory found!'
-    file_name = args.conv_layer
-    if args.chkpt == 'best':
-        checkpoint = torch.load(os.path.join(chkpt_dir, file_name + '.t7'))
-    else:
-        checkpoint = torch.load(os.path.join(chkpt_dir, file_name + '_latest.t7'))
-    net = checkpoint['net']
-else:
     print('| Building net with [' + args.conv_layer+ '] core...')
-    chkpt_dir = os.path.join(args.exp_dir, 'chkpt')
     # net = FlexibleNet(args.dataset, args.conv_layer, args.layers_per_scale,
     #                   args.channels_per_scale, reg=args.reg, wd=args.wd)
     # net = MixedNet(args.dataset, args.channels_per_scale, reg=args.reg,
@@ -168,111 +191,180 @@ else:
                   wd=args.wd)
     # net = MixedNet2(args.dataset, args.type, reg=args.reg, wd=args.wd)
     net.init()
-    file_name = args.conv_layer
-    save_experiment_info(args.exp_dir, args.seed,
-                         args.no_comment, args.exist_ok, net)
-    print(net)
-
-if use_cuda:
-    net.cuda()
-    net = torch.nn.DataParallel(net,
-                                device_ids=range(torch.cuda.device_count()))
-    cudnn.benchmark = True
-
-criterion = nn.CrossEntropyLoss()
-
-# ##############################################################################
-#  Data
-print('\n[Phase 2] : Data Preparation')
-print("| Preparing dataset...")
-if args.dataset.startswith('cifar'):
-    trainloader, testloader = cifar.get_data(
-        32, args.data_dir, args.dataset, args.batch_size, args.trainsize,
-        args.seed, double_size=args.double_size)
-elif args.dataset == 'tiny_imagenet':
-    trainloader, testloader = tiny_imagenet.get_data(
-        64, args.data_dir, val_only=args.testOnly, batch_size=args.batch_size,
-        trainsize=args.trainsize, seed=args.seed, distributed=(args.num_gpus>1))
-
-# Test only option
-if args.testOnly:
-    acc1, acc5 = learn.validate(testloader, net, use_cuda)
-    sys.exit(0)
-else:
-    num_iter = len(trainloader)
-
-# ##############################################################################
-#  Optimizer
-print('\n[Phase 3] : Building Optimizer')
-print('| Training Epochs = ' + str(args.epochs))
-print('| Initial Learning Rate = ' + str(args.lr))
-print('| Optimizer = ' + str(args.optim))
-tr_writer = SummaryWriter(os.path.join(args.exp_dir, 'train'))
-te_writer = SummaryWriter(os.path.join(args.exp_dir, 'test'))
-elapsed_time = 0
-# Get the parameters to optimize
-try:
-    params = net.param_groups()
-except AttributeError:
-    params = net.parameters()
-
-# Don't use the optimizer's weight decay, call that later in the loss func
-optimizer, scheduler = optim.get_optim(args.optim, params, init_lr=args.lr,
-                                       steps=args.steps, wd=0,
-                                       gamma=args.gamma, momentum=args.momentum,
-                                       max_epochs=args.epochs)
-
-# ##############################################################################
-#  Train
-print('\n[Phase 4] : Training')
-# Get one batch of validation data for logging
-# x, y = next(iter(testloader))
-# if use_cuda:
-#     x = x.cuda()
-
-for epoch in range(start_epoch, start_epoch+args.epochs):
-    start_time = time.time()
-    scheduler.step()
-
-    learn.train(trainloader, net, criterion, optimizer, epoch, args.epochs,
-                use_cuda, tr_writer, summary_freq=args.summary_freq)
-
-    if epoch % args.eval_period == 0:
-        sys.stdout.write('\n| Validating...')
-        sys.stdout.flush()
-        acc1, acc5 = learn.validate(testloader, net, criterion, use_cuda, epoch,
-                                    te_writer)
-        if acc1 > best_acc:
-            print('| Saving Best model...\t\t\tTop1 = {:.2f}%\tTop5 = '
-                  '{:.2f}%'.format(acc1, acc5))
-            state = {
-                'net': net.module if use_cuda else net,
-                'acc1': acc1,
-                'acc5': acc5,
-                'epoch': epoch,
-            }
-            if not os.path.isdir(chkpt_dir):
+    if args.resume or args.testOnly:
+        # Load checkpoint
+        if args.resume:
+            print('| Resuming from checkpoint...')
+        else:
+            print('\n[Test Phase] : Model setup')
+        assert os.path.isdir(chkpt_dir), 'Error: No checkpoint directory found!'
+        if args.chkpt == 'best':
+            checkpoint = chkpt.load(os.path.join(chkpt_dir, file_name + '.t7'))
+        else:
+            checkpoint = chkpt.load(
+                os.path.join(chkpt_dir, file_name + '_latest.t7'))
+        net.load_state_dict(checkpoint['net'])
+        if args.resume:
+            best_acc = checkpoint.get('best_acc', checkpoint['acc1'])
+            start_epoch = checkpoint['epoch'] + 1
+    else:
+        if rank == 0:
+            # The spawned processes can't read stdin to prompt for comments
+            save_experiment_info(args.exp_dir, args.seed,
+                                 args.no_comment or distributed,
+                                 args.exist_ok, net)
+        print(net)
+
+    # Get the parameters to optimize before wrapping the net
+    try:
+        params = net.param_groups()
+    except AttributeError:
+        params = net.parameters()
+
+    if distributed:
+        net = DistributedDataParallel(net)
+    elif use_cuda:
+        net.cuda()
+        net = torch.nn.DataParallel(net,
+                                    device_ids=range(torch.cuda.device_count()))
+        cudnn.benchmark = True
+
+    criterion = nn.CrossEntropyLoss()
+
+    # ##########################################################################
+    #  Data
+    print('\n[Phase 2] : Data Preparation')
+    print("| Preparing dataset...")
+    # The batch is split between the processes
+    batch_size = args.batch_size // args.world_size
+    if args.dataset.startswith('cifar'):
+        # The loader gives the batches that are accumulated to make the
+        # batch_size
+        trainloader, testloader = cifar.get_data(
+            32, args.data_dir, args.dataset, batch_size // args.iter_size,
+            args.trainsize, args.seed, double_size=args.double_size,
+            distributed=distributed, batched=args.batched_data)
+    elif args.dataset == 'tiny_imagenet':
+        trainloader, testloader = tiny_imagenet.get_data(
+            64, args.data_dir, val_only=args.testOnly, batch_size=batch_size,
+            trainsize=args.trainsize, seed=args.seed, iter_size=args.iter_size,
+            distributed=distributed, batched=args.batched_data)
+
+    # Test only option
+    if args.testOnly:
+        acc1, acc5 = learn.validate(testloader, net, use_cuda=use_cuda,
+                                    amp=args.amp)
+        return
+
+    # ##########################################################################
+    #  Optimizer
+    print('\n[Phase 3] : Building Optimizer')
+    print('| Training Epochs = ' + str(args.epochs))
+    print('| Initial Learning Rate = ' + str(args.lr))
+    print('| Optimizer = ' + str(args.optim))
+    if rank == 0:
+        tr_writer = SummaryWriter(os.path.join(args.exp_dir, 'train'))
+        te_writer = SummaryWriter(os.path.join(args.exp_dir, 'test'))
+    else:
+        tr_writer, te_writer = None, None
+    elapsed_time = 0
+
+    # Don't use the optimizer's weight decay, call that later in the loss func
+    optimizer, scheduler = optim.get_optim(args.optim, params, init_lr=args.lr,
+                                           steps=args.steps, wd=0,
+                                           gamma=args.gamma,
+                                           momentum=args.momentum,
+                                           max_epochs=args.epochs)
+    # Loss scaling for fp16. None if not needed
+    scaler = learn.make_scaler(args.amp, use_cuda)
+    if args.resume:
+        # Checkpoints from before state dicts were saved only have the net
+        if checkpoint.get('optimizer') is not None:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+        if checkpoint.get('scheduler') is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        if scaler is not None and checkpoint.get('scaler') is not None:
+            scaler.load_state_dict(checkpoint['scaler'])
+        # The other ranks keep their seed + rank generators, as only rank 0's
+        # are saved
+        if rank == 0 and checkpoint.get('rng') is not None:
+            chkpt.set_rng_state(checkpoint['rng'])
+        del checkpoint
+    # Writes the checkpoints in the background while training carries on
+    checkpointer = chkpt.AsyncCheckpointer() if rank == 0 else None
+
+    # ##########################################################################
+    #  Train
+    print('\n[Phase 4] : Training')
+    for epoch in range(start_epoch, start_epoch+args.epochs):
+        start_time = time.time()
+        scheduler.step()
+
+        learn.train(trainloader, net, criterion, optimizer, epoch,
+                    args.epochs, use_cuda, tr_writer,
+                    summary_freq=args.summary_freq, debug=args.debug,
+                    check_freq=args.check_freq, amp=args.amp, scaler=scaler,
+                    iter_size=args.iter_size, prefetch=args.prefetch)
+
+        if epoch % args.eval_period == 0:
+            sys.stdout.write('\n| Validating...')
+            sys.stdout.flush()
+            # The metrics are summed over the processes, so are the same for
+            # every rank
+            acc1, acc5 = learn.validate(testloader, net, criterion, use_cuda,
+                                        epoch, te_writer, amp=args.amp)
+            if rank == 0 and not os.path.isdir(chkpt_dir):
                 os.mkdir(chkpt_dir)
-            save_point = os.path.join(chkpt_dir, file_name + '.t7')
-            torch.save(state, save_point)
-            best_acc = acc1
-        # Save the last epoch's run as well
-        state = {
-            'net': net.module if use_cuda else net,
-            'acc1': acc1,
-            'acc5': acc5,
-            'epoch': epoch,
-        }
-        if not os.path.isdir(chkpt_dir):
-            os.mkdir(chkpt_dir)
-        save_point = os.path.join(chkpt_dir, file_name + '_latest.t7')
-        torch.save(state, save_point)
-
-    epoch_time = time.time() - start_time
-    elapsed_time += epoch_time
-    print('| Elapsed time : %d:%02d:%02d\t Epoch time: %.1fs' % (
-        get_hms(elapsed_time) + (epoch_time,)))
-
-print('\n[Phase 5] : Results')
-print('* Test results : Acc@1 = %.2f%%' % best_acc)
-save_acc(args.exp_dir, best_acc)
+            paths = [os.path.join(chkpt_dir, file_name + '_latest.t7')]
+            if acc1 > best_acc:
+                print('| Saving Best model...\t\t\tTop1 = {:.2f}%\tTop5 = '
+                      '{:.2f}%'.format(acc1, acc5))
+                paths.append(os.path.join(chkpt_dir, file_name + '.t7'))
+                best_acc = acc1
+            # Save the last epoch's run as well. Both files are written from
+            # the same snapshot
+            if rank == 0:
+                checkpointer.save(
+                    chkpt.snapshot(net, optimizer, scheduler, scaler,
+                                   acc1=acc1, acc5=acc5, epoch=epoch,
+                                   best_acc=best_acc),
+                    *paths)
+
+        epoch_time = time.time() - start_time
+        elapsed_time += epoch_time
+        print('| Elapsed time : %d:%02d:%02d\t Epoch time: %.1fs' % (
+            get_hms(elapsed_time) + (epoch_time,)))
+
+    if checkpointer is not None:
+        checkpointer.close()
+
+    print('\n[Phase 5] : Results')
+    print('* Test results : Acc@1 = %.2f%%' % best_acc)
+    if rank == 0:
+        save_acc(args.exp_dir, best_acc)
+    if distributed:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    if args.iter_size < 1 or \
+            args.batch_size % (args.iter_size * args.world_size) != 0:
+        parser.error('--batch_size must be a multiple of --iter_size times '
+                     '--world_size')
+
+    # If seed was not provided, create one here so all the processes share it
+    if args.seed < 0:
+        args.seed = np.random.randint(1 << 16)
+
+    if args.world_size > 1:
+        # Pack the dataset here once, rather than have the processes wait on
+        # rank 0 to do it
+        if args.batched_data and args.dataset.startswith('cifar'):
+            packed.pack_cifar(args.data_dir, args.dataset)
+        elif args.batched_data and args.dataset == 'tiny_imagenet':
+            tiny_imagenet.pack(args.data_dir, val_only=args.testOnly)
+        mp.spawn(main, args=(args,), nprocs=args.world_size)
+    else:
+        main(0, args)
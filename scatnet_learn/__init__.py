@@ -1,5 +1,7 @@
 __version__ = "0.1.0"
 
 from scatnet_learn.layers import ScatLayerj1, InvariantLayerj1, InvariantLayerj1_dct
+from scatnet_learn.layers import ScatLayerJ
 
-__all__ = ['ScatLayerj1', 'InvariantLayerj1', 'InvariantLayerj1_dct']
+__all__ = ['ScatLayerj1', 'InvariantLayerj1', 'InvariantLayerj1_dct',
+           'ScatLayerJ']
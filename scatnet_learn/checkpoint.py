@@ -0,0 +1,185 @@
+"""
+Module to save and load training checkpoints.
+
+A checkpoint holds the state dicts of the net, optimizer, scheduler and loss
+scaler, and the random number generator states, rather than pickling the
+modules themselves. :func:`snapshot` copies them to the cpu, so training can
+carry on changing the originals while an :class:`AsyncCheckpointer` writes
+the copy in a background thread. Files are written to a temporary name and
+then renamed, so a crash mid write never leaves a truncated checkpoint.
+
+The scattering layers each hold their own copy of the fixed wavelet filters
+(h0o, h1o, ...). :func:`snapshot` makes frozen parameters and buffers with
+the same values share one tensor, which torch.save then only stores once.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import io
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def _to_cpu(obj):
+    """ Copies every tensor in a nest of dicts, lists and tuples to the cpu.
+    The containers are copied too, so the result shares nothing with obj. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _share_frozen(net, state_dict):
+    """ Points the entries of state_dict for frozen parameters and buffers
+    with equal values at the same tensor. Returns the number of entries
+    shared. """
+    seen = {}
+    shared = 0
+    frozen = [name for name, p in net.named_parameters()
+              if not p.requires_grad]
+    frozen += [name for name, _ in net.named_buffers()]
+    for name in frozen:
+        if name not in state_dict:
+            continue
+        t = state_dict[name]
+        key = (t.dtype, tuple(t.shape),
+               hashlib.sha1(t.contiguous().numpy().tobytes()).hexdigest())
+        if key in seen:
+            state_dict[name] = seen[key]
+            shared += 1
+        else:
+            seen[key] = t
+    return shared
+
+
+def get_rng_state():
+    """ Returns the states of the python, numpy and torch random number
+    generators. """
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """ Restores the random number generator states from
+    :func:`get_rng_state`. """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state.get('cuda') is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(net, optimizer=None, scheduler=None, scaler=None, **extra):
+    """ Takes a cpu copy of the training state.
+
+    Args:
+        net (nn.Module): the net. A DataParallel or DistributedDataParallel
+            wrapper is removed, so the keys match the bare net.
+        optimizer: the optimizer, or None
+        scheduler: the learning rate scheduler, or None
+        scaler: the amp GradScaler, or None
+        extra: other picklable values to store, e.g. epoch=epoch
+
+    Returns:
+        state (dict): with keys 'net', 'optimizer', 'scheduler', 'scaler',
+        'rng' and those of extra
+    """
+    net = getattr(net, 'module', net)
+    state = {
+        'net': _to_cpu(net.state_dict()),
+        'optimizer': _to_cpu(optimizer.state_dict())
+        if optimizer is not None else None,
+        'scheduler': _to_cpu(scheduler.state_dict())
+        if scheduler is not None else None,
+        'scaler': _to_cpu(scaler.state_dict()) if scaler is not None else None,
+        'rng': get_rng_state(),
+    }
+    _share_frozen(net, state['net'])
+    state.update(extra)
+    return state
+
+
+def _write(state, paths):
+    buf = io.BytesIO()
+    torch.save(state, buf)
+    data = buf.getvalue()
+    for path in paths:
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class AsyncCheckpointer(object):
+    """ Writes checkpoints in a background thread.
+
+    The thread serializes the state once and then writes it to each path.
+    The state must not change after it is passed to :meth:`save`, so pass it
+    a :func:`snapshot`. Only one save is in flight at a time, a second call
+    waits for the first to finish, so there is at most one extra copy of the
+    state in memory. Errors from the thread are raised by the next call to
+    :meth:`save` or :meth:`wait`.
+    """
+    def __init__(self):
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def save(self, state, *paths):
+        """ Saves state, e.g. from :func:`snapshot`, to each of paths. """
+        self.wait()
+        self._pending = self._pool.submit(_write, state, paths)
+
+    def wait(self):
+        """ Blocks until the last save has been written. """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load(path):
+    """ Loads a checkpoint onto the cpu.
+
+    Checkpoints from before state dicts were saved, which pickled the whole
+    net, have their net replaced by its state dict (without any DataParallel
+    wrapper).
+    """
+    try:
+        state = torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # Older torch without weights_only
+        state = torch.load(path, map_location='cpu')
+    if isinstance(state.get('net'), torch.nn.Module):
+        state['net'] = getattr(state['net'], 'module',
+                               state['net']).state_dict()
+    return state
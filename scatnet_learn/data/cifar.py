@@ -5,11 +5,15 @@ import torchvision
 from torchvision import transforms
 import numpy as np
 import torch
+import torch.distributed as dist
 import os
 import random
 import tarfile
 import pickle
-from scatnet_learn.utils import download, md5, convert_to_one_hot
+from scatnet_learn.utils import download, md5, convert_to_one_hot, shard
+from scatnet_learn.utils import stratified_indices
+from scatnet_learn.data import packed
+from scatnet_learn.data import transforms as batch_transforms
 
 mean = {
     'cifar10': (0.4914, 0.4822, 0.4465),
@@ -144,22 +148,20 @@ def load_cifar_data(data_dir, cifar10=True, val_size=2000, one_hot=True,
         num_classes = 100
         label_func = lambda x: np.array(x['fine_labels'], dtype='int32')
 
-    # Load the data into memory
+    # Load the data into memory. The files are joined once at the end, rather
+    # than growing the array with each one
     def load_files(filenames):
-        data = np.array([])
-        labels = np.array([])
+        data = []
+        labels = []
         for name in filenames:
             with open(name, 'rb') as f:
                 mydict = pickle.load(f, encoding='latin1')
 
             # The labels have different names in the two datasets.
-            newlabels = label_func(mydict)
-            if data.size:
-                data = np.vstack([data, mydict['data']])
-                labels = np.hstack([labels, newlabels])
-            else:
-                data = mydict['data']
-                labels = newlabels
+            labels.append(label_func(mydict))
+            data.append(mydict['data'])
+        data = np.concatenate(data)
+        labels = np.concatenate(labels)
         data = np.reshape(data, [-1, 3, 32, 32], order='C')
         if one_hot:
             labels = convert_to_one_hot(labels, num_classes=num_classes)
@@ -180,39 +182,8 @@ def load_cifar_data(data_dir, cifar10=True, val_size=2000, one_hot=True,
         val_labels
 
 
-def subsample(cifar10=True, size=50000):
-    """ Subsamples cifar10/cifar100 so the entire dataset has size <size> but
-    with equal classes."""
-    basedir = os.path.dirname(__file__)
-    if cifar10:
-        class_sz = size // 10
-        idx = np.load(os.path.join(basedir, 'cifar10_idxs.npy'))
-        return np.sort(idx[:, :class_sz].ravel())
-    else:
-        class_sz = size // 100
-        idx = np.load(os.path.join(basedir, 'cifar100_idxs.npy'))
-        return np.sort(idx[:, :class_sz].ravel())
-
-
-def get_data(in_size, data_dir, dataset='cifar10', batch_size=128,
-             trainsize=-1, seed=random.randint(0, 10000), perturb=True,
-             double_size=False, pin_memory=True, num_workers=0):
-    """ Provides a pytorch loader to load in cifar10/100
-    Args:
-        in_size (int): the input size - can be used to scale the spatial size
-        data_dir (str): the directory where the data is stored
-        dataset (str): 'cifar10' or 'cifar100'
-        batch_size (int): batch size for train loader. the val loader batch
-            size is always 100
-        trainsize (int): size of the training set. can be used to subsample it
-        seed (int): random seed for the loaders
-        perturb (bool): whether to do data augmentation on the training set
-        double_size (bool): whether to double the input size
-
-    Returns:
-        trainloader: iterator with (data, target) for train set
-        valloader: iterator with (data, target) for val set
-    """
+def _get_torchvision_sets(in_size, data_dir, dataset, perturb, double_size):
+    """ Makes the cifar datasets, which transform each image separately """
     if double_size:
         resize = transforms.Resize(in_size*2)
     else:
@@ -220,9 +191,9 @@ def get_data(in_size, data_dir, dataset='cifar10', batch_size=128,
 
     if perturb:
         transform_train = transforms.Compose([
-            transforms.RandomCrop(in_size, padding=4),
+            batch_transforms.ImageRandomCrop(in_size, padding=4),
             resize,
-            transforms.RandomHorizontalFlip(),
+            batch_transforms.ImageRandomHorizontalFlip(),
             transforms.ToTensor(),
             transforms.Normalize(mean[dataset], std[dataset])
         ])
@@ -245,9 +216,6 @@ def get_data(in_size, data_dir, dataset='cifar10', batch_size=128,
         trainset = torchvision.datasets.CIFAR10(
             root=data_dir, train=True, download=False,
             transform=transform_train)
-        if trainsize > 0:
-            idxs = subsample(False, trainsize)
-            trainset = torch.utils.data.Subset(trainset, idxs)
         testset = torchvision.datasets.CIFAR10(
             root=data_dir, train=False, download=False,
             transform=transform_test)
@@ -256,24 +224,129 @@ def get_data(in_size, data_dir, dataset='cifar10', batch_size=128,
         trainset = torchvision.datasets.CIFAR100(
             root=data_dir, train=True, download=False,
             transform=transform_train)
-        if trainsize > 0:
-            idxs = subsample(False, trainsize)
-            trainset = torch.utils.data.Subset(trainset, idxs)
         testset = torchvision.datasets.CIFAR100(
             root=data_dir, train=False, download=False,
             transform=transform_test)
+    return trainset, testset
+
+
+def _get_packed_sets(in_size, data_dir, dataset, perturb, double_size,
+                     pack_dir=None, distributed=False):
+    """ Makes the packed cifar datasets, which load and transform a batch at
+    a time, packing the dataset first if needed (on rank 0 only if
+    distributed) """
+    pack_dir = packed.rank0_first(packed.pack_cifar, data_dir, dataset,
+                                  pack_dir, distributed=distributed)
+    # Normalizing and resizing are both linear, so can be done in either
+    # order. Doing the crops and flips first keeps them on uint8 data
+    normalize = transforms.Compose([
+        batch_transforms.ToFloatNormalize(mean[dataset], std[dataset]),
+        batch_transforms.Resize(2 if double_size else 1),
+    ])
+    if perturb:
+        transform_train = transforms.Compose([
+            batch_transforms.RandomCrop(in_size, padding=4),
+            batch_transforms.RandomHorizontalFlip(),
+            normalize,
+        ])
+    else:
+        transform_train = transforms.Compose([
+            batch_transforms.CenterCrop(in_size),
+            normalize,
+        ])
+    transform_test = transforms.Compose([
+        batch_transforms.CenterCrop(in_size),
+        normalize,
+    ])
+    trainset = packed.PackedDataset(pack_dir, 'train', transform_train)
+    testset = packed.PackedDataset(pack_dir, 'test', transform_test)
+    return trainset, testset
+
+
+def get_data(in_size, data_dir, dataset='cifar10', batch_size=128,
+             trainsize=-1, seed=random.randint(0, 10000), perturb=True,
+             double_size=False, pin_memory=True, num_workers=0,
+             distributed=False, batched=False, pack_dir=None,
+             subsample_seed=0):
+    """ Provides a pytorch loader to load in cifar10/100
+    Args:
+        in_size (int): the input size - can be used to scale the spatial size
+        data_dir (str): the directory where the data is stored
+        dataset (str): 'cifar10' or 'cifar100'
+        batch_size (int): batch size for train loader. the val loader batch
+            size is always 100
+        trainsize (int): size of the training set. can be used to subsample it
+            to trainsize // num_classes images of each class, see
+            :func:`scatnet_learn.utils.stratified_indices`
+        seed (int): random seed for the loaders
+        perturb (bool): whether to do data augmentation on the training set
+        double_size (bool): whether to double the input size
+        distributed (bool): whether to shard the data between the processes
+            of the default (already initialized) torch.distributed process
+            group. The train set is shuffled with a DistributedSampler, whose
+            set_epoch must be called each epoch, and each process gets every
+            world_size'th image of the test set.
+        batched (bool): whether to load and augment whole batches at a time.
+            The dataset is packed into pack_dir the first time (see
+            :mod:`scatnet_learn.data.packed`), and the transforms are the
+            batch versions in :mod:`scatnet_learn.data.transforms`. This
+            avoids the per image overhead of the torchvision datasets.
+        pack_dir (str): where to store the packed dataset for batched.
+            Defaults to data_dir/<dataset>_packed.
+        subsample_seed (int): the seed for the choice of the trainsize
+            subset. Is separate from seed so runs with different seeds train
+            on the same subset.
+
+    Returns:
+        trainloader: iterator with (data, target) for train set
+        valloader: iterator with (data, target) for val set
+    """
+    if batched:
+        trainset, testset = _get_packed_sets(in_size, data_dir, dataset,
+                                             perturb, double_size, pack_dir,
+                                             distributed)
+    else:
+        trainset, testset = _get_torchvision_sets(in_size, data_dir, dataset,
+                                                  perturb, double_size)
+    if trainsize > 0:
+        idxs = stratified_indices(trainset.targets, trainsize, subsample_seed)
+        trainset = torch.utils.data.Subset(trainset, idxs)
 
     # Set the loader initializer seeds for reproducibility
     if seed is None:
         seed = random.randint(0, 10000)
+    # Offset the worker seeds by the rank so the processes augment differently
+    offset = dist.get_rank() * max(num_workers, 1) if distributed else 0
     def worker_init_fn(id):
         import random
         import numpy as np
-        random.seed(seed+id)
-        np.random.seed(seed+id)
+        random.seed(seed+offset+id)
+        np.random.seed(seed+offset+id)
+
+    if batched:
+        if distributed:
+            testset = shard(testset)
+        trainloader = packed.get_loader(
+            trainset, batch_size, shuffle=True, seed=seed,
+            num_workers=num_workers, pin_memory=pin_memory,
+            worker_init_fn=worker_init_fn, distributed=distributed)
+        testloader = packed.get_loader(
+            testset, 100, shuffle=False, num_workers=num_workers,
+            pin_memory=pin_memory, worker_init_fn=worker_init_fn)
+        return trainloader, testloader
+
+    if distributed:
+        # The sampler seed must be the same for every process so the shards
+        # don't overlap
+        trainsampler = torch.utils.data.distributed.DistributedSampler(
+            trainset, seed=seed)
+        testset = shard(testset)
+    else:
+        trainsampler = None
 
     trainloader = torch.utils.data.DataLoader(
-        trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+        trainset, batch_size=batch_size, shuffle=(trainsampler is None),
+        sampler=trainsampler, num_workers=num_workers,
         worker_init_fn=worker_init_fn, pin_memory=pin_memory)
     testloader = torch.utils.data.DataLoader(
         testset, batch_size=100, shuffle=False, num_workers=num_workers,
@@ -0,0 +1,410 @@
+"""
+Module to store an image dataset as contiguous uint8 arrays and serve whole
+batches of it.
+
+A split of the dataset is converted once into ``<split>_x.npy``, a uint8
+N x C x H x W array, and ``<split>_y.npy``, the int64 labels. Large splits,
+e.g. tiny imagenet's train set, are instead written as shards
+``<split>_x_00000.npy, <split>_x_00001.npy ...`` of shard_size images each.
+Reading memory maps the images and indexes a batch of them at once, so a
+batch costs one numpy gather per shard and a ``torch.from_numpy`` rather
+than a python call, decode and collate per image. The batches are uint8 and
+unnormalized.
+
+To use it, give :func:`get_loader` a :class:`PackedDataset`. The loader's
+sampler is a :class:`BatchSampler`, which yields arrays of indices, so each
+item the DataLoader fetches is a whole batch::
+
+    pack_cifar('/scratch/share/cifar', 'cifar10', 'packed/cifar10')
+    trainset = PackedDataset('packed/cifar10', 'train')
+    trainloader = get_loader(trainset, batch_size=128, shuffle=True)
+
+The pack directory has::
+
+    - meta.json: the image shape, dtype, length and shard files of each
+      split, and for image folders the class to index map
+    - <split>_x.npy or <split>_x_00000.npy, ...: the images of each split
+    - <split>_y.npy: the labels of each split
+"""
+import json
+import multiprocessing
+import os
+
+import PIL.Image
+
+import numpy as np
+import torch
+import torch.utils.data
+import torch.distributed as dist
+
+META = 'meta.json'
+
+
+def _read_meta(pack_dir):
+    meta_file = os.path.join(pack_dir, META)
+    if not os.path.exists(meta_file):
+        return {}
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def write_split(pack_dir, split, x, y, **info):
+    """ Saves one split of a dataset.
+
+    The arrays are written to temporary files and renamed into place, and the
+    split is only added to meta.json once they are, so an interrupted write
+    never leaves a split that looks complete.
+
+    Args:
+        pack_dir (str): the directory to write to
+        split (str): name of the split, e.g. 'train' or 'test'
+        x (ndarray): the N x C x H x W images. Are stored as uint8.
+        y (ndarray): the N labels. Are stored as int64.
+        info: any other values to record in meta.json for the split
+
+    Returns:
+        meta (dict): the split's entry in meta.json
+    """
+    os.makedirs(pack_dir, exist_ok=True)
+    x = np.ascontiguousarray(x, dtype=np.uint8)
+    y = np.ascontiguousarray(y, dtype=np.int64)
+    if x.ndim != 4 or len(x) != len(y):
+        raise ValueError('Expected N x C x H x W images and N labels, got '
+                         'shapes {} and {}'.format(x.shape, y.shape))
+    for name, arr in (('x', x), ('y', y)):
+        _save(os.path.join(pack_dir, '{}_{}.npy'.format(split, name)), arr)
+    return _add_split(pack_dir, split, dict(
+        length=len(x), shape=list(x.shape[1:]), dtype=x.dtype.str,
+        shard_size=len(x), shards=[split + '_x.npy'], **info))
+
+
+def _save(f, arr):
+    """ Saves arr to f via a temporary file, so f is never partly written """
+    with open(f + '.tmp', 'wb') as fp:
+        np.save(fp, arr)
+    os.replace(f + '.tmp', f)
+
+
+def _add_split(pack_dir, split, entry):
+    """ Records a split in meta.json, once its files are all written """
+    meta = _read_meta(pack_dir)
+    meta[split] = entry
+    with open(os.path.join(pack_dir, META + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(pack_dir, META + '.tmp'),
+               os.path.join(pack_dir, META))
+    return entry
+
+
+def is_packed(pack_dir, split):
+    """ Returns true if the split has been written to pack_dir. """
+    return split in _read_meta(pack_dir)
+
+
+def rank0_first(fn, *args, distributed=False, **kwargs):
+    """ Calls fn(*args, **kwargs), e.g. one of the pack functions. If
+    distributed, rank 0 calls it first while the other processes of the
+    default process group wait, so only one process writes the files. The
+    pack functions skip splits that are already packed, so the others then
+    only read meta.json.
+
+    The barrier times out with the process group (30 minutes by default),
+    so for a large dataset pack it before starting the processes.
+    """
+    first = not distributed or dist.get_rank() == 0
+    if not first:
+        dist.barrier()
+    out = fn(*args, **kwargs)
+    if distributed and first:
+        dist.barrier()
+    return out
+
+
+def pack_cifar(data_dir, dataset='cifar10', pack_dir=None, overwrite=False):
+    """ Converts the python version of cifar10/100 to the packed format.
+
+    Args:
+        data_dir (str): the directory with the cifar python files, as for
+            :func:`scatnet_learn.data.cifar.load_cifar_data`
+        dataset (str): 'cifar10' or 'cifar100'
+        pack_dir (str): where to write the splits 'train' and 'test'.
+            Defaults to data_dir/<dataset>_packed
+        overwrite (bool): convert again even if pack_dir already has both
+            splits
+
+    Returns:
+        pack_dir (str)
+    """
+    from scatnet_learn.data.cifar import load_cifar_data
+    if pack_dir is None:
+        pack_dir = os.path.join(data_dir, dataset + '_packed')
+    if not overwrite and is_packed(pack_dir, 'train') and \
+            is_packed(pack_dir, 'test'):
+        return pack_dir
+
+    trainx, trainy, testx, testy, _, _ = load_cifar_data(
+        data_dir, cifar10=(dataset == 'cifar10'), val_size=0, one_hot=False)
+    write_split(pack_dir, 'train', trainx, trainy, dataset=dataset)
+    write_split(pack_dir, 'test', testx, testy, dataset=dataset)
+    return pack_dir
+
+
+def _decode(path):
+    """ Reads an image file into a C x H x W uint8 array, decoding it as
+    ImageFolder's default loader does """
+    with open(path, 'rb') as f:
+        img = PIL.Image.open(f).convert('RGB')
+    return np.asarray(img).transpose(2, 0, 1)
+
+
+def pack_image_folder(root, pack_dir, split, shard_size=10000,
+                      num_workers=None, overwrite=False):
+    """ Decodes the images of an ImageFolder tree, e.g. tiny imagenet's train
+    or val2 directory, into shards of the packed format.
+
+    The images are in the order ImageFolder lists them, and the labels are
+    its class indices, so a :class:`PackedDataset` of the split gives the
+    same (image, label) pairs as ImageFolder(root). Its classes and
+    class_to_idx are saved in meta.json. All the images must be the same
+    size.
+
+    Args:
+        root (str): the root of the tree, with one directory per class
+        pack_dir (str): the directory to write to
+        split (str): the name to save the split under
+        shard_size (int): how many images to put in each file
+        num_workers (int): number of processes to decode the images with.
+            Defaults to the number of cpus.
+        overwrite (bool): convert again even if pack_dir already has the
+            split
+
+    Returns:
+        meta (dict): the split's entry in meta.json
+    """
+    from torchvision import datasets
+    if not overwrite and is_packed(pack_dir, split):
+        return _read_meta(pack_dir)[split]
+    os.makedirs(pack_dir, exist_ok=True)
+    # Listing the tree doesn't decode anything
+    folder = datasets.ImageFolder(root)
+    files = [path for path, _ in folder.samples]
+    labels = np.array([target for _, target in folder.samples],
+                      dtype=np.int64)
+    if len(files) == 0:
+        raise ValueError('Found no images in {}'.format(root))
+    shape = _decode(files[0]).shape
+
+    shards = []
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for start in range(0, len(files), shard_size):
+            chunk = files[start:start + shard_size]
+            name = '{}_x_{:05d}.npy'.format(split, len(shards))
+            f = os.path.join(pack_dir, name)
+            x = np.lib.format.open_memmap(f + '.tmp', mode='w+',
+                                          dtype=np.uint8,
+                                          shape=(len(chunk),) + shape)
+            for i, img in enumerate(pool.imap(_decode, chunk, chunksize=64)):
+                if img.shape != shape:
+                    raise ValueError(
+                        '{} has shape {}, but the first image has shape '
+                        '{}'.format(chunk[i], img.shape, shape))
+                x[i] = img
+            x.flush()
+            del x
+            os.replace(f + '.tmp', f)
+            shards.append(name)
+    finally:
+        pool.close()
+        pool.join()
+
+    _save(os.path.join(pack_dir, split + '_y.npy'), labels)
+    return _add_split(pack_dir, split, dict(
+        length=len(files), shape=list(shape), dtype=np.dtype(np.uint8).str,
+        shard_size=shard_size, shards=shards, root=os.path.abspath(root),
+        classes=folder.classes, class_to_idx=folder.class_to_idx))
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """ Serves a split written by :func:`write_split`.
+
+    Indexing with an array of indices returns the whole batch, as a uint8
+    tensor of images and an int64 tensor of labels. The indices are sorted
+    first so the reads from the memory map are in file order. Indexing with
+    an int returns a single image and label. The transform is always given a
+    batch. The files are only opened on first use, so each DataLoader worker
+    maps them itself.
+
+    Args:
+        pack_dir (str): the directory written by :func:`write_split`
+        split (str): which split to read
+        transform (callable): optional function to apply to each batch of
+            images
+    """
+    def __init__(self, pack_dir, split, transform=None):
+        meta = _read_meta(pack_dir)
+        if split not in meta:
+            raise ValueError(
+                'Could not find the {} split in {}. Has it been '
+                'packed?'.format(split, pack_dir))
+        self.meta = meta[split]
+        self.pack_dir = pack_dir
+        self.split = split
+        self.transform = transform
+        self.shape = tuple(self.meta['shape'])
+        self.shard_size = self.meta.get('shard_size', self.meta['length'])
+        self.classes = self.meta.get('classes')
+        self.class_to_idx = self.meta.get('class_to_idx')
+        self._x = None
+        self._y = None
+
+    @property
+    def x(self):
+        """ The memory maps of the shards """
+        if self._x is None:
+            shards = self.meta.get('shards', [self.split + '_x.npy'])
+            self._x = [np.load(os.path.join(self.pack_dir, name),
+                               mmap_mode='r') for name in shards]
+        return self._x
+
+    @property
+    def y(self):
+        if self._y is None:
+            self._y = np.load(os.path.join(
+                self.pack_dir, self.split + '_y.npy'))
+        return self._y
+
+    @property
+    def targets(self):
+        return self.y
+
+    def __len__(self):
+        return self.meta['length']
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0:
+            # A batch of one, copied out of the read only map
+            x, y = self[np.array([idx])]
+            return x[0], int(y[0])
+        idx = np.sort(np.asarray(idx))
+        if len(self.x) == 1:
+            # The fancy indexing gathers the batch into a new array, which
+            # from_numpy wraps without copying
+            x = self.x[0][idx]
+        else:
+            # Gather from each shard the batch touches in turn. As idx is
+            # sorted, each shard's images are a contiguous run of the batch
+            x = np.empty((len(idx),) + self.shape, dtype=np.uint8)
+            k = idx // self.shard_size
+            bounds = np.flatnonzero(np.diff(k)) + 1
+            for a, b in zip(np.r_[0, bounds], np.r_[bounds, len(idx)]):
+                x[a:b] = self.x[k[a]][idx[a:b] - k[a] * self.shard_size]
+        x = torch.from_numpy(x)
+        y = torch.from_numpy(self.y[idx])
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, y
+
+    def __getstate__(self):
+        # Don't send the maps to the DataLoader workers
+        state = self.__dict__.copy()
+        state['_x'] = None
+        state['_y'] = None
+        return state
+
+
+class BatchSampler(torch.utils.data.Sampler):
+    """ Yields arrays of indices, one per batch, for datasets like
+    :class:`PackedDataset` that load a whole batch at a time.
+
+    The order is a permutation drawn from seed and the epoch, so call
+    :meth:`set_epoch` each epoch as with a DistributedSampler. With
+    num_replicas > 1 each replica gets every num_replicas'th index of the
+    permutation, padded by wrapping around so they all have the same number
+    of batches.
+
+    Args:
+        n (int or Dataset): the dataset or its size
+        batch_size (int): number of indices in each batch
+        shuffle (bool): whether to shuffle. If false the indices are in
+            order.
+        drop_last (bool): whether to drop the last batch if it is smaller
+            than batch_size
+        seed (int): seed for the permutation. Must be the same for all the
+            replicas.
+        num_replicas (int): the number of processes. Defaults to the world
+            size if torch.distributed is initialized, else 1.
+        rank (int): this process's rank. Defaults to the rank in the default
+            process group if it is initialized, else 0.
+    """
+    def __init__(self, n, batch_size, shuffle=True, drop_last=False, seed=0,
+                 num_replicas=None, rank=None):
+        if not isinstance(n, int):
+            n = len(n)
+        initialized = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if initialized else 1
+        if rank is None:
+            rank = dist.get_rank() if initialized else 0
+        self.n = n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = -(-n // num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            rng = np.random.RandomState((self.seed + self.epoch) % 2**32)
+            idx = rng.permutation(self.n)
+        else:
+            idx = np.arange(self.n)
+        if self.num_replicas > 1:
+            total = self.num_samples * self.num_replicas
+            idx = np.resize(idx, total)[self.rank::self.num_replicas]
+        for i in range(len(self)):
+            yield idx[i*self.batch_size:(i+1)*self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return -(-self.num_samples // self.batch_size)
+
+
+def get_loader(dataset, batch_size, shuffle=True, drop_last=False, seed=0,
+               num_workers=0, pin_memory=False, worker_init_fn=None,
+               distributed=False):
+    """ Makes a DataLoader that fetches whole batches from a
+    :class:`PackedDataset`.
+
+    Args:
+        dataset (PackedDataset): the data
+        batch_size (int): the batch size
+        shuffle (bool): whether to shuffle each epoch
+        drop_last (bool): whether to drop the last incomplete batch
+        seed (int): the seed for the shuffling
+        num_workers (int): how many workers to load batches with
+        pin_memory (bool): whether to pin the batches
+        worker_init_fn (callable): passed to the DataLoader
+        distributed (bool): whether to shard the batches between the
+            processes of the default torch.distributed process group
+
+    Returns:
+        loader: iterator with (data, target) batches. data is uint8.
+    """
+    if distributed:
+        sampler = BatchSampler(dataset, batch_size, shuffle, drop_last, seed)
+    else:
+        sampler = BatchSampler(dataset, batch_size, shuffle, drop_last, seed,
+                               num_replicas=1, rank=0)
+    # batch_size=None turns off the DataLoader's batching, so each index
+    # array goes to the dataset in one call and the batch comes back as is
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=None, sampler=sampler, num_workers=num_workers,
+        pin_memory=pin_memory, worker_init_fn=worker_init_fn)
@@ -3,40 +3,170 @@ amenable to pytorch loading.
 
 I.e. it puts the validation files in a new folder called 'val2' where
 each class is in its own subfolder, rather than relying on the
-val_annotations.txt file."""
+val_annotations.txt file.
+
+The files are hard linked rather than copied, falling back to symbolic links
+if the filesystem can't hard link, and the links are made by a pool of
+threads, as on network filesystems each one is a round trip to the server.
+Links that already exist are skipped, so the script can be rerun after an
+interruption and only does the work left. When done it writes
+data_dir/manifest.json, which lists the classes and the files and labels of
+each split in the order ImageFolder would find them. If the manifest already
+exists nothing is done unless --force is given.
+
+With --pack, it then also decodes the train and val2 images into the shards
+of a packed dataset (see scatnet_learn.data.packed), as used by
+tiny_imagenet.get_data with batched=True."""
 import csv
+import errno
+import json
 import os
-from shutil import copyfile
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from scatnet_learn.data import packed
+
+MANIFEST = 'manifest.json'
 
 parser = argparse.ArgumentParser(description='Prep tiny imagenet for '
                                              'classification')
 parser.add_argument('data_dir', type=str,
                     default='/scratch/share/Tiny_Imagenet',
                     help='Default location for the dataset')
+parser.add_argument('--threads', type=int, default=32,
+                    help='Number of threads to make the links and list the '
+                         'directories with')
+parser.add_argument('--force', action='store_true',
+                    help='Check all the links and rewrite the manifest even '
+                         'if it already exists')
+parser.add_argument('--pack', action='store_true',
+                    help='Also decode the images into packed shards')
+parser.add_argument('--pack_dir', type=str, default=None,
+                    help='Where to write the packed shards. Defaults to '
+                         'data_dir/tiny_imagenet_packed')
+parser.add_argument('--num_workers', type=int, default=None,
+                    help='Number of processes to decode the images with')
 
 
-def main(args):
-    labels = {}
-    with open(os.path.join(args.data_dir, 'val', 'val_annotations.txt')) as f:
-        reader = csv.reader(f, delimiter='\t')
-        for row in reader:
-            labels[row[0]] = row[1]
-
-    folders = {}
-    for k, v in labels.items():
+def _link(pair):
+    """ Links dest to src. Returns 1 if a link was made, 0 if dest already
+    existed. """
+    src, dest = pair
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return 0
+        # E.g. a filesystem without hard links, or src on another device
         try:
-            folders[v].append(k)
-        except KeyError:
-            folders[v] = [k]
-
-    # Make a new folder call val2
-    os.makedirs(os.path.join(args.data_dir, 'val2'), exist_ok=True)
-    for k, v in folders.items():
-        os.makedirs(os.path.join(args.data_dir, 'val2', k), exist_ok=True)
-        for f in v:
-            copyfile(os.path.join(args.data_dir, 'val', 'images', f),
-                     os.path.join(args.data_dir, 'val2', k, f))
+            os.symlink(os.path.abspath(src), dest)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return 0
+            raise
+    return 1
+
+
+def link_files(pairs, threads=32):
+    """ Links each dest to its src in parallel, making the directories of
+    the dests first. Dests that already exist are left alone.
+
+    Args:
+        pairs (list): of (src, dest) paths
+        threads (int): number of threads to link with
+
+    Returns:
+        made (int): the number of new links
+    """
+    for d in {os.path.dirname(dest) for _, dest in pairs}:
+        os.makedirs(d, exist_ok=True)
+    with ThreadPoolExecutor(threads) as pool:
+        return sum(pool.map(_link, pairs))
+
+
+def _list_class(class_dir):
+    """ Lists the images under a class directory, sorted as ImageFolder
+    does. """
+    files = []
+    for root, _, fnames in sorted(os.walk(class_dir, followlinks=True)):
+        for fname in sorted(fnames):
+            if fname.lower().endswith(('.jpeg', '.jpg', '.png')):
+                files.append(os.path.join(root, fname))
+    return files
+
+
+def index_split(split_dir, classes, threads=32):
+    """ Lists a split's files and labels in ImageFolder's order, listing the
+    class directories in parallel.
+
+    Returns:
+        samples (list): of [path relative to split_dir, class index]
+    """
+    with ThreadPoolExecutor(threads) as pool:
+        listed = pool.map(_list_class,
+                          [os.path.join(split_dir, c) for c in classes])
+        return [[os.path.relpath(f, split_dir), i]
+                for i, files in enumerate(listed) for f in files]
+
+
+def read_manifest(data_dir):
+    """ Returns the manifest written by :func:`main`, or None if there isn't
+    one. """
+    f = os.path.join(data_dir, MANIFEST)
+    if not os.path.exists(f):
+        return None
+    with open(f) as fp:
+        return json.load(fp)
+
+
+def main(args):
+    if read_manifest(args.data_dir) is not None and not args.force:
+        print('| {} exists, so tiny imagenet is already prepared. Use '
+              '--force to check it again'.format(
+                  os.path.join(args.data_dir, MANIFEST)))
+    else:
+        labels = {}
+        with open(os.path.join(args.data_dir, 'val',
+                               'val_annotations.txt')) as f:
+            reader = csv.reader(f, delimiter='\t')
+            for row in reader:
+                labels[row[0]] = row[1]
+
+        # Link the validation images into a new folder called val2
+        pairs = [(os.path.join(args.data_dir, 'val', 'images', f),
+                  os.path.join(args.data_dir, 'val2', c, f))
+                 for f, c in sorted(labels.items())]
+        made = link_files(pairs, args.threads)
+        print('| Linked {} validation images ({} already done)'.format(
+            made, len(pairs) - made))
+
+        # Write the manifest last, so it only exists once the rest is done
+        classes = sorted(
+            d.name for d in os.scandir(os.path.join(args.data_dir, 'train'))
+            if d.is_dir())
+        manifest = {
+            'classes': classes,
+            'splits': {
+                split: index_split(os.path.join(args.data_dir, split),
+                                   classes, args.threads)
+                for split in ('train', 'val2')
+            },
+        }
+        f = os.path.join(args.data_dir, MANIFEST)
+        with open(f + '.tmp', 'w') as fp:
+            json.dump(manifest, fp)
+        os.replace(f + '.tmp', f)
+        print('| Wrote {} with {} train and {} val2 images'.format(
+            f, len(manifest['splits']['train']),
+            len(manifest['splits']['val2'])))
+
+    if args.pack:
+        pack_dir = args.pack_dir or os.path.join(args.data_dir,
+                                                 'tiny_imagenet_packed')
+        for split in ('train', 'val2'):
+            packed.pack_image_folder(os.path.join(args.data_dir, split),
+                                     pack_dir, split,
+                                     num_workers=args.num_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""
+Module to precompute the output of a fixed front end (e.g. the ScatLayerj2 or
+pair of ScatLayerj1 layers at the start of a ScatNet) over a dataset and serve
+it from disk.
+
+The features are written to a directory of .npy shards that are memory mapped
+when read, so each epoch only has to train the learned part of the network.
+As the features are computed once, this only makes sense for datasets without
+random augmentation, e.g. the cifar loaders with perturb=False.
+
+For example, to train only the head of a ScatNet whose first block is a pair
+of ScatLayerj1 layers followed by a BatchNorm::
+
+    precompute(net.net[0][:2], testset, 'store/test')
+    testset = FeatureStore('store/test')
+
+The store directory has::
+
+    - meta.json: the sample shape, dtype, number of samples and shards
+    - shard_00000.npy, shard_00001.npy, ...: the features, shard_size samples
+      per file
+    - labels.npy: the targets
+"""
+import json
+import os
+
+import numpy as np
+import torch
+import torch.utils.data
+
+META = 'meta.json'
+
+
+def _shard_name(i):
+    return 'shard_{:05d}.npy'.format(i)
+
+
+def precompute(prefix, dataset, out_dir, batch_size=256, shard_size=10000,
+               dtype=np.float32, device=None, num_workers=0):
+    """ Runs prefix over every sample of dataset and saves the outputs.
+
+    Args:
+        prefix (nn.Module): the fixed part of the network. Is run in eval mode
+            with no gradients.
+        dataset (Dataset): returns (x, y) pairs. Is read in order.
+        out_dir (str): the directory to write the store to
+        batch_size (int): how many samples to transform at a time
+        shard_size (int): how many samples to put in each file
+        dtype: the numpy datatype to store the features in. float16 halves
+            the disk space and read bandwidth.
+        device: where to run prefix. Defaults to the device of its parameters.
+        num_workers (int): number of workers to load the dataset with
+
+    Returns:
+        meta (dict): the contents of meta.json
+    """
+    n = len(dataset)
+    if n == 0:
+        raise ValueError('The dataset is empty, so there is nothing to '
+                         'precompute')
+    os.makedirs(out_dir, exist_ok=True)
+    # Remove the old meta first so a partly written store can't be read
+    if os.path.exists(os.path.join(out_dir, META)):
+        os.remove(os.path.join(out_dir, META))
+    if device is None:
+        p = next(prefix.parameters(), None)
+        device = p.device if p is not None else torch.device('cpu')
+
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=False,
+        num_workers=num_workers)
+    was_training = prefix.training
+    prefix.eval()
+
+    shards = []
+    labels = None
+    shard = None
+    i = 0
+    with torch.no_grad():
+        for x, y in loader:
+            z = prefix(x.to(device)).cpu().numpy().astype(dtype, copy=False)
+            y = np.asarray(y)
+            if labels is None:
+                labels = np.empty((n,) + y.shape[1:], dtype=y.dtype)
+            labels[i:i + len(y)] = y
+
+            # Write the batch out, possibly split across shards
+            j = 0
+            while j < len(z):
+                k, off = divmod(i, shard_size)
+                if off == 0:
+                    if shard is not None:
+                        shard.flush()
+                    shards.append(_shard_name(k))
+                    shard = np.lib.format.open_memmap(
+                        os.path.join(out_dir, shards[-1]), mode='w+',
+                        dtype=dtype,
+                        shape=(min(shard_size, n - i),) + z.shape[1:])
+                m = min(len(z) - j, shard_size - off)
+                shard[off:off + m] = z[j:j + m]
+                i += m
+                j += m
+
+    if shard is not None:
+        shard.flush()
+    prefix.train(was_training)
+    np.save(os.path.join(out_dir, 'labels.npy'), labels)
+
+    meta = {
+        'length': i,
+        'shape': list(z.shape[1:]),
+        'dtype': np.dtype(dtype).str,
+        'shard_size': shard_size,
+        'shards': shards,
+        'prefix': repr(prefix),
+    }
+    with open(os.path.join(out_dir, META), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class FeatureStore(torch.utils.data.Dataset):
+    """ Serves the features saved by :func:`precompute`.
+
+    The shards are memory mapped copy-on-write, so indexing returns a tensor
+    backed by the page cache without copying the data. The files are only
+    opened on first use, so each DataLoader worker maps them itself.
+
+    Args:
+        store_dir (str): the directory written by :func:`precompute`
+        transform (callable): optional function to apply to each feature
+            tensor
+    """
+    def __init__(self, store_dir, transform=None):
+        meta_file = os.path.join(store_dir, META)
+        if not os.path.exists(meta_file):
+            raise ValueError(
+                'Could not find {}. Has precompute finished writing the '
+                'store?'.format(meta_file))
+        with open(meta_file) as f:
+            self.meta = json.load(f)
+        self.store_dir = store_dir
+        self.transform = transform
+        self.shard_size = self.meta['shard_size']
+        self.shape = tuple(self.meta['shape'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'))
+        self._shards = None
+
+    @property
+    def shards(self):
+        if self._shards is None:
+            self._shards = [
+                np.load(os.path.join(self.store_dir, name), mmap_mode='c')
+                for name in self.meta['shards']]
+        return self._shards
+
+    def __len__(self):
+        return self.meta['length']
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        k, off = divmod(idx, self.shard_size)
+        z = torch.from_numpy(self.shards[k][off])
+        if self.transform is not None:
+            z = self.transform(z)
+        return z, self.labels[idx]
+
+    def __getstate__(self):
+        # Don't send the maps to the DataLoader workers
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
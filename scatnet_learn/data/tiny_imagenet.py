@@ -5,24 +5,44 @@ import os
 import sys
 import random
 import torch.utils.data
+import torch.distributed as dist
+from scatnet_learn.utils import shard, stratified_indices
+from scatnet_learn.data import packed
+from scatnet_learn.data import transforms as batch_transforms
 
 
-def subsample(data_dir, sz):
-    dest = os.path.join(data_dir, 'train{}'.format(sz))
-    os.makedirs(dest)
-    classes = os.listdir(os.path.join(data_dir, 'train'))
-    for c in classes:
-        if os.path.isdir(os.path.join(data_dir, 'train', c)):
-            os.makedirs(os.path.join(dest, c))
-            files = os.listdir(os.path.join(data_dir, 'train', c, 'images'))
-            for i in range(sz):
-                os.symlink(os.path.join(data_dir, 'train', c, 'images', files[i]),
-                           os.path.join(dest, c, files[i]))
+def _subsample(trainset, trainsize, seed):
+    """ Takes a class balanced subset of trainsize images, if trainsize is
+    less than the size of the train set. Only uses the labels, so nothing is
+    read or written. """
+    if 0 < trainsize < len(trainset):
+        idxs = stratified_indices(trainset.targets, trainsize, seed)
+        trainset = torch.utils.data.Subset(trainset, idxs)
+    return trainset
+
+
+def pack(data_dir, pack_dir=None, val_only=False):
+    """ Packs the val2 and train splits for get_data with batched=True, if
+    they aren't already. E.g. to do it once before starting distributed
+    processes.
+
+    Returns:
+        pack_dir (str)
+    """
+    if pack_dir is None:
+        pack_dir = os.path.join(data_dir, 'tiny_imagenet_packed')
+    packed.pack_image_folder(os.path.join(data_dir, 'val2'), pack_dir,
+                             'val2')
+    if not val_only:
+        packed.pack_image_folder(os.path.join(data_dir, 'train'), pack_dir,
+                                 'train')
+    return pack_dir
 
 
 def get_data(in_size, data_dir, val_only=False, batch_size=128,
              trainsize=-1, seed=random.randint(0, 10000), perturb=True,
-             num_workers=4, iter_size=1, distributed=False, pin_memory=False):
+             num_workers=4, iter_size=1, distributed=False, pin_memory=False,
+             batched=False, pack_dir=None, subsample_seed=0):
     """ Provides a pytorch loader to load in imagenet
     Args:
         in_size (int): the input size - can be used to scale the spatial size
@@ -30,22 +50,45 @@ def get_data(in_size, data_dir, val_only=False, batch_size=128,
         val_only (bool): Whether to load only the validation set
         batch_size (int): batch size for train loader. the val loader batch
             size is always 100
-        class_sz (int): size of the training set. can be used to subsample it
+        trainsize (int): size of the training set. can be used to subsample it
+            to trainsize // 200 images of each class, see
+            :func:`scatnet_learn.utils.stratified_indices`
         seed (int): random seed for the loaders
         perturb (bool): whether to do data augmentation on the training set
         num_workers (int): how many workers to load data
-        iter_size (int):
+        iter_size (int): number of batches the gradients are accumulated
+            over in each update step. The train loader gives batches of
+            batch_size // iter_size, so batch_size is the effective batch size
+        distributed (bool): whether to shard the data between the processes
+            of the default (already initialized) torch.distributed process
+            group. The train set is shuffled with a DistributedSampler, whose
+            set_epoch must be called each epoch, and each process gets every
+            world_size'th image of the val set.
+        batched (bool): whether to load and augment whole batches at a time.
+            The images are decoded once into the shards of a packed dataset
+            in pack_dir the first time (see :mod:`scatnet_learn.data.packed`),
+            and the transforms are the batch versions in
+            :mod:`scatnet_learn.data.transforms`.
+        pack_dir (str): where to store the packed dataset for batched.
+            Defaults to data_dir/tiny_imagenet_packed.
+        subsample_seed (int): the seed for the choice of the trainsize
+            subset. Is separate from seed so runs with different seeds train
+            on the same subset.
     """
-    # Set the loader initializer seeds for reproducibility
+    # Set the loader initializer seeds for reproducibility. Offset them by the
+    # rank so the processes augment differently
+    offset = dist.get_rank() * max(num_workers, 1) if distributed else 0
     def worker_init_fn(id):
         import random
         import numpy as np
-        random.seed(seed+id)
-        np.random.seed(seed+id)
+        random.seed(seed+offset+id)
+        np.random.seed(seed+offset+id)
 
     valdir = os.path.join(data_dir, 'val2')
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                     std=[0.229, 0.224, 0.225])
+    mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    normalize = transforms.Normalize(mean=mean, std=std)
+    if pack_dir is None:
+        pack_dir = os.path.join(data_dir, 'tiny_imagenet_packed')
 
     if not os.path.exists(valdir):
         raise ValueError(
@@ -54,58 +97,93 @@ def get_data(in_size, data_dir, val_only=False, batch_size=128,
             'scatnet_learn.data?')
 
     # Get the test loader
-    transform_test = transforms.Compose([
-        #  transforms.RandomRotation((30, 30), PIL.Image.BILINEAR),
-        transforms.CenterCrop(in_size),
-        transforms.ToTensor(),
-        normalize
-    ])
-    testloader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transform_test),
-        batch_size=100, shuffle=False,
-        num_workers=num_workers, pin_memory=pin_memory,
-        worker_init_fn=worker_init_fn)
+    if batched:
+        packed.rank0_first(packed.pack_image_folder, valdir, pack_dir,
+                           'val2', distributed=distributed)
+        testset = packed.PackedDataset(
+            pack_dir, 'val2', transforms.Compose([
+                batch_transforms.CenterCrop(in_size),
+                batch_transforms.ToFloatNormalize(mean, std),
+            ]))
+    else:
+        transform_test = transforms.Compose([
+            #  transforms.RandomRotation((30, 30), PIL.Image.BILINEAR),
+            transforms.CenterCrop(in_size),
+            transforms.ToTensor(),
+            normalize
+        ])
+        testset = datasets.ImageFolder(valdir, transform_test)
+    if distributed:
+        testset = shard(testset)
+    if batched:
+        testloader = packed.get_loader(
+            testset, 100, shuffle=False, num_workers=num_workers,
+            pin_memory=pin_memory, worker_init_fn=worker_init_fn)
+    else:
+        testloader = torch.utils.data.DataLoader(
+            testset,
+            batch_size=100, shuffle=False,
+            num_workers=num_workers, pin_memory=pin_memory,
+            worker_init_fn=worker_init_fn)
 
     if val_only:
         trainloader = None
     else:
-        if 0 < trainsize < 100000:
-            class_sz = trainsize // 200
-            traindir = os.path.join(data_dir, 'train{}'.format(class_sz))
-        else:
-            traindir = os.path.join(data_dir, 'train')
-        if not os.path.exists(traindir):
-            subsample(data_dir, class_sz)
-            assert os.path.exists(traindir)
+        traindir = os.path.join(data_dir, 'train')
         # Get the train loader
-        if perturb:
-            transform_train = transforms.Compose([
-                transforms.RandomCrop(in_size, padding=8),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ])
+        if batched:
+            if perturb:
+                transform_train = transforms.Compose([
+                    batch_transforms.RandomCrop(in_size, padding=8),
+                    batch_transforms.RandomHorizontalFlip(),
+                    batch_transforms.ToFloatNormalize(mean, std),
+                ])
+            else:
+                transform_train = transforms.Compose([
+                    batch_transforms.CenterCrop(in_size),
+                    batch_transforms.ToFloatNormalize(mean, std),
+                ])
+            packed.rank0_first(packed.pack_image_folder, traindir,
+                               pack_dir, 'train', distributed=distributed)
+            trainset = packed.PackedDataset(pack_dir, 'train',
+                                            transform_train)
+            trainset = _subsample(trainset, trainsize, subsample_seed)
+            trainloader = packed.get_loader(
+                trainset, batch_size // iter_size, shuffle=True, seed=seed,
+                num_workers=num_workers, pin_memory=pin_memory,
+                worker_init_fn=worker_init_fn, distributed=distributed)
         else:
-            transform_train = transforms.Compose([
-                transforms.CenterCrop(in_size),
-                transforms.ToTensor(),
-                normalize
-            ])
+            if perturb:
+                transform_train = transforms.Compose([
+                    batch_transforms.ImageRandomCrop(in_size, padding=8),
+                    batch_transforms.ImageRandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    normalize,
+                ])
+            else:
+                transform_train = transforms.Compose([
+                    transforms.CenterCrop(in_size),
+                    transforms.ToTensor(),
+                    normalize
+                ])
 
-        trainset = datasets.ImageFolder(
-            traindir, transform_train)
+            trainset = datasets.ImageFolder(
+                traindir, transform_train)
+            trainset = _subsample(trainset, trainsize, subsample_seed)
 
-        if distributed:
-            trainsampler = torch.utils.data.distributed.DistributedSampler(
-                trainset)
-        else:
-            trainsampler = None
+            if distributed:
+                # The sampler seed must be the same for every process so the
+                # shards don't overlap
+                trainsampler = torch.utils.data.distributed.DistributedSampler(
+                    trainset, seed=seed)
+            else:
+                trainsampler = None
 
-        trainloader = torch.utils.data.DataLoader(
-            trainset, batch_size=batch_size // iter_size,
-            shuffle=(trainsampler is None), num_workers=num_workers,
-            pin_memory=pin_memory, sampler=trainsampler,
-            worker_init_fn=worker_init_fn)
+            trainloader = torch.utils.data.DataLoader(
+                trainset, batch_size=batch_size // iter_size,
+                shuffle=(trainsampler is None), num_workers=num_workers,
+                pin_memory=pin_memory, sampler=trainsampler,
+                worker_init_fn=worker_init_fn)
 
     sys.stdout.write("| loaded tiny imagenet")
     return trainloader, testloader
@@ -0,0 +1,214 @@
+"""
+Module of data augmentation transforms that work on whole batches.
+
+Each transform takes an N x C x H x W tensor and applies the same operation
+as the torchvision transform of the same name to every image of the batch
+with one vectorized op, rather than a python call per image. The random
+transforms draw from :func:`get_rng`, which is ``np.random`` unless a thread
+has its own generator set by :func:`thread_rng`. The loaders'
+``worker_init_fn`` seeds ``np.random`` in each DataLoader worker (and the
+training script seeds it in the main process), and
+:class:`scatnet_learn.learn.Prefetcher` gives its loading thread a seeded
+generator, so runs are reproducible however the batches are loaded.
+:class:`ImageRandomCrop` and :class:`ImageRandomHorizontalFlip` are per image
+versions for PIL images that draw from the same generators, for the
+torchvision datasets.
+
+The images should stay uint8 until :class:`ToFloatNormalize`, so the crops
+and flips move a quarter of the data. They can be chained with
+``torchvision.transforms.Compose``. Use them as the transform of a
+:class:`scatnet_learn.data.packed.PackedDataset`, or wrap them in
+:class:`BatchCollate` to apply them after a DataLoader stacks the images
+of a per image dataset.
+"""
+import contextlib
+import threading
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+import torchvision.transforms.functional as TF
+
+_local = threading.local()
+
+
+def get_rng():
+    """ Returns the generator the random transforms draw from in this
+    thread: the one set by :func:`thread_rng`, otherwise ``np.random``. """
+    rng = getattr(_local, 'rng', None)
+    return rng if rng is not None else np.random
+
+
+@contextlib.contextmanager
+def thread_rng(rng):
+    """ Makes the random transforms called in this thread draw from rng, a
+    ``np.random.RandomState``, rather than the global generator. The
+    global generator isn't thread safe, so another thread drawing from it
+    at the same time would make the draws depend on the timing. """
+    old = getattr(_local, 'rng', None)
+    _local.rng = rng
+    try:
+        yield
+    finally:
+        _local.rng = old
+
+
+class RandomCrop(object):
+    """ Pads each image with zeros and takes a random size x size crop of it.
+
+    Args:
+        size (int): the height and width of the crops
+        padding (int): the number of zeros to pad each side with
+    """
+    def __init__(self, size, padding=0):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, x):
+        N, C, H, W = x.shape
+        p = self.padding
+        if p > 0:
+            x = F.pad(x, (p, p, p, p))
+        rng = get_rng()
+        oy = rng.randint(0, H + 2*p - self.size + 1, size=N)
+        ox = rng.randint(0, W + 2*p - self.size + 1, size=N)
+        # Gather the crops with one index. rows and cols are N x size
+        rng = torch.arange(self.size)
+        rows = torch.from_numpy(oy)[:, None] + rng
+        cols = torch.from_numpy(ox)[:, None] + rng
+        n = torch.arange(N)[:, None, None, None]
+        c = torch.arange(C)[None, :, None, None]
+        return x[n, c, rows[:, None, :, None], cols[:, None, None, :]]
+
+    def __repr__(self):
+        return '{}(size={}, padding={})'.format(
+            self.__class__.__name__, self.size, self.padding)
+
+
+class CenterCrop(object):
+    """ Takes the central size x size crop of each image. """
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, x):
+        H, W = x.shape[-2:]
+        top = int(round((H - self.size) / 2.))
+        left = int(round((W - self.size) / 2.))
+        return x[..., top:top + self.size, left:left + self.size]
+
+    def __repr__(self):
+        return '{}(size={})'.format(self.__class__.__name__, self.size)
+
+
+class RandomHorizontalFlip(object):
+    """ Mirrors each image left to right with probability p. """
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        flip = torch.from_numpy(get_rng().rand(len(x)) < self.p)
+        if flip.any():
+            x = x.clone()
+            x[flip] = x[flip].flip(-1)
+        return x
+
+    def __repr__(self):
+        return '{}(p={})'.format(self.__class__.__name__, self.p)
+
+
+class ImageRandomCrop(object):
+    """ Pads a PIL image with zeros and takes a random size x size crop of
+    it, as torchvision's RandomCrop does, but drawing from :func:`get_rng`.
+
+    Args:
+        size (int): the height and width of the crop
+        padding (int): the number of zeros to pad each side with
+    """
+    def __init__(self, size, padding=0):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, img):
+        if self.padding > 0:
+            img = TF.pad(img, self.padding)
+        W, H = img.size
+        rng = get_rng()
+        top = rng.randint(0, H - self.size + 1)
+        left = rng.randint(0, W - self.size + 1)
+        return TF.crop(img, top, left, self.size, self.size)
+
+    def __repr__(self):
+        return '{}(size={}, padding={})'.format(
+            self.__class__.__name__, self.size, self.padding)
+
+
+class ImageRandomHorizontalFlip(object):
+    """ Mirrors a PIL image left to right with probability p, as
+    torchvision's RandomHorizontalFlip does, but drawing from
+    :func:`get_rng`. """
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, img):
+        if get_rng().rand() < self.p:
+            return TF.hflip(img)
+        return img
+
+    def __repr__(self):
+        return '{}(p={})'.format(self.__class__.__name__, self.p)
+
+
+class ToFloatNormalize(object):
+    """ Converts uint8 images to floats in [0, 1], as ToTensor does, then
+    normalizes each channel, as Normalize does.
+
+    Args:
+        mean (sequence): the mean of each channel
+        std (sequence): the standard deviation of each channel
+    """
+    def __init__(self, mean, std):
+        # Fold the /255 into the scale, so it is one multiply and add
+        std = torch.tensor(std, dtype=torch.float32)
+        self.scale = (1. / (255. * std)).view(1, -1, 1, 1)
+        self.shift = (-torch.tensor(mean, dtype=torch.float32) / std).view(
+            1, -1, 1, 1)
+        self.mean, self.std = mean, std.tolist()
+
+    def __call__(self, x):
+        return torch.addcmul(self.shift, x.float(), self.scale)
+
+    def __repr__(self):
+        return '{}(mean={}, std={})'.format(
+            self.__class__.__name__, self.mean, self.std)
+
+
+class Resize(object):
+    """ Resizes float images by scale with bilinear interpolation. """
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, x):
+        if self.scale == 1:
+            return x
+        return F.interpolate(x, scale_factor=self.scale, mode='bilinear',
+                             align_corners=False)
+
+    def __repr__(self):
+        return '{}(scale={})'.format(self.__class__.__name__, self.scale)
+
+
+class BatchCollate(object):
+    """ A DataLoader collate_fn that stacks the samples as usual and then
+    applies a batch transform to the images. Runs in the DataLoader workers,
+    if there are any.
+
+    The dataset should return uint8 image tensors, e.g. by having
+    torchvision's PILToTensor as its only transform.
+    """
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        x, y = torch.utils.data.dataloader.default_collate(batch)
+        return self.transform(x), y
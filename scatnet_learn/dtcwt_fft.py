@@ -0,0 +1,135 @@
+""" Level 1 DTCWT done in the frequency domain.
+
+The level 1 stage of the DTCWT is four separable 2D filters (lowpass, and the
+three bandpasses) applied at full resolution. For long filters, like the 13
+and 19 tap rotationally symmetric ones, it is cheaper on large images to pad
+the input, take its rfft2 and multiply by the spectra of the 2D filters than
+to do the separable convolutions. The decimated level 2+ stages are left in
+the spatial domain.
+"""
+from __future__ import absolute_import
+import torch
+import torch.nn.functional as F
+
+from pytorch_wavelets.dtcwt.transform_funcs import highs_to_orientations
+from pytorch_wavelets.dtcwt.transform_funcs import orientations_to_highs
+from scatnet_learn.lowlevel import acc_dtype
+
+
+def symm_index(n, m):
+    """ Returns the indices to symmetrically pad a signal of length n by m
+    samples on each side, i.e. x[-1] = x[0]. Works for m > n too. """
+    i = torch.arange(-m, n+m) % (2*n)
+    return torch.where(i >= n, 2*n - 1 - i, i)
+
+
+def circ_kernel(h, n):
+    """ Places the filter h in a length n circular buffer so that a circular
+    convolution with it matches the conv2d correlation of h with a signal
+    padded by len(h)//2 on each side. """
+    m = h.numel() // 2
+    k = h.new_zeros(n)
+    k[(m - torch.arange(h.numel())) % n] = h
+    return k
+
+
+class FFTj1(object):
+    """ Does the level 1 DTCWT and its adjoint with FFTs.
+
+    Gives the same outputs as fwd_j1 (or fwd_j1_rot if h2o is given) and
+    the same gradients as inv_j1 with the time reversed filters. The filter
+    spectra and padding indices are cached for each input size, dtype and
+    device. Half precision inputs are transformed in float32.
+
+    Inputs:
+        h0o, h1o, h2o (torch.tensor): the level 1 filters, as prepared by
+            prep_filt
+        mode (str): padding mode. Can be 'symmetric' or 'zero'
+    """
+    def __init__(self, h0o, h1o, h2o=None, mode='symmetric'):
+        if mode not in ('symmetric', 'zero'):
+            raise ValueError('The fft backend only supports symmetric and '
+                             'zero padding, got {}'.format(mode))
+        self.mode = mode
+        self.rot = h2o is not None
+        hs = [h0o, h1o] + ([h2o] if self.rot else [])
+        self.filts = [h.detach().reshape(-1).cpu().double() for h in hs]
+        # Pad by enough for the longest filter
+        self.M = max(h.numel() for h in self.filts) // 2
+        self.cache = {}
+
+    def spectra(self, H, W, dtype, device):
+        """ Returns the stacked (ll, lh, hl, hh) spectra for an input of size
+        H, W, along with the padding indices. """
+        key = (H, W, dtype, device)
+        if key not in self.cache:
+            P, Q = H + 2*self.M, W + 2*self.M
+            col = [torch.fft.fft(circ_kernel(h, P)) for h in self.filts]
+            row = [torch.fft.rfft(circ_kernel(h, Q)) for h in self.filts]
+            # The column filter is along dim 2, the row filter along dim 3
+            d = 2 if self.rot else 1
+            bands = ((0, 0), (1, 0), (0, 1), (d, d))
+            S = torch.stack([col[c][:, None] * row[r][None]
+                             for c, r in bands])
+            cdtype = torch.complex128 if dtype == torch.float64 else \
+                torch.complex64
+            S = S.to(device=device, dtype=cdtype)
+            ih = symm_index(H, self.M).to(device)
+            iw = symm_index(W, self.M).to(device)
+            self.cache[key] = (S, ih, iw)
+        return self.cache[key]
+
+    def forward(self, x, skip_hps=False):
+        """ Level 1 forward DTCWT, like fwd_j1 with o_dim=1 """
+        dtype = acc_dtype(x.dtype)
+        N, C, H, W = x.shape
+        M = self.M
+        S, ih, iw = self.spectra(H, W, dtype, x.device)
+        if skip_hps:
+            S = S[:1]
+
+        if self.mode == 'symmetric':
+            xp = x.to(dtype)[:, :, ih][:, :, :, iw]
+        else:
+            xp = F.pad(x.to(dtype), (M, M, M, M))
+        X = torch.fft.rfft2(xp)
+        Y = torch.fft.irfft2(X[:, :, None] * S, s=xp.shape[-2:])
+        Y = Y[..., M:M+H, M:M+W].to(x.dtype)
+        del X
+
+        if skip_hps:
+            return Y[:, :, 0], x.new_zeros([]), x.new_zeros([])
+        highr, highi = highs_to_orientations(Y[:, :, 1], Y[:, :, 2],
+                                             Y[:, :, 3], 1)
+        return Y[:, :, 0], highr, highi
+
+    def adjoint(self, lo, highr, highi):
+        """ Backward pass of :meth:`forward`, like inv_j1 with o_dim=1 and the
+        time reversed filters. """
+        dtype = acc_dtype(lo.dtype)
+        N, C, H, W = lo.shape
+        M = self.M
+        S, ih, iw = self.spectra(H, W, dtype, lo.device)
+
+        if highr is None or highr.shape == torch.Size([]):
+            Y = lo[:, :, None]
+            S = S[:1]
+        else:
+            lh, hl, hh = orientations_to_highs(highr, highi, 1)
+            Y = torch.stack((lo, lh, hl, hh), dim=2)
+        Y = F.pad(Y.to(dtype), (M, M, M, M))
+        D = (torch.fft.rfft2(Y) * S.conj()).sum(dim=2)
+        dxp = torch.fft.irfft2(D, s=Y.shape[-2:])
+        del D, Y
+
+        # Fold the padding back onto the signal
+        if self.mode == 'symmetric':
+            dx = dxp.new_zeros(N, C, H, dxp.shape[-1]).index_add_(2, ih, dxp)
+            dx = dx.new_zeros(N, C, H, W).index_add_(3, iw, dx)
+        else:
+            dx = dxp[..., M:M+H, M:M+W]
+        return dx.to(lo.dtype)
+
+    def __repr__(self):
+        return 'FFTj1(rot={}, mode={}, cached={})'.format(
+            self.rot, self.mode, len(self.cache))
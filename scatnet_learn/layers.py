@@ -5,8 +5,13 @@ from pytorch_wavelets.dtcwt.coeffs import biort as _biort, qshift as _qshift
 from pytorch_wavelets import DTCWTForward
 from pytorch_wavelets.dtcwt.lowlevel import prep_filt
 from scatnet_learn.lowlevel import mode_to_int, MagFn, correct_phases, add_conjugates
-from scatnet_learn.lowlevel import ScatLayerj1_f, ScatLayerj1_rot_f
+from scatnet_learn.lowlevel import compute_dtype, acc_dtype
+from scatnet_learn.lowlevel import scatj1_inference, scatj2_inference
+from scatnet_learn.lowlevel import ScatLayerj1_f, ScatLayerj1_rot_f, ScatLayerj1a_f
 from scatnet_learn.lowlevel import ScatLayerj2_f, ScatLayerj2_rot_f
+from scatnet_learn.lowlevel import ScatLayerJ_f
+from scatnet_learn.dtcwt_fft import FFTj1
+from scatnet_learn.plan import ScatPlan, PlanCache
 from scatnet_learn.filters import filters_rotated
 import torch.nn.init as init
 import numpy as np
@@ -59,6 +64,29 @@ def dct_bases():
             torch.tensor(vertic, dtype=torch.float32))
 
 
+def _make_fft(layer, backend, mode):
+    """ Makes the frequency domain level 1 transform for a layer's h0o, h1o
+    and (if it uses the rotationally symmetric filters) h2o. """
+    if backend != 'fft':
+        return None
+    h2o = layer.h2o if layer.bandpass_diag else None
+    return FFTj1(layer.h0o, layer.h1o, h2o, mode)
+
+
+def _get_plan(layer, x, multiple, centre=True):
+    """ Gets the :class:`ScatPlan` for running a layer on x from its plan
+    cache. The input is padded to a multiple of multiple, and the plan's
+    filters are (h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b), with None for
+    the ones the layer doesn't have. """
+    filts = [getattr(layer, name, None) for name in (
+        'h0o', 'h1o', 'h2o', 'h0a', 'h0b', 'h1a', 'h1b', 'h2a', 'h2b')]
+
+    def build(shape, dtype, device, memory_format):
+        return ScatPlan(shape, dtype, device, memory_format, filts, multiple,
+                        centre)
+    return layer.plans.get(x, compute_dtype(x), build)
+
+
 class InvariantLayerj1(nn.Module):
     """ Also can be called the learnable scatternet layer.
 
@@ -67,6 +95,9 @@ class InvariantLayerj1(nn.Module):
     single 1x1 convolutional layer, but other options include a 3x3
     convolutional mixing and a 1x1 mixing with random offsets.
 
+    Works under torch.autocast, in which case the mixing is done in the
+    autocast dtype too.
+
     Inputs:
         C (int): The number of input channels
         F (int): The number of output channels. None by default, in which case
@@ -86,18 +117,27 @@ class InvariantLayerj1(nn.Module):
                 - 'random'
 
         biort (str): which biorthogonal filters to use.
+        checkpoint (bool): if true, the scattering layer only saves its input
+            for the backward pass and recomputes the phases from it. See
+            :meth:`ScatLayerj1.memory_cost`.
+        compact_phase (bool): if true, the scattering layer saves a half
+            precision phase for the backward pass instead of the two full
+            precision gradient terms. See :class:`ScatLayerj1`.
 
     Returns:
         y (torch.tensor): The output
 
     """
     def __init__(self, C, F=None, stride=2, alpha=None,
-                 biort='near_sym_a', mode='symmetric', magbias=1e-2):
+                 biort='near_sym_a', mode='symmetric', magbias=1e-2,
+                 checkpoint=False, compact_phase=False):
         super().__init__()
         if F is None:
             F = 7*C
 
-        self.scat = ScatLayerj1(biort=biort, mode=mode, magbias=magbias)
+        self.scat = ScatLayerj1(biort=biort, mode=mode, magbias=magbias,
+                                checkpoint=checkpoint,
+                                compact_phase=compact_phase)
 
         # Create the learned mixing weights and possibly the expansion kernel
         self.stride = stride
@@ -158,12 +198,19 @@ class InvariantLayerj1(nn.Module):
 
     def forward(self, x):
         z = self.scat(x)
-        y = func.conv2d(z, self.h, self.b, padding=self.pad)
+        # z may be in a lower precision than the mixing weights
+        h, b = self.h.to(z.dtype), self.b.to(z.dtype)
+        y = func.conv2d(z, h, b, padding=self.pad)
         if self.stride == 1:
             y = func.interpolate(y, scale_factor=2, mode='bilinear',
                                  align_corners=False)
         return y
 
+    def memory_cost(self, shape, dtype=torch.float32):
+        """ Memory/compute trade-off of the scattering layer for an input of
+        the given shape. See :meth:`ScatLayerj1.memory_cost`. """
+        return self.scat.memory_cost(shape, dtype)
+
     def extra_repr(self):
         return '{}, {}, stride={}, alpha={}'.format(
                self.C, self.F, self.stride, self.alpha_t)
@@ -206,9 +253,9 @@ class InvariantLayerj1_dct(nn.Module):
         A1 = self.A1 * self.lp
         A2 = self.A2 * self.h
         A3 = self.A3 * self.v
+        # The scattering output is already (N, 7*C, H/2, W/2), in the memory
+        # format of x
         z = self.scat(x)
-        s = z.shape
-        z = z.view(s[0], s[1]*s[2], s[3], s[4])
         y = (func.conv2d(z, A1, padding=1) +
              func.conv2d(z, A2, padding=1) +
              func.conv2d(z, A3, padding=1) + self.b)
@@ -271,6 +318,10 @@ class ScatLayerj1(nn.Module):
     """ Does one order of scattering at a single scale. Can be made into a
     second order scatternet by stacking two of these layers.
 
+    Under torch.autocast, or for a half precision input, the DTCWT is done in
+    the lower precision but the magnitudes and their gradients are
+    calculated in float32.
+
     Inputs:
         biort (str): the biorthogonal filters to use. if 'near_sym_b_bp' will
             use the rotationally symmetric filters. These have 13 and 19 taps
@@ -280,6 +331,19 @@ class ScatLayerj1(nn.Module):
         magbias (float): the magnitude bias to use for smoothing
         combine_colour (bool): if true, will only have colour lowpass and have
             greyscale bandpass
+        checkpoint (bool): if true, only the input is saved for the backward
+            pass and the phases are recomputed from it. Trades an extra level
+            1 DTCWT in the backward pass for a third of the saved activation
+            memory. See :meth:`memory_cost`.
+        compact_phase (bool): if true, a half precision phase is saved for the
+            backward pass instead of the two full precision gradient terms,
+            and the magnitudes are taken from the layer output. This means
+            the output must not be modified inplace. Can't be used with
+            combine_colour or checkpoint.
+        backend (str): 'spatial' or 'fft'. With 'fft' the DTCWT is done by
+            multiplying the padded input's spectrum with cached filter
+            spectra. This is faster for large inputs and the long
+            near_sym_b_bp filters. Only works with symmetric and zero padding.
 
     Returns:
         y (torch.tensor): y has the lowpass and invariant U terms stacked along
@@ -288,8 +352,15 @@ class ScatLayerj1(nn.Module):
             the magnitude highpass outputs.
     """
     def __init__(self, biort='near_sym_a', mode='symmetric', magbias=1e-2,
-                 combine_colour=False):
+                 combine_colour=False, checkpoint=False, compact_phase=False,
+                 backend='spatial'):
         super().__init__()
+        if backend not in ('spatial', 'fft'):
+            raise ValueError("backend must be 'spatial' or 'fft', got "
+                             "{}".format(backend))
+        if compact_phase and (combine_colour or checkpoint):
+            raise ValueError('compact_phase cannot be used with '
+                             'combine_colour or checkpoint')
         self.biort = biort
         # Have to convert the string to an int as the grad checks don't work
         # with string inputs
@@ -297,6 +368,10 @@ class ScatLayerj1(nn.Module):
         self.mode = mode_to_int(mode)
         self.magbias = magbias
         self.combine_colour = combine_colour
+        self.checkpoint = checkpoint
+        self.compact_phase = compact_phase
+        self.backend = backend
+        self.plans = PlanCache()
         if biort == 'near_sym_b_bp':
             self.bandpass_diag = True
             h0o, _, h1o, _, h2o, _ = _biort(biort)
@@ -308,36 +383,121 @@ class ScatLayerj1(nn.Module):
             h0o, _, h1o, _ = _biort(biort)
             self.h0o = torch.nn.Parameter(prep_filt(h0o, 1), False)
             self.h1o = torch.nn.Parameter(prep_filt(h1o, 1), False)
+        self.fft = _make_fft(self, backend, mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        # The cached plans hold the filters and workspaces on the old
+        # device/dtype
+        self.plans.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def forward(self, x, out=None):
+        """ Does the scattering.
+
+        If no gradients are needed, e.g. under torch.inference_mode, the
+        output is written straight into out (or a new tensor) without saving
+        anything for a backward pass. out should have the shape of the
+        output. It can only be given when no gradients are needed.
+        """
+        # Under autocast, do the transform in the autocast dtype. The
+        # magnitudes are still calculated in float32. The plan for this input
+        # shape has the filters in that dtype.
+        plan = _get_plan(self, x, 2, centre=False)
+        dtype = plan.dtype
+        x = x.to(dtype)
+        h0o, h1o, h2o = plan.filts[:3]
+        if self.combine_colour:
+            assert x.shape[1] == 3
 
-    def forward(self, x):
         # Do the single scale DTCWT
         # If the row/col count of X is not divisible by 2 then we need to
-        # extend X
-        _, ch, r, c = x.shape
-        if r % 2 != 0:
-            x = torch.cat((x, x[:,:,-1:]), dim=2)
-        if c % 2 != 0:
-            x = torch.cat((x, x[:,:,:,-1:]), dim=3)
-
-        if self.combine_colour:
-            assert ch == 3
+        # extend X. The padded input is only kept when it is needed for the
+        # backward pass.
+        grad = torch.is_grad_enabled() and x.requires_grad
+        inference = not grad and acc_dtype(dtype) == dtype
+        x = plan.pad(x, reuse=inference)
+
+        if grad and out is not None:
+            raise ValueError('out can only be given when no gradients are '
+                             'needed')
+        elif inference:
+            return scatj1_inference(
+                x, h0o, h1o, h2o, self.mode, self.magbias,
+                self.combine_colour, out, self.fft)
 
         if self.bandpass_diag:
             Z = ScatLayerj1_rot_f.apply(
-                x, self.h0o, self.h1o, self.h2o, self.mode, self.magbias,
-                self.combine_colour)
+                x, h0o, h1o, h2o, self.mode, self.magbias,
+                self.combine_colour, self.checkpoint, self.compact_phase,
+                self.fft)
         else:
             Z = ScatLayerj1_f.apply(
-                x, self.h0o, self.h1o, self.mode, self.magbias,
-                self.combine_colour)
+                x, h0o, h1o, self.mode, self.magbias,
+                self.combine_colour, self.checkpoint, self.compact_phase,
+                self.fft)
         if not self.combine_colour:
             b, _, c, h, w = Z.shape
             Z = Z.view(b, 7*c, h, w)
+        if out is not None:
+            Z = out.copy_(Z)
         return Z
 
+    def memory_cost(self, shape, dtype=torch.float32):
+        """ Reports the peak-memory vs extra-compute trade-off of the
+        checkpoint and compact_phase options for an input of the given shape.
+
+        Inputs:
+            shape (tuple): input shape (N, C, H, W)
+            dtype (torch.dtype): the input datatype
+
+        Returns:
+            cost (dict): with keys
+
+                - 'saved_bytes': bytes kept for the backward pass in the
+                  current mode
+                - 'saved_bytes_full': bytes kept for the backward pass
+                  without checkpointing
+                - 'saved_bytes_checkpoint': bytes kept for the backward pass
+                  with checkpointing
+                - 'saved_bytes_compact': bytes kept for the backward pass
+                  with compact_phase, not counting the layer output which is
+                  kept anyway by the next layer
+                - 'recompute_transforms': number of extra level 1 DTCWTs run
+                  in the backward pass in the current mode
+        """
+        N, C, H, W = shape
+        H += H % 2
+        W += W % 2
+        nbytes = torch.tensor([], dtype=dtype).element_size()
+        # drdx and drdy each have 6 orientations at half the spatial size
+        full = 2 * 6 * N * C * (H//2) * (W//2) * nbytes
+        chkpt = N * C * H * W * nbytes
+        # one half precision phase with 6 orientations at half the size
+        compact = 6 * N * C * (H//2) * (W//2) * 2
+        if self.checkpoint:
+            saved = chkpt
+        elif self.compact_phase:
+            saved = compact
+        else:
+            saved = full
+        return {
+            'saved_bytes': saved,
+            'saved_bytes_full': full,
+            'saved_bytes_checkpoint': chkpt,
+            'saved_bytes_compact': compact,
+            'recompute_transforms': 1 if self.checkpoint else 0,
+        }
+
     def extra_repr(self):
-        return "biort='{}', mode='{}', magbias={}".format(
-               self.biort, self.mode_str, self.magbias)
+        s = "biort='{}', mode='{}', magbias={}".format(
+            self.biort, self.mode_str, self.magbias)
+        if self.checkpoint:
+            s += ", checkpoint=True"
+        if self.compact_phase:
+            s += ", compact_phase=True"
+        if self.fft is not None:
+            s += ", backend='fft'"
+        return s
 
 
 class ScatLayerj1a(nn.Module):
@@ -383,7 +543,7 @@ class ScatLayerj1a(nn.Module):
         if c % 2 != 0:
             x = torch.cat((x, x[:,:,:,-1:]), dim=3)
 
-        ll, r = ScatLayerj1_f.apply(
+        ll, r = ScatLayerj1a_f.apply(
             x, self.h0o, self.h1o, self.mode, self.magbias)
         ll = self.lp_pool(ll)
         Z = torch.cat((ll[:, None], r), dim=1)
@@ -400,12 +560,27 @@ class ScatLayerj2(nn.Module):
     """ Does one order of scattering at a single scale. Can be made into a
     second order scatternet by stacking two of these layers.
 
+    Under torch.autocast, or for a half precision input, the DTCWT is done in
+    the lower precision but the magnitudes and their gradients are
+    calculated in float32.
+
+    For J > 2 this only average pools the J=2 output, use
+    :class:`ScatLayerJ` to compute the coarser scales.
+
     Inputs:
         biort (str): the biorthogonal filters to use. if 'near_sym_b_bp' will
             use the rotationally symmetric filters. These have 13 and 19 taps
             so are quite long. They also require 7 1D convolutions instead of 6.
         x (torch.tensor): Input of shape (N, C, H, W)
         mode (str): padding mode. Can be 'symmetric' or 'zero'
+        compact_phase (bool): if true, half precision phases are saved for
+            the backward pass instead of the six full precision gradient
+            terms, and the magnitudes are taken from the layer output. This
+            means the output must not be modified inplace. Can't be used with
+            combine_colour.
+        backend (str): 'spatial' or 'fft'. With 'fft' the level 1 DTCWTs are
+            done in the frequency domain, see :class:`ScatLayerj1`. The
+            decimated level 2 transform is always done spatially.
 
     Returns:
         y (torch.tensor): y has the lowpass and invariant U terms stacked along
@@ -414,8 +589,15 @@ class ScatLayerj2(nn.Module):
             the magnitude highpass outputs.
     """
     def __init__(self, biort='near_sym_a', qshift='qshift_a', mode='symmetric',
-                 magbias=1e-2, combine_colour=False, J=2):
+                 magbias=1e-2, combine_colour=False, J=2, compact_phase=False,
+                 backend='spatial'):
         super().__init__()
+        if backend not in ('spatial', 'fft'):
+            raise ValueError("backend must be 'spatial' or 'fft', got "
+                             "{}".format(backend))
+        if compact_phase and combine_colour:
+            raise ValueError('compact_phase cannot be used with '
+                             'combine_colour')
         self.biort = biort
         self.qshift = biort
         # Have to convert the string to an int as the grad checks don't work
@@ -424,6 +606,9 @@ class ScatLayerj2(nn.Module):
         self.mode = mode_to_int(mode)
         self.magbias = magbias
         self.combine_colour = combine_colour
+        self.compact_phase = compact_phase
+        self.backend = backend
+        self.plans = PlanCache()
         self.J = J
         if biort == 'near_sym_b_bp':
             assert qshift == 'qshift_b_bp'
@@ -449,47 +634,164 @@ class ScatLayerj2(nn.Module):
             self.h0b = torch.nn.Parameter(prep_filt(h0b, 1), False)
             self.h1a = torch.nn.Parameter(prep_filt(h1a, 1), False)
             self.h1b = torch.nn.Parameter(prep_filt(h1b, 1), False)
-
-    def forward(self, x):
-        # Ensure the input size is divisible by 8
-        ch, r, c = x.shape[1:]
-        rem = r % 8
-        if rem != 0:
-            rows_after = (9-rem)//2
-            rows_before = (8-rem) // 2
-            x = torch.cat((x[:,:,:rows_before], x,
-                           x[:,:,-rows_after:]), dim=2)
-        rem = c % 8
-        if rem != 0:
-            cols_after = (9-rem)//2
-            cols_before = (8-rem) // 2
-            x = torch.cat((x[:,:,:,:cols_before], x,
-                           x[:,:,:,-cols_after:]), dim=3)
-
+        self.fft = _make_fft(self, backend, mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        # The cached plans hold the filters and workspaces on the old
+        # device/dtype
+        self.plans.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def forward(self, x, out=None):
+        """ Does the scattering. See :meth:`ScatLayerj1.forward` for out. """
+        # Under autocast, do the transform in the autocast dtype. The
+        # magnitudes are still calculated in float32.
+        plan = _get_plan(self, x, 8)
+        dtype = plan.dtype
+        x = x.to(dtype)
+        h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b = plan.filts
         if self.combine_colour:
-            assert ch == 3
+            assert x.shape[1] == 3
 
-        if self.bandpass_diag:
-            pass
+        # Ensure the input size is divisible by 8
+        grad = torch.is_grad_enabled() and x.requires_grad
+        inference = not grad and acc_dtype(dtype) == dtype
+        x = plan.pad(x, reuse=inference)
+
+        if grad and out is not None:
+            raise ValueError('out can only be given when no gradients are '
+                             'needed')
+        elif inference:
+            if self.J == 2:
+                return scatj2_inference(
+                    x, h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, self.mode,
+                    self.magbias, self.combine_colour, out, self.fft)
+            Z = scatj2_inference(
+                x, h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, self.mode,
+                self.magbias, self.combine_colour, fft=self.fft)
+        elif self.bandpass_diag:
             Z = ScatLayerj2_rot_f.apply(
-                x, self.h0o, self.h1o, self.h2o, self.h0a, self.h0b, self.h1a,
-                self.h1b, self.h2a, self.h2b, self.mode, self.magbias,
-                self.combine_colour)
+                x, h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, self.mode,
+                self.magbias, self.combine_colour, self.compact_phase,
+                self.fft)
         else:
             Z = ScatLayerj2_f.apply(
-                x, self.h0o, self.h1o, self.h0a, self.h0b, self.h1a,
-                self.h1b, self.mode, self.magbias, self.combine_colour)
+                x, h0o, h1o, h0a, h0b, h1a, h1b, self.mode, self.magbias,
+                self.combine_colour, self.compact_phase, self.fft)
 
-        if not self.combine_colour:
+        if Z.dim() == 5:
             b, _, c, h, w = Z.shape
             Z = Z.view(b, 49*c, h, w)
         if self.J > 2:
             Z = func.avg_pool2d(Z, 2**(self.J-2))
+        if out is not None:
+            Z = out.copy_(Z)
         return Z
 
     def extra_repr(self):
-        return "biort='{}', mode='{}', magbias={}".format(
-               self.biort, self.mode_str, self.magbias)
+        s = "biort='{}', mode='{}', magbias={}".format(
+            self.biort, self.mode_str, self.magbias)
+        if self.fft is not None:
+            s += ", backend='fft'"
+        return s
+
+
+class ScatLayerJ(nn.Module):
+    """ Does scattering to J scales and up to second order in one layer.
+
+    Unlike :class:`ScatLayerj2`, the coarse scales are properly computed by
+    walking the DTCWT tree J levels deep, so this is the layer to use for
+    large inputs. Only the second order paths with j2 > j1 are computed.
+
+    Under torch.autocast, or for a half precision input, the DTCWT is done in
+    the lower precision but the magnitudes and their gradients are
+    calculated in float32.
+
+    Inputs:
+        biort (str): the biorthogonal filters to use. if 'near_sym_b_bp' will
+            use the rotationally symmetric filters, and qshift must be
+            'qshift_b_bp'.
+        qshift (str): the quarter shift filters to use for scales 2 and up.
+        x (torch.tensor): Input of shape (N, C, H, W)
+        mode (str): padding mode. Can be 'symmetric' or 'zero'
+        magbias (float): the magnitude bias to use for smoothing
+        J (int): number of scales
+        order (int): scattering order. Can be 1 or 2
+
+    Returns:
+        y (torch.tensor): y has the lowpass, first and second order
+            coefficients stacked along the channel dimension, and so has shape
+            (N, K*C, H/2**J, W/2**J) where K = 1 + 6J + 36J(J-1)/2 for order
+            2 and 1 + 6J for order 1. See :class:`ScatLayerJ_f` for the
+            ordering of the channels.
+    """
+    def __init__(self, biort='near_sym_a', qshift='qshift_a', mode='symmetric',
+                 magbias=1e-2, J=3, order=2):
+        super().__init__()
+        if order not in (1, 2):
+            raise ValueError('order must be 1 or 2, got {}'.format(order))
+        if J < 1:
+            raise ValueError('J must be at least 1, got {}'.format(J))
+        self.biort = biort
+        self.qshift = qshift
+        # Have to convert the string to an int as the grad checks don't work
+        # with string inputs
+        self.mode_str = mode
+        self.mode = mode_to_int(mode)
+        self.magbias = magbias
+        self.J = J
+        self.order = order
+        self.plans = PlanCache()
+        if biort == 'near_sym_b_bp':
+            assert qshift == 'qshift_b_bp'
+            self.bandpass_diag = True
+            h0o, _, h1o, _, h2o, _ = _biort(biort)
+            self.h0o = torch.nn.Parameter(prep_filt(h0o, 1), False)
+            self.h1o = torch.nn.Parameter(prep_filt(h1o, 1), False)
+            self.h2o = torch.nn.Parameter(prep_filt(h2o, 1), False)
+            h0a, h0b, _, _, h1a, h1b, _, _, h2a, h2b, _, _ = _qshift('qshift_b_bp')
+            self.h0a = torch.nn.Parameter(prep_filt(h0a, 1), False)
+            self.h0b = torch.nn.Parameter(prep_filt(h0b, 1), False)
+            self.h1a = torch.nn.Parameter(prep_filt(h1a, 1), False)
+            self.h1b = torch.nn.Parameter(prep_filt(h1b, 1), False)
+            self.h2a = torch.nn.Parameter(prep_filt(h2a, 1), False)
+            self.h2b = torch.nn.Parameter(prep_filt(h2b, 1), False)
+        else:
+            self.bandpass_diag = False
+            h0o, _, h1o, _ = _biort(biort)
+            self.h0o = torch.nn.Parameter(prep_filt(h0o, 1), False)
+            self.h1o = torch.nn.Parameter(prep_filt(h1o, 1), False)
+            h0a, h0b, _, _, h1a, h1b, _, _ = _qshift(qshift)
+            self.h0a = torch.nn.Parameter(prep_filt(h0a, 1), False)
+            self.h0b = torch.nn.Parameter(prep_filt(h0b, 1), False)
+            self.h1a = torch.nn.Parameter(prep_filt(h1a, 1), False)
+            self.h1b = torch.nn.Parameter(prep_filt(h1b, 1), False)
+            self.h2o = self.h2a = self.h2b = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # The cached plans hold the filters and workspaces on the old
+        # device/dtype
+        self.plans.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def forward(self, x):
+        # Under autocast, do the transform in the autocast dtype. The
+        # magnitudes are still calculated in float32.
+        plan = _get_plan(self, x, 2**self.J)
+        x = x.to(plan.dtype)
+
+        # Ensure the input size is divisible by 2**J
+        x = plan.pad(x)
+
+        Z = ScatLayerJ_f.apply(x, *plan.filts, self.J, self.order, self.mode,
+                               self.magbias)
+        b, k, c, h, w = Z.shape
+        return Z.view(b, k*c, h, w)
+
+    def extra_repr(self):
+        return "biort='{}', qshift='{}', mode='{}', magbias={}, J={}, " \
+               "order={}".format(self.biort, self.qshift, self.mode_str,
+                                 self.magbias, self.J, self.order)
 
 
 class LogScale(nn.Module):
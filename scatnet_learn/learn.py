@@ -7,13 +7,19 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import queue
 import sys
+import threading
 import torch
 import torch.utils.data
 import torch.autograd as autograd
+import torch.distributed as dist
 import numpy as np
 import time
 
+from scatnet_learn.data import transforms as data_transforms
+
 
 def num_correct(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
@@ -27,7 +33,7 @@ def num_correct(output, target, topk=(1,)):
 
         res = []
         for k in topk:
-            correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
+            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
             res.append(correct_k)
         return res, batch_size
 
@@ -55,6 +61,189 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class MetricAccumulator(object):
+    """ Keeps running sums of the loss, top-1 and top-5 correct on the
+    device, so updating it doesn't make the host wait for the device. Only
+    reading the metrics syncs.
+
+    The loss passed to :meth:`update` should be the batch mean, it is
+    weighted by the batch size.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = None
+        self.count = 0
+        self.steps = 0
+        self.start = time.time()
+
+    def update(self, loss, output, target):
+        with torch.no_grad():
+            corrects, bs = num_correct(output, target, topk=(1, 5))
+            sums = torch.cat((loss.detach().float().reshape(1) * bs,
+                              corrects[0], corrects[1]))
+            if self.sums is None:
+                self.sums = sums
+            else:
+                self.sums += sums
+        self.count += bs
+        self.steps += 1
+
+    def all_reduce(self):
+        """ Sums the metrics over the processes of the default
+        torch.distributed process group. Must be called by all of them. """
+        sums = self.sums
+        if sums is None:
+            sums = torch.zeros(3)
+        sums = torch.cat((sums.float(), sums.new_tensor([self.count],
+                                                        dtype=torch.float)))
+        dist.all_reduce(sums)
+        self.sums, self.count = sums[:3], int(sums[3])
+
+    def read(self):
+        """ Returns the mean loss, and top-1 and top-5 accuracy in %, since the
+        last reset. """
+        if self.sums is None:
+            return 0., 0., 0.
+        loss, top1, top5 = self.sums.tolist()
+        return (loss / self.count, 100. * top1 / self.count,
+                100. * top5 / self.count)
+
+    @property
+    def steps_per_sec(self):
+        return self.steps / max(time.time() - self.start, 1e-6)
+
+
+class Prefetcher(object):
+    """ Wraps a data loader, loading and preparing the next batches in a
+    background thread while the current one is trained on.
+
+    Each (inputs, targets) batch is optionally pinned, has its inputs cast to
+    dtype and is moved to device before being put in a queue of at most
+    depth batches. When the device is a gpu the copies are done on a side
+    stream, so they overlap with the compute.
+
+    The thread releases the GIL while the loader's workers, or the numpy and
+    torch ops of a loader with num_workers=0, are busy, so even a loader
+    without workers overlaps with training. Such a loader runs its random
+    transforms in the thread, so they would draw from the global generators
+    at the same time as the training loop (e.g. for dropout) and a seed
+    would no longer reproduce a run. So the thread has its own
+    ``np.random.RandomState``, seeded from ``np.random`` at the start of
+    each epoch, that the transforms in :mod:`scatnet_learn.data.transforms`
+    draw from (see :func:`~scatnet_learn.data.transforms.thread_rng`). Other
+    random transforms should be run in the loader's workers. The first
+    batch is loaded in the calling thread, so a sampler's seed is drawn
+    there too.
+
+    Args:
+        loader: the data loader to wrap
+        depth (int): the number of batches to load ahead
+        device: where to move the batches to. None leaves them where they
+            are.
+        pin_memory (bool): whether to pin the batches before moving them to
+            the gpu, so the copies can be asynchronous
+        dtype: what to cast the inputs to, e.g. torch.float for uint8
+            batches. None leaves them as they are.
+    """
+    def __init__(self, loader, depth=2, device=None, pin_memory=True,
+                 dtype=None):
+        self.loader = loader
+        self.depth = depth
+        self.device = torch.device(device) if device is not None else None
+        self.pin_memory = pin_memory
+        self.dtype = dtype
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, batch, stream):
+        inputs, targets = batch
+        if self.dtype is not None:
+            inputs = inputs.to(self.dtype)
+        if self.device is None:
+            return inputs, targets, None
+        if stream is None:
+            return inputs.to(self.device), targets.to(self.device), None
+        if self.pin_memory:
+            inputs, targets = inputs.pin_memory(), targets.pin_memory()
+        with torch.cuda.stream(stream):
+            inputs = inputs.to(self.device, non_blocking=True)
+            targets = targets.to(self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(stream)
+        return inputs, targets, ready
+
+    @staticmethod
+    def _put(q, item, stop):
+        """ Puts item in the queue, unless the consumer stops first """
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _load(self, q, stop, batches, rng):
+        stream = None
+        if self.device is not None and self.device.type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+        try:
+            with data_transforms.thread_rng(rng):
+                for batch in batches:
+                    if not self._put(q, self._prepare(batch, stream), stop):
+                        return
+            self._put(q, StopIteration, stop)
+        except Exception as e:
+            self._put(q, e, stop)
+
+    def __iter__(self):
+        # Seed the loading thread's generator, and start the loader's
+        # iterator, in this thread. Getting the first batch here also draws
+        # the shuffling seed of a RandomSampler, which is drawn lazily
+        rng = np.random.RandomState(np.random.randint(2**31))
+        batches = iter(self.loader)
+        with data_transforms.thread_rng(rng):
+            first = next(batches, None)
+        if first is None:
+            return
+        stream = None
+        if self.device is not None and self.device.type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+        first = self._prepare(first, stream)
+
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._load,
+                                  args=(q, stop, batches, rng), daemon=True)
+        thread.start()
+        try:
+            item = first
+            while item is not StopIteration:
+                if isinstance(item, Exception):
+                    raise item
+                inputs, targets, ready = item
+                if ready is not None:
+                    # Wait for the copy, and stop the caching allocator
+                    # reusing the memory before the compute stream is done
+                    # with it
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(ready)
+                    inputs.record_stream(current)
+                    targets.record_stream(current)
+                yield inputs, targets
+                item = q.get()
+        finally:
+            stop.set()
+            thread.join()
+
+
 def calculate_plot_steps(num_iter, pts):
     startpoint = 1/pts * (num_iter-1)
     update_steps = np.linspace(startpoint, num_iter-1, pts, endpoint=True)
@@ -71,8 +260,200 @@ def get_lr(optim):
         return lrs
 
 
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(amp, device_type):
+    """ Returns the autocast context for the amp mode.
+
+    Args:
+        amp (str): one of 'off', 'bf16' or 'fp16'
+        device_type (str): 'cuda' or 'cpu'
+    """
+    if amp != 'off' and amp not in AMP_DTYPES:
+        raise ValueError("amp must be one of 'off', 'bf16' or 'fp16', got "
+                         "{}".format(amp))
+    return torch.autocast(device_type, dtype=AMP_DTYPES.get(amp),
+                          enabled=(amp != 'off'))
+
+
+def make_scaler(amp, use_cuda=True):
+    """ Returns a GradScaler for fp16 training, or None for the other amp
+    modes. bf16 has the range of fp32 so doesn't need the loss scaled. """
+    if amp != 'fp16':
+        return None
+    try:
+        return torch.amp.GradScaler('cuda' if use_cuda else 'cpu')
+    except (AttributeError, TypeError):
+        # Older pytorch only has the cuda scaler
+        return torch.cuda.amp.GradScaler(enabled=use_cuda)
+
+
+def _add_reg(net, loss):
+    """ Adds the network's regularization term to the loss, if it has one """
+    try:
+        loss = loss + net.get_reg()
+    except AttributeError:
+        try:
+            loss = loss + net.module.get_reg()
+        except AttributeError:
+            pass
+    return loss
+
+
+def _get_loss(net, loss_fn, inputs, targets, amp='off'):
+    """ Runs the network and applies the loss function under autocast, then
+    adds the network's regularization term. The regularizer is added outside
+    of autocast so it is computed, and scaled with the loss, in fp32.
+
+    Returns:
+        outputs, loss
+    """
+    with autocast(amp, inputs.device.type):
+        outputs = net(inputs)
+        loss = loss_fn(outputs, targets)
+    return outputs, _add_reg(net, loss.float())
+
+
+def _to_cpu(obj):
+    """ Copies every tensor in a nest of dicts, lists and tuples to the cpu.
+    The containers are copied too, so the result shares nothing with obj. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+class NaNWatchdog(object):
+    """ Cheap check that training hasn't diverged.
+
+    The finiteness of the loss is recorded on the device every step, and the
+    gradients are checked every check_freq steps, so the host only has to
+    wait for the device once every check_freq steps. With gradient
+    accumulation the check waits for the end of the optimizer step.
+
+    As the optimizer keeps stepping between checks, a bad batch may already
+    have corrupted the weights by the time it is found. So after each check
+    that passes, a cpu copy of the net, optimizer and scaler state is kept
+    (at the start of the next optimizer step), along with the batches since
+    (copied to the cpu if they were on the device). :meth:`replay` restores
+    that state and reruns the batches up to the bad one with anomaly
+    detection on, so the fault is found in the step that made it.
+
+    Args:
+        check_freq (int): number of steps between checks
+    """
+    def __init__(self, check_freq=50):
+        self.check_freq = check_freq
+        self.flags = []
+        self.state = None
+        self.batches = []
+
+    def start_step(self, net, optimizer, scaler=None):
+        """ Called before the first batch of each optimizer step. Keeps a
+        copy of the state if a check has passed since the last copy. """
+        if self.state is None:
+            net = getattr(net, 'module', net)
+            self.state = (
+                _to_cpu(net.state_dict()), _to_cpu(optimizer.state_dict()),
+                _to_cpu(scaler.state_dict()) if scaler is not None else None)
+            self.batches = []
+
+    def step(self, batch_idx, loss, net, batch, first=True, last=True,
+             accum=1, force=False, grads=True):
+        """ Records a step, and checks the steps since the last check if
+        there have been at least check_freq of them or force is true (e.g.
+        at the end of an epoch), and the batch is the last of its optimizer
+        step. The gradients aren't checked if grads is false, e.g.
+        when a GradScaler is used as it skips the steps with inf gradients
+        itself. first, last and accum describe the batch's place in the
+        optimizer step, as in :func:`train`, so it can be replayed.
+
+        Returns:
+            bad: None if the check passed or wasn't done this step, otherwise
+                (batch_idx, reason) for the first bad batch
+        """
+        self.flags.append((batch_idx,
+                           torch.isfinite(loss.detach()).logical_not()))
+        # Batches on the device are copied back without waiting for it, as
+        # they are only read after the sync in check. Cpu batches are kept
+        # as they came from the loader
+        batch = tuple(t if t.device.type == 'cpu' else
+                      t.detach().to('cpu', non_blocking=True) for t in batch)
+        self.batches.append((batch_idx, batch, first, last, accum))
+        # Only check at the end of an optimizer step, so the state copied
+        # after a passing check is never part way through a step
+        if last and (force or len(self.flags) >= self.check_freq):
+            return self.check(net, grads)
+
+    def check(self, net, grads=True):
+        """ Checks the recorded losses and the current gradients. """
+        if len(self.flags) == 0:
+            return None
+        idx = [i for i, _ in self.flags]
+        bad = torch.stack([f for _, f in self.flags])
+        grads = [p.grad for p in net.parameters()
+                 if grads and p.grad is not None]
+        if len(grads) > 0:
+            grads_bad = torch.stack(
+                [torch.isfinite(g).all().logical_not() for g in grads]).any()
+        else:
+            grads_bad = bad.new_zeros([])
+        # The only sync with the device
+        bad = torch.cat((bad, grads_bad[None])).cpu()
+        bad, grads_bad = bad[:-1], bool(bad[-1])
+        self.flags = []
+
+        if bad.any():
+            return idx[int(bad.nonzero()[0])], 'non-finite loss'
+        elif grads_bad:
+            return idx[-1], 'non-finite gradients'
+        # Copy the state again at the start of the next step
+        self.state = None
+
+    def replay(self, net, loss_fn, optimizer, bad_idx, scaler=None,
+               use_cuda=True, amp='off'):
+        """ Restores the last good state and reruns the kept batches up to
+        and including bad_idx with anomaly detection on, to find the op that
+        created the first nan/inf. Raises the anomaly's RuntimeError if it
+        is found. The weights are left as they were before bad_idx. """
+        # The other processes won't join in the replay, so don't run it
+        # through DistributedDataParallel or DataParallel
+        net = getattr(net, 'module', net)
+        net_state, optim_state, scaler_state = self.state
+        net.load_state_dict(net_state)
+        optimizer.load_state_dict(optim_state)
+        if scaler is not None and scaler_state is not None:
+            scaler.load_state_dict(scaler_state)
+        with autograd.detect_anomaly():
+            for batch_idx, (inputs, targets), first, last, accum in \
+                    self.batches:
+                if batch_idx > bad_idx:
+                    break
+                if use_cuda:
+                    inputs, targets = inputs.cuda(), targets.cuda()
+                if first:
+                    optimizer.zero_grad()
+                _, loss = _get_loss(net, loss_fn, inputs, targets, amp)
+                if scaler is not None:
+                    scaler.scale(loss / accum).backward()
+                else:
+                    (loss / accum).backward()
+                if last and batch_idx < bad_idx:
+                    if scaler is not None:
+                        scaler.step(optimizer)
+                        scaler.update()
+                    else:
+                        optimizer.step()
+        optimizer.zero_grad()
+
+
 def train(loader, net, loss_fn, optimizer, epoch=0, epochs=0,
-          use_cuda=True, writer=None, summary_freq=4):
+          use_cuda=True, writer=None, summary_freq=4, debug=False,
+          check_freq=50, amp='off', scaler=None, iter_size=1, prefetch=0):
     """ Train a model with the given loss functions
 
     Args:
@@ -86,76 +467,156 @@ def train(loader, net, loss_fn, optimizer, epoch=0, epochs=0,
         epochs (int): max epochs
         use_cuda (bool): true if want to use gpu
         writer: tensorboard writer
-        summary_freq: number of times to update the
+        summary_freq: number of times to update the training info per epoch.
+            The host only waits for the device to read the metrics at these
+            points.
+        debug (bool): if true, runs the whole epoch with
+            autograd.detect_anomaly. This is several times slower.
+        check_freq (int): how often (in steps) the :class:`NaNWatchdog`
+            checks the loss and gradients are finite. If it finds a bad
+            batch, the batches from the last good check up to it are
+            replayed from that check's state under anomaly detection to
+            locate the fault, and a FloatingPointError is raised if the
+            replay doesn't. 0 turns the check off.
+        amp (str): 'off', 'bf16' or 'fp16'. Runs the forward pass and loss
+            function under torch.autocast with that dtype.
+        scaler: a GradScaler (see :func:`make_scaler`) to scale the loss
+            by, needed for fp16. None to not scale the loss.
+        iter_size (int): number of batches to accumulate the gradients over
+            before each optimizer step. The loss of each batch is divided by
+            the number of batches in its step, so the gradients are those of
+            the mean loss over the larger, effective batch. If the number of
+            batches isn't a multiple of iter_size, the last step of the epoch
+            uses the remaining batches.
+        prefetch (int): if more than 0, loads and moves this many batches to
+            the device ahead of time in a background thread, see
+            :class:`Prefetcher`. The time spent waiting for
+            data is reported for each epoch either way.
+
+    Returns:
+        loss, acc1, acc5: the epoch's mean loss and top-1 and top-5 accuracy
     """
     net.train()
-    train_loss = 0
-    top1_correct = 0
-    top5_correct = 0
-    total = 0
-
-    losses = AverageMeter()
+    # The metrics since the last summary, and for the whole epoch
+    metrics = MetricAccumulator()
+    epoch_metrics = MetricAccumulator()
     num_iter = len(loader)
     update_steps = np.linspace(int(1/summary_freq * num_iter),
                                num_iter-1,
                                summary_freq).astype('int')
     start = time.time()
+    watchdog = NaNWatchdog(check_freq) if check_freq > 0 and not debug \
+        else None
+
+    # A DistributedSampler shuffles by the epoch, so has to be told it
+    if hasattr(loader, 'sampler') and hasattr(loader.sampler, 'set_epoch'):
+        loader.sampler.set_epoch(epoch)
+    if prefetch > 0 and not isinstance(loader, Prefetcher):
+        loader = Prefetcher(loader, prefetch,
+                            device='cuda' if use_cuda else None,
+                            pin_memory=use_cuda)
+    # The time the loop waits for the loader. The rest of the epoch is
+    # compute (and reporting)
+    data_time = 0
+    fetch_start = time.time()
 
     print('\n=> Training Epoch #%d, LR=%.4f' % (epoch, get_lr(optimizer)))
-    with autograd.detect_anomaly():
+    with autograd.set_detect_anomaly(debug):
         for batch_idx, (inputs, targets) in enumerate(loader):
+            data_time += time.time() - fetch_start
+            batch = (inputs, targets)
             # GPU settings
             if use_cuda:
                 inputs, targets = inputs.cuda(), targets.cuda()
-            # Forward and Backward
-            optimizer.zero_grad()
-            outputs = net(inputs)
-            loss = loss_fn(outputs, targets)
-            try:
-                loss += net.get_reg()
-            except AttributeError:
-                try:
-                    loss += net.module.get_reg()
-                except AttributeError:
-                    pass
-            loss.backward()
-            optimizer.step()
-
-            # Plotting/Reporting
-            train_loss += loss.item()
-            losses.update(loss.item())
-            corrects, bs = num_correct(outputs.data, targets, topk=(1,5))
-            total += bs
-            top1_correct += corrects[0]
-            top5_correct += corrects[1]
-
-            sys.stdout.write('\r')
-            sys.stdout.write(
-                '| Epoch [{:3d}/{:3d}] Iter[{:3d}/{:3d}]\t\tLoss: {:.4f}\t'
-                'Acc@1: {:.3f}%\tAcc@5: {:.3f}%\tElapsed Time: '
-                '{:.1f}min'.format(
-                    epoch, epochs, batch_idx+1, num_iter, loss.item(),
-                    100. * top1_correct.item()/total,
-                    100. * top5_correct.item()/total, (time.time()-start)/60))
-            sys.stdout.flush()
-
-            # Output summaries
-            if batch_idx in update_steps and writer is not None:
-                global_step = 100*epoch + int(100*batch_idx/num_iter)
-                writer.add_scalar('acc', 100. * top1_correct.item()/total,
-                                  global_step)
-                writer.add_scalar('acc5', 100. * top5_correct.item()/total,
-                                  global_step)
-                writer.add_scalar('loss', losses.avg, global_step)
-                top1_correct = 0
-                top5_correct = 0
-                total = 0
-                losses.reset()
+            # Forward and Backward. The gradients are accumulated over
+            # iter_size batches before each step
+            first = batch_idx % iter_size == 0
+            last = (batch_idx % iter_size == iter_size - 1 or
+                    batch_idx == num_iter - 1)
+            if first:
+                if watchdog is not None:
+                    watchdog.start_step(net, optimizer, scaler)
+                optimizer.zero_grad()
+                accum = min(iter_size, num_iter - batch_idx)
+            # DistributedDataParallel only needs to average the gradients
+            # across processes on the last batch before a step
+            if last or not hasattr(net, 'no_sync'):
+                sync = contextlib.suppress()
+            else:
+                sync = net.no_sync()
+            with sync:
+                outputs, loss = _get_loss(net, loss_fn, inputs, targets, amp)
+                if scaler is not None:
+                    scaler.scale(loss / accum).backward()
+                else:
+                    (loss / accum).backward()
+
+            # Check for divergence before the step, so the gradients of the
+            # last batch are still there
+            if watchdog is not None:
+                bad = watchdog.step(batch_idx, loss, net, batch, first,
+                                    last, accum,
+                                    force=(batch_idx == num_iter - 1),
+                                    grads=(scaler is None))
+                if bad is not None:
+                    bad_idx, reason = bad
+                    print('\n| {} at epoch {} batch {}, replaying from the '
+                          'last good state with anomaly detection'.format(
+                              reason, epoch, bad_idx))
+                    watchdog.replay(net, loss_fn, optimizer, bad_idx, scaler,
+                                    use_cuda, amp)
+                    raise FloatingPointError(
+                        '{} at epoch {} batch {}, but the replay from the '
+                        'last good state with anomaly detection found no '
+                        'fault, so it may not be deterministic.'.format(
+                            reason, epoch, bad_idx))
+            if last and scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            elif last:
+                optimizer.step()
+
+            # Plotting/Reporting. The metrics stay on the device until the
+            # summary steps
+            metrics.update(loss, outputs, targets)
+            epoch_metrics.update(loss, outputs, targets)
+            if batch_idx in update_steps or batch_idx == num_iter - 1:
+                loss_avg, acc1, acc5 = metrics.read()
+                sys.stdout.write('\r')
+                sys.stdout.write(
+                    '| Epoch [{:3d}/{:3d}] Iter[{:3d}/{:3d}]\t\tLoss: {:.4f}\t'
+                    'Acc@1: {:.3f}%\tAcc@5: {:.3f}%\tSteps/s: {:.2f}\t'
+                    'Elapsed Time: {:.1f}min'.format(
+                        epoch, epochs, batch_idx+1, num_iter, loss_avg, acc1,
+                        acc5, metrics.steps_per_sec, (time.time()-start)/60))
+                sys.stdout.flush()
+
+                # Output summaries
+                if writer is not None:
+                    global_step = 100*epoch + int(100*batch_idx/num_iter)
+                    writer.add_scalar('acc', acc1, global_step)
+                    writer.add_scalar('acc5', acc5, global_step)
+                    writer.add_scalar('loss', loss_avg, global_step)
+                    writer.add_scalar('steps_per_sec', metrics.steps_per_sec,
+                                      global_step)
+                metrics.reset()
                 print()
+            fetch_start = time.time()
+
+    loss_avg, acc1, acc5 = epoch_metrics.read()
+    total_time = max(time.time() - start, 1e-6)
+    print('| Epoch {} steps/s: {:.2f}\tData wait: {:.1f}s ({:.0f}%)\t'
+          'Compute: {:.1f}s'.format(
+              epoch, epoch_metrics.steps_per_sec, data_time,
+              100 * data_time / total_time, total_time - data_time))
+    if writer is not None:
+        writer.add_scalar('data_wait_frac', data_time / total_time,
+                          100*(epoch+1))
+    return loss_avg, acc1, acc5
 
 
 def validate(loader, net, loss_fn=None, use_cuda=True, epoch=-1, writer=None,
-             noise=None, insertlevel=0):
+             noise=None, insertlevel=0, amp='off'):
     """ Validate a model with the given loss functions
 
     Args:
@@ -169,41 +630,38 @@ def validate(loader, net, loss_fn=None, use_cuda=True, epoch=-1, writer=None,
         epoch: current epoch (used only for print and logging purposes)
         writer: tensorboard writer
         noise: None or std of noise to add to input
+        amp (str): 'off', 'bf16' or 'fp16'. Runs the network under
+            torch.autocast with that dtype.
 
     Returns:
         acc: current epoch accuracy
     """
     net.eval()
-    test_loss = 0
-    top1_correct = 0
-    top5_correct = 0
-    total = 0
+    metrics = MetricAccumulator()
     with torch.no_grad():
         for batch_idx, (inputs, targets) in enumerate(loader):
             if use_cuda:
                 inputs, targets = inputs.cuda(), targets.cuda()
 
             # Calculate the output (potentially with noise)
-            if noise is not None:
-                outputs = net.forward_noise(inputs, insertlevel, noise)
-            else:
-                outputs = net(inputs)
-
-            if loss_fn is not None:
-                loss = loss_fn(outputs, targets)
-            else:
-                loss = torch.tensor(0)
-
-            corrects, bs = num_correct(outputs.data, targets, topk=(1, 5))
-            test_loss += bs * loss.item()
-            total += bs
-            top1_correct += corrects[0]
-            top5_correct += corrects[1]
+            with autocast(amp, inputs.device.type):
+                if noise is not None:
+                    outputs = net.forward_noise(inputs, insertlevel, noise)
+                else:
+                    outputs = net(inputs)
+
+                if loss_fn is not None:
+                    loss = loss_fn(outputs, targets)
+                else:
+                    loss = outputs.new_zeros([])
+            metrics.update(loss, outputs, targets)
+
+    # Each process has a shard of the data when distributed
+    if dist.is_available() and dist.is_initialized():
+        metrics.all_reduce()
 
     # Save checkpoint when best model
-    test_loss /= total
-    acc1 = 100. * top1_correct.item()/total
-    acc5 = 100. * top5_correct.item()/total
+    test_loss, acc1, acc5 = metrics.read()
     sys.stdout.write('\r')
     print("\n| Validation Epoch #{}\t\t\tLoss: {:.4f}\tAcc@1: {:.2f}%\t"
           "Acc@5: {:.2f}%".format(epoch, test_loss, acc1, acc5))
@@ -46,6 +46,127 @@ def int_to_mode(mode):
         raise ValueError("Unkown pad type: {}".format(mode))
 
 
+def compute_dtype(x):
+    """ Returns the dtype the scattering transforms should be done in for the
+    input x. This is the autocast dtype if autocast is enabled for the device
+    of x, otherwise it is the dtype of x. """
+    if x.device.type == 'cpu' and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    elif x.device.type == 'cuda' and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    return x.dtype
+
+
+def acc_dtype(dtype):
+    """ Returns the dtype to calculate magnitudes and their gradients in. The
+    bias of 1e-2 is lost when squared and added in half precision, so use
+    float32 for the half types. """
+    if dtype in (torch.float16, torch.bfloat16):
+        return torch.float32
+    return dtype
+
+
+def suggest_format(x):
+    """ Returns torch.channels_last if x is an NHWC tensor, otherwise
+    torch.contiguous_format. """
+    if not x.is_contiguous() and \
+            x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def cat_like(tensors, x):
+    """ Concatenates tensors along dimension 1 like torch.cat, but into a new
+    tensor with the dtype, device and memory format of x, so that channels
+    last networks keep their format through the scattering layers.
+
+    The tensors can be 4D, or 5D of shape (N, K, C, H, W). For 5D tensors
+    the output is allocated as (N, K*C, H, W) and returned as a 5D view, so
+    it can be viewed back to 4D without a copy.
+    """
+    K = sum(t.shape[1] for t in tensors)
+    s = tensors[0].shape
+    fmt = suggest_format(x)
+    if len(s) == 5:
+        Z = torch.empty((s[0], K*s[2], s[3], s[4]), dtype=x.dtype,
+                        device=x.device, memory_format=fmt)
+        Z = Z.view(s[0], K, s[2], s[3], s[4])
+    else:
+        Z = torch.empty((s[0], K, s[2], s[3]), dtype=x.dtype,
+                        device=x.device, memory_format=fmt)
+    k = 0
+    for t in tensors:
+        Z[:, k:k+t.shape[1]] = t
+        k += t.shape[1]
+    return Z
+
+
+def smooth_mag(reals, imags, bias, combine_colour=False):
+    """ Calculates the smoothed magnitude sqrt(x**2 + y**2 + b**2) of the
+    bandpass outputs. If combine_colour is true, the energy of the 3 colour
+    channels (the third dimension) is pooled into a single channel.
+
+    Note that the returned value still has the bias in it, i.e. the caller
+    needs to subtract it to get the scattering coefficients. For half
+    precision inputs the result is float32, see :func:`acc_dtype`.
+    """
+    dtype = acc_dtype(reals.dtype)
+    reals, imags = reals.to(dtype), imags.to(dtype)
+    if combine_colour:
+        r = torch.sqrt(reals[:,:,0]**2 + imags[:,:,0]**2 +
+                       reals[:,:,1]**2 + imags[:,:,1]**2 +
+                       reals[:,:,2]**2 + imags[:,:,2]**2 + bias**2)
+        r = r[:, :, None]
+    else:
+        r = torch.sqrt(reals**2 + imags**2 + bias**2)
+    return r
+
+
+def pack_phase(reals, imags):
+    """ Compresses the bandpass gradient terms into a single half precision
+    phase tensor. Use :func:`unpack_phase` to get drdx and drdy back. """
+    dtype = acc_dtype(reals.dtype)
+    return torch.atan2(imags.to(dtype), reals.to(dtype)).half()
+
+
+def unpack_phase(θ, m, bias):
+    """ Rebuilds the magnitude gradient terms drdx and drdy from the phase
+    tensor made by :func:`pack_phase` and the scattering magnitude
+    m = sqrt(x**2 + y**2 + b**2) - b.
+
+    The unbiased magnitude of x + jy is sqrt(m*(m + 2b)), so
+    drdx = cos(θ) * sqrt(m*(m + 2b))/(m + b) and similarly for drdy with
+    sin(θ). These are returned in float32 if m is half precision.
+    """
+    m = m.to(acc_dtype(m.dtype))
+    θ = θ.to(m.dtype)
+    g = torch.sqrt((m * (m + 2*bias)).clamp(min=0)) / (m + bias)
+    return g * torch.cos(θ), g * torch.sin(θ)
+
+
+def _fwd_j1(x, h0o, h1o, h2o, mode, fft=None):
+    """ Level 1 forward DTCWT with o_dim=1. Uses the rotationally symmetric
+    filters if h2o is not None, and the frequency domain if fft (a
+    :class:`scatnet_learn.dtcwt_fft.FFTj1`) is given. """
+    if fft is not None:
+        return fft.forward(x)
+    elif h2o is None:
+        return fwd_j1(x, h0o, h1o, False, 1, mode)
+    else:
+        return fwd_j1_rot(x, h0o, h1o, h2o, False, 1, mode)
+
+
+def _inv_j1(lo, reals, imags, h0o, h1o, h2o, mode, fft=None):
+    """ Backward pass of :func:`_fwd_j1`. The level 1 filters are symmetric so
+    don't need time reversing. """
+    if fft is not None:
+        return fft.adjoint(lo, reals, imags)
+    elif h2o is None:
+        return inv_j1(lo, reals, imags, h0o, h1o, 1, 3, 4, mode)
+    else:
+        return inv_j1_rot(lo, reals, imags, h0o, h1o, h2o, 1, 3, 4, mode)
+
+
 class SmoothMagFn(torch.autograd.Function):
     """ Class to do complex magnitude """
     @staticmethod
@@ -176,10 +297,21 @@ class ScatLayerj1a_f(torch.autograd.Function):
 
 class ScatLayerj1_f(torch.autograd.Function):
     """ Function to do forward and backward passes of a single scattering
-    layer with the DTCWT biorthogonal filters. """
+    layer with the DTCWT biorthogonal filters.
+
+    If checkpoint is true, only the input is saved for the backward pass and
+    the phase terms drdx, drdy are recomputed from it. This cuts the saved
+    activations from 3x the input size to 1x at the cost of an extra level 1
+    DTCWT in the backward pass.
+
+    If compact is true, only a half precision phase tensor is saved and the
+    gradient terms are rebuilt from it and the output magnitudes, needing a
+    quarter of the memory of drdx and drdy. This can't be used with
+    combine_colour. """
 
     @staticmethod
-    def forward(ctx, x, h0o, h1o, mode, bias, combine_colour):
+    def forward(ctx, x, h0o, h1o, mode, bias, combine_colour, checkpoint,
+                compact, fft):
         #  bias = 1e-2
         #  bias = 0
         ctx.in_shape = x.shape
@@ -187,19 +319,22 @@ class ScatLayerj1_f(torch.autograd.Function):
         assert r % 2 == c % 2 == 0
         mode = int_to_mode(mode)
         ctx.mode = mode
+        ctx.bias = bias
         ctx.combine_colour = combine_colour
+        ctx.checkpoint = checkpoint
+        ctx.compact = compact
+        ctx.fft = fft
+        assert not (compact and combine_colour)
 
-        ll, reals, imags = fwd_j1(x, h0o, h1o, False, 1, mode)
+        ll, reals, imags = _fwd_j1(x, h0o, h1o, None, mode, fft)
         ll = F.avg_pool2d(ll, 2)
-        if combine_colour:
-            r = torch.sqrt(reals[:,:,0]**2 + imags[:,:,0]**2 +
-                           reals[:,:,1]**2 + imags[:,:,1]**2 +
-                           reals[:,:,2]**2 + imags[:,:,2]**2 + bias**2)
-            r = r[:, :, None]
-        else:
-            r = torch.sqrt(reals**2 + imags**2 + bias**2)
+        r = smooth_mag(reals, imags, bias, combine_colour)
 
-        if x.requires_grad:
+        if x.requires_grad and checkpoint:
+            ctx.save_for_backward(h0o, h1o, x)
+        elif x.requires_grad and compact:
+            θ = pack_phase(reals, imags)
+        elif x.requires_grad:
             drdx = reals/r
             drdy = imags/r
             ctx.save_for_backward(h0o, h1o, drdx, drdy)
@@ -207,12 +342,16 @@ class ScatLayerj1_f(torch.autograd.Function):
             z = x.new_zeros(1)
             ctx.save_for_backward(h0o, h1o, z, z)
 
-        r = r - bias
+        r = (r - bias).to(x.dtype)
         del reals, imags
         if combine_colour:
-            Z = torch.cat((ll, r[:, :, 0]), dim=1)
+            Z = cat_like((ll, r[:, :, 0]), x)
         else:
-            Z = torch.cat((ll[:, None], r), dim=1)
+            Z = cat_like((ll[:, None], r), x)
+
+        if x.requires_grad and compact and not checkpoint:
+            # The magnitudes are in the output so only need the phase
+            ctx.save_for_backward(h0o, h1o, θ, Z)
 
         return Z
 
@@ -220,10 +359,22 @@ class ScatLayerj1_f(torch.autograd.Function):
     def backward(ctx, dZ):
         dX = None
         mode = ctx.mode
+        fft = ctx.fft
 
         if ctx.needs_input_grad[0]:
-            #  h0o, h1o, θ = ctx.saved_tensors
-            h0o, h1o, drdx, drdy = ctx.saved_tensors
+            if ctx.checkpoint:
+                # Rerun the forward transform to get the phase back
+                h0o, h1o, x = ctx.saved_tensors
+                _, reals, imags = _fwd_j1(x, h0o, h1o, None, mode, fft)
+                r = smooth_mag(reals, imags, ctx.bias, ctx.combine_colour)
+                drdx = reals/r
+                drdy = imags/r
+                del reals, imags, r
+            elif ctx.compact:
+                h0o, h1o, θ, Z = ctx.saved_tensors
+                drdx, drdy = unpack_phase(θ, Z[:, 1:], ctx.bias)
+            else:
+                h0o, h1o, drdx, drdy = ctx.saved_tensors
             # Use the special properties of the filters to get the time reverse
             h0o_t = h0o
             h1o_t = h1o
@@ -235,52 +386,62 @@ class ScatLayerj1_f(torch.autograd.Function):
             else:
                 dYl, dr = dZ[:,0], dZ[:,1:]
             ll = 1/4 * F.interpolate(dYl, scale_factor=2, mode="nearest")
-            reals = dr * drdx
-            imags = dr * drdy
+            reals = (dr * drdx).to(dr.dtype)
+            imags = (dr * drdy).to(dr.dtype)
 
-            dX = inv_j1(ll, reals, imags, h0o_t, h1o_t, 1, 3, 4, mode)
+            dX = _inv_j1(ll, reals, imags, h0o_t, h1o_t, None, mode, fft)
 
-        return (dX,) + (None,) * 5
+        return (dX,) + (None,) * 8
 
 
 class ScatLayerj1_rot_f(torch.autograd.Function):
     """ Function to do forward and backward passes of a single scattering
     layer with the DTCWT biorthogonal filters. Uses the rotationally symmetric
-    filters, i.e. a slightly more expensive operation."""
+    filters, i.e. a slightly more expensive operation.
+
+    See :class:`ScatLayerj1_f` for the checkpoint and compact options."""
 
     @staticmethod
-    def forward(ctx, x, h0o, h1o, h2o, mode, bias, combine_colour):
+    def forward(ctx, x, h0o, h1o, h2o, mode, bias, combine_colour, checkpoint,
+                compact, fft):
         mode = int_to_mode(mode)
         ctx.mode = mode
         #  bias = 0
         ctx.in_shape = x.shape
+        ctx.bias = bias
         ctx.combine_colour = combine_colour
+        ctx.checkpoint = checkpoint
+        ctx.compact = compact
+        ctx.fft = fft
+        assert not (compact and combine_colour)
         batch, ch, r, c = x.shape
         assert r % 2 == c % 2 == 0
 
         # Level 1 forward (biorthogonal analysis filters)
-        ll, reals, imags = fwd_j1_rot(x, h0o, h1o, h2o, False, 1, mode)
+        ll, reals, imags = _fwd_j1(x, h0o, h1o, h2o, mode, fft)
         ll = F.avg_pool2d(ll, 2)
-        if combine_colour:
-            r = torch.sqrt(reals[:,:,0]**2 + imags[:,:,0]**2 +
-                           reals[:,:,1]**2 + imags[:,:,1]**2 +
-                           reals[:,:,2]**2 + imags[:,:,2]**2 + bias**2)
-            r = r[:, :, None]
-        else:
-            r = torch.sqrt(reals**2 + imags**2 + bias**2)
-        if x.requires_grad:
+        r = smooth_mag(reals, imags, bias, combine_colour)
+        if x.requires_grad and checkpoint:
+            ctx.save_for_backward(h0o, h1o, h2o, x)
+        elif x.requires_grad and compact:
+            θ = pack_phase(reals, imags)
+        elif x.requires_grad:
             drdx = reals/r
             drdy = imags/r
             ctx.save_for_backward(h0o, h1o, h2o, drdx, drdy)
         else:
             z = x.new_zeros(1)
             ctx.save_for_backward(h0o, h1o, h2o, z, z)
-        r = r - bias
+        r = (r - bias).to(x.dtype)
         del reals, imags
         if combine_colour:
-            Z = torch.cat((ll, r[:, :, 0]), dim=1)
+            Z = cat_like((ll, r[:, :, 0]), x)
         else:
-            Z = torch.cat((ll[:, None], r), dim=1)
+            Z = cat_like((ll[:, None], r), x)
+
+        if x.requires_grad and compact and not checkpoint:
+            # The magnitudes are in the output so only need the phase
+            ctx.save_for_backward(h0o, h1o, h2o, θ, Z)
 
         return Z
 
@@ -288,11 +449,23 @@ class ScatLayerj1_rot_f(torch.autograd.Function):
     def backward(ctx, dZ):
         dX = None
         mode = ctx.mode
+        fft = ctx.fft
 
         if ctx.needs_input_grad[0]:
             # Don't need to do time reverse as these filters are symmetric
-            #  h0o, h1o, h2o, θ = ctx.saved_tensors
-            h0o, h1o, h2o, drdx, drdy = ctx.saved_tensors
+            if ctx.checkpoint:
+                # Rerun the forward transform to get the phase back
+                h0o, h1o, h2o, x = ctx.saved_tensors
+                _, reals, imags = _fwd_j1(x, h0o, h1o, h2o, mode, fft)
+                r = smooth_mag(reals, imags, ctx.bias, ctx.combine_colour)
+                drdx = reals/r
+                drdy = imags/r
+                del reals, imags, r
+            elif ctx.compact:
+                h0o, h1o, h2o, θ, Z = ctx.saved_tensors
+                drdx, drdy = unpack_phase(θ, Z[:, 1:], ctx.bias)
+            else:
+                h0o, h1o, h2o, drdx, drdy = ctx.saved_tensors
 
             # Level 1 backward (time reversed biorthogonal analysis filters)
             if ctx.combine_colour:
@@ -302,19 +475,25 @@ class ScatLayerj1_rot_f(torch.autograd.Function):
                 dYl, dr = dZ[:,0], dZ[:,1:]
             ll = 1/4 * F.interpolate(dYl, scale_factor=2, mode="nearest")
 
-            reals = dr * drdx
-            imags = dr * drdy
-            dX = inv_j1_rot(ll, reals, imags, h0o, h1o, h2o, 1, 3, 4, mode)
+            reals = (dr * drdx).to(dr.dtype)
+            imags = (dr * drdy).to(dr.dtype)
+            dX = _inv_j1(ll, reals, imags, h0o, h1o, h2o, mode, fft)
 
-        return (dX,) + (None,) * 6
+        return (dX,) + (None,) * 9
 
 
 class ScatLayerj2_f(torch.autograd.Function):
     """ Function to do forward and backward passes of a single scattering
-    layer with the DTCWT biorthogonal filters. """
+    layer with the DTCWT biorthogonal filters.
+
+    If compact is true, the six full precision gradient terms are replaced
+    by three half precision phase tensors and a half precision copy of the
+    j=1 magnitudes. The other magnitudes are taken from the output. This
+    can't be used with combine_colour. """
 
     @staticmethod
-    def forward(ctx, x, h0o, h1o, h0a, h0b, h1a, h1b, mode, bias, combine_colour):
+    def forward(ctx, x, h0o, h1o, h0a, h0b, h1a, h1b, mode, bias, combine_colour,
+                compact, fft):
         #  bias = 1e-2
         #  bias = 0
         ctx.in_shape = x.shape
@@ -323,40 +502,38 @@ class ScatLayerj2_f(torch.autograd.Function):
         mode = int_to_mode(mode)
         ctx.mode = mode
         ctx.combine_colour = combine_colour
+        ctx.bias = bias
+        ctx.compact = compact
+        ctx.fft = fft
+        assert not (compact and combine_colour)
 
         # First order scattering
-        s0, reals, imags = fwd_j1(x, h0o, h1o, False, 1, mode)
+        s0, reals, imags = _fwd_j1(x, h0o, h1o, None, mode, fft)
         if combine_colour:
-            s1_j1 = torch.sqrt(reals[:,:,0]**2 + imags[:,:,0]**2 +
-                               reals[:,:,1]**2 + imags[:,:,1]**2 +
-                               reals[:,:,2]**2 + imags[:,:,2]**2 + bias**2)
-            s1_j1 = s1_j1[:, :, None]
+            s1_j1 = smooth_mag(reals, imags, bias, True)
             if x.requires_grad:
                 dsdx1 = reals/s1_j1
                 dsdy1 = imags/s1_j1
-            s1_j1 = s1_j1 - bias
+            s1_j1 = (s1_j1 - bias).to(x.dtype)
 
             s0, reals, imags = fwd_j2plus(s0, h0a, h1a, h0b, h1b, False, 1, mode)
-            s1_j2 = torch.sqrt(reals[:,:,0]**2 + imags[:,:,0]**2 +
-                               reals[:,:,1]**2 + imags[:,:,1]**2 +
-                               reals[:,:,2]**2 + imags[:,:,2]**2 + bias**2)
-            s1_j2 = s1_j2[:, :, None]
+            s1_j2 = smooth_mag(reals, imags, bias, True)
             if x.requires_grad:
                 dsdx2 = reals/s1_j2
                 dsdy2 = imags/s1_j2
-            s1_j2 = s1_j2 - bias
+            s1_j2 = (s1_j2 - bias).to(x.dtype)
             s0 = F.avg_pool2d(s0, 2)
 
             # Second order scattering
             s1_j1 = s1_j1[:, :, 0]
-            s1_j1, reals, imags = fwd_j1(s1_j1, h0o, h1o, False, 1, mode)
-            s2_j1 = torch.sqrt(reals**2 + imags**2 + bias**2)
+            s1_j1, reals, imags = _fwd_j1(s1_j1, h0o, h1o, None, mode, fft)
+            s2_j1 = smooth_mag(reals, imags, bias)
             if x.requires_grad:
                 dsdx2_1 = reals/s2_j1
                 dsdy2_1 = imags/s2_j1
             q = s2_j1.shape
             s2_j1 = s2_j1.view(q[0], 36, q[3], q[4])
-            s2_j1 = s2_j1 - bias
+            s2_j1 = (s2_j1 - bias).to(x.dtype)
             s1_j1 = F.avg_pool2d(s1_j1, 2)
             if x.requires_grad:
                 ctx.save_for_backward(h0o, h1o, h0a, h0b, h1a, h1b,
@@ -368,49 +545,62 @@ class ScatLayerj2_f(torch.autograd.Function):
                                       z, z, z, z, z, z)
 
             del reals, imags
-            Z = torch.cat((s0, s1_j1, s1_j2[:,:,0], s2_j1), dim=1)
+            Z = cat_like((s0, s1_j1, s1_j2[:,:,0], s2_j1), x)
 
         else:
-            s1_j1 = torch.sqrt(reals**2 + imags**2 + bias**2)
-            if x.requires_grad:
+            s1_j1 = smooth_mag(reals, imags, bias)
+            if x.requires_grad and compact:
+                θ1 = pack_phase(reals, imags)
+            elif x.requires_grad:
                 dsdx1 = reals/s1_j1
                 dsdy1 = imags/s1_j1
-            s1_j1 = s1_j1 - bias
+            s1_j1 = (s1_j1 - bias).to(x.dtype)
+            if x.requires_grad and compact:
+                m1 = s1_j1.half()
 
             s0, reals, imags = fwd_j2plus(s0, h0a, h1a, h0b, h1b, False, 1, mode)
-            s1_j2 = torch.sqrt(reals**2 + imags**2 + bias**2)
-            if x.requires_grad:
+            s1_j2 = smooth_mag(reals, imags, bias)
+            if x.requires_grad and compact:
+                θ2 = pack_phase(reals, imags)
+            elif x.requires_grad:
                 dsdx2 = reals/s1_j2
                 dsdy2 = imags/s1_j2
-            s1_j2 = s1_j2 - bias
+            s1_j2 = (s1_j2 - bias).to(x.dtype)
             s0 = F.avg_pool2d(s0, 2)
 
             # Second order scattering
             p = s1_j1.shape
             s1_j1 = s1_j1.view(p[0], 6*p[2], p[3], p[4])
 
-            s1_j1, reals, imags = fwd_j1(s1_j1, h0o, h1o, False, 1, mode)
-            s2_j1 = torch.sqrt(reals**2 + imags**2 + bias**2)
-            if x.requires_grad:
+            s1_j1, reals, imags = _fwd_j1(s1_j1, h0o, h1o, None, mode, fft)
+            s2_j1 = smooth_mag(reals, imags, bias)
+            if x.requires_grad and compact:
+                θ2_1 = pack_phase(reals, imags)
+            elif x.requires_grad:
                 dsdx2_1 = reals/s2_j1
                 dsdy2_1 = imags/s2_j1
             q = s2_j1.shape
             s2_j1 = s2_j1.view(q[0], 36, q[2]//6, q[3], q[4])
-            s2_j1 = s2_j1 - bias
+            s2_j1 = (s2_j1 - bias).to(x.dtype)
             s1_j1 = F.avg_pool2d(s1_j1, 2)
             s1_j1 = s1_j1.view(p[0], 6, p[2], p[3]//2, p[4]//2)
 
-            if x.requires_grad:
+            if x.requires_grad and not compact:
                 ctx.save_for_backward(h0o, h1o, h0a, h0b, h1a, h1b,
                                       dsdx1, dsdy1, dsdx2, dsdy2,
                                       dsdx2_1, dsdy2_1)
-            else:
+            elif not x.requires_grad:
                 z = x.new_zeros(1)
                 ctx.save_for_backward(h0o, h1o, h0a, h0b, h1a, h1b,
                                       z, z, z, z, z, z)
 
             del reals, imags
-            Z = torch.cat((s0[:, None], s1_j1, s1_j2, s2_j1), dim=1)
+            Z = cat_like((s0[:, None], s1_j1, s1_j2, s2_j1), x)
+            if x.requires_grad and compact:
+                # The j=2 and second order magnitudes are in the output, so
+                # only need to keep their phases
+                ctx.save_for_backward(h0o, h1o, h0a, h0b, h1a, h1b,
+                                      θ1, m1, θ2, θ2_1, Z)
 
         return Z
 
@@ -418,6 +608,7 @@ class ScatLayerj2_f(torch.autograd.Function):
     def backward(ctx, dZ):
         dX = None
         mode = ctx.mode
+        fft = ctx.fft
 
         if ctx.needs_input_grad[0]:
             # Input has shape N, L, C, H, W
@@ -426,8 +617,16 @@ class ScatLayerj2_f(torch.autograd.Function):
             w_dim = 4
 
             # Retrieve phase info
-            (h0o, h1o, h0a, h0b, h1a, h1b, dsdx1, dsdy1, dsdx2, dsdy2, dsdx2_1,
-             dsdy2_1) = ctx.saved_tensors
+            if ctx.compact:
+                (h0o, h1o, h0a, h0b, h1a, h1b, θ1, m1, θ2, θ2_1,
+                 Z) = ctx.saved_tensors
+                dsdx1, dsdy1 = unpack_phase(θ1, m1, ctx.bias)
+                dsdx2, dsdy2 = unpack_phase(θ2, Z[:, 7:13], ctx.bias)
+                dsdx2_1, dsdy2_1 = unpack_phase(
+                    θ2_1, Z[:, 13:].reshape(θ2_1.shape), ctx.bias)
+            else:
+                (h0o, h1o, h0a, h0b, h1a, h1b, dsdx1, dsdy1, dsdx2, dsdy2, dsdx2_1,
+                 dsdy2_1) = ctx.saved_tensors
 
             # Use the special properties of the filters to get the time reverse
             h0o_t = h0o
@@ -448,27 +647,27 @@ class ScatLayerj2_f(torch.autograd.Function):
                 ds2_j1 = ds2_j1.view(q[0], 6, 6, q[2], q[3])
 
                 # Inverse second order scattering
-                reals = ds2_j1 * dsdx2_1
-                imags = ds2_j1 * dsdy2_1
-                ds1_j1 = inv_j1(
-                    ds1_j1, reals, imags, h0o_t, h1o_t, o_dim, h_dim, w_dim, mode)
+                reals = (ds2_j1 * dsdx2_1).to(ds2_j1.dtype)
+                imags = (ds2_j1 * dsdy2_1).to(ds2_j1.dtype)
+                ds1_j1 = _inv_j1(
+                    ds1_j1, reals, imags, h0o_t, h1o_t, None, mode, fft)
                 ds1_j1 = ds1_j1[:, :, None]
 
                 # Inverse first order scattering j=2
                 ds0 = 1/4 * F.interpolate(ds0, scale_factor=2, mode="nearest")
                 #  s = ds1_j2.shape
                 #  ds1_j2 = ds1_j2.view(s[0], 6, s[1]//6, s[2], s[3])
-                reals = ds1_j2 * dsdx2
-                imags = ds1_j2 * dsdy2
+                reals = (ds1_j2 * dsdx2).to(ds1_j2.dtype)
+                imags = (ds1_j2 * dsdy2).to(ds1_j2.dtype)
                 ds0 = inv_j2plus(
                     ds0, reals, imags, h0a_t, h1a_t, h0b_t, h1b_t,
                     o_dim, h_dim, w_dim, mode)
 
                 # Inverse first order scattering j=1
-                reals = ds1_j1 * dsdx1
-                imags = ds1_j1 * dsdy1
-                dX = inv_j1(
-                    ds0, reals, imags, h0o_t, h1o_t, o_dim, h_dim, w_dim, mode)
+                reals = (ds1_j1 * dsdx1).to(ds1_j1.dtype)
+                imags = (ds1_j1 * dsdy1).to(ds1_j1.dtype)
+                dX = _inv_j1(
+                    ds0, reals, imags, h0o_t, h1o_t, None, mode, fft)
             else:
                 ds0, ds1_j1, ds1_j2, ds2_j1 = \
                     dZ[:,0], dZ[:,1:7], dZ[:,7:13], dZ[:,13:]
@@ -479,37 +678,40 @@ class ScatLayerj2_f(torch.autograd.Function):
                 ds2_j1 = ds2_j1.view(q[0], 6, q[2]*6, q[3], q[4])
 
                 # Inverse second order scattering
-                reals = ds2_j1 * dsdx2_1
-                imags = ds2_j1 * dsdy2_1
-                ds1_j1 = inv_j1(
-                    ds1_j1, reals, imags, h0o_t, h1o_t, o_dim, h_dim, w_dim, mode)
+                reals = (ds2_j1 * dsdx2_1).to(ds2_j1.dtype)
+                imags = (ds2_j1 * dsdy2_1).to(ds2_j1.dtype)
+                ds1_j1 = _inv_j1(
+                    ds1_j1, reals, imags, h0o_t, h1o_t, None, mode, fft)
                 ds1_j1 = ds1_j1.view(p[0], 6, p[2], p[3]*2, p[4]*2)
 
                 # Inverse first order scattering j=2
                 ds0 = 1/4 * F.interpolate(ds0, scale_factor=2, mode="nearest")
                 #  s = ds1_j2.shape
                 #  ds1_j2 = ds1_j2.view(s[0], 6, s[1]//6, s[2], s[3])
-                reals = ds1_j2 * dsdx2
-                imags = ds1_j2 * dsdy2
+                reals = (ds1_j2 * dsdx2).to(ds1_j2.dtype)
+                imags = (ds1_j2 * dsdy2).to(ds1_j2.dtype)
                 ds0 = inv_j2plus(
                     ds0, reals, imags, h0a_t, h1a_t, h0b_t, h1b_t,
                     o_dim, h_dim, w_dim, mode)
 
                 # Inverse first order scattering j=1
-                reals = ds1_j1 * dsdx1
-                imags = ds1_j1 * dsdy1
-                dX = inv_j1(
-                    ds0, reals, imags, h0o_t, h1o_t, o_dim, h_dim, w_dim, mode)
+                reals = (ds1_j1 * dsdx1).to(ds1_j1.dtype)
+                imags = (ds1_j1 * dsdy1).to(ds1_j1.dtype)
+                dX = _inv_j1(
+                    ds0, reals, imags, h0o_t, h1o_t, None, mode, fft)
 
-        return (dX,) + (None,) * 9
+        return (dX,) + (None,) * 11
 
 
 class ScatLayerj2_rot_f(torch.autograd.Function):
     """ Function to do forward and backward passes of a single scattering
-    layer with the DTCWT bandpass biorthogonal and qshift filters . """
+    layer with the DTCWT bandpass biorthogonal and qshift filters .
+
+    See :class:`ScatLayerj2_f` for the compact option. """
 
     @staticmethod
-    def forward(ctx, x, h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, mode, bias, combine_colour):
+    def forward(ctx, x, h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, mode, bias, combine_colour,
+                compact, fft):
         #  bias = 1e-2
         #  bias = 0
         ctx.in_shape = x.shape
@@ -518,40 +720,38 @@ class ScatLayerj2_rot_f(torch.autograd.Function):
         mode = int_to_mode(mode)
         ctx.mode = mode
         ctx.combine_colour = combine_colour
+        ctx.bias = bias
+        ctx.compact = compact
+        ctx.fft = fft
+        assert not (compact and combine_colour)
 
         # First order scattering
-        s0, reals, imags = fwd_j1_rot(x, h0o, h1o, h2o, False, 1, mode)
+        s0, reals, imags = _fwd_j1(x, h0o, h1o, h2o, mode, fft)
         if combine_colour:
-            s1_j1 = torch.sqrt(reals[:,:,0]**2 + imags[:,:,0]**2 +
-                               reals[:,:,1]**2 + imags[:,:,1]**2 +
-                               reals[:,:,2]**2 + imags[:,:,2]**2 + bias**2)
-            s1_j1 = s1_j1[:, :, None]
+            s1_j1 = smooth_mag(reals, imags, bias, True)
             if x.requires_grad:
                 dsdx1 = reals/s1_j1
                 dsdy1 = imags/s1_j1
-            s1_j1 = s1_j1 - bias
+            s1_j1 = (s1_j1 - bias).to(x.dtype)
 
             s0, reals, imags = fwd_j2plus_rot(s0, h0a, h1a, h0b, h1b, h2a, h2b, False, 1, mode)
-            s1_j2 = torch.sqrt(reals[:,:,0]**2 + imags[:,:,0]**2 +
-                               reals[:,:,1]**2 + imags[:,:,1]**2 +
-                               reals[:,:,2]**2 + imags[:,:,2]**2 + bias**2)
-            s1_j2 = s1_j2[:, :, None]
+            s1_j2 = smooth_mag(reals, imags, bias, True)
             if x.requires_grad:
                 dsdx2 = reals/s1_j2
                 dsdy2 = imags/s1_j2
-            s1_j2 = s1_j2 - bias
+            s1_j2 = (s1_j2 - bias).to(x.dtype)
             s0 = F.avg_pool2d(s0, 2)
 
             # Second order scattering
             s1_j1 = s1_j1[:, :, 0]
-            s1_j1, reals, imags = fwd_j1_rot(s1_j1, h0o, h1o, h2o, False, 1, mode)
-            s2_j1 = torch.sqrt(reals**2 + imags**2 + bias**2)
+            s1_j1, reals, imags = _fwd_j1(s1_j1, h0o, h1o, h2o, mode, fft)
+            s2_j1 = smooth_mag(reals, imags, bias)
             if x.requires_grad:
                 dsdx2_1 = reals/s2_j1
                 dsdy2_1 = imags/s2_j1
             q = s2_j1.shape
             s2_j1 = s2_j1.view(q[0], 36, q[3], q[4])
-            s2_j1 = s2_j1 - bias
+            s2_j1 = (s2_j1 - bias).to(x.dtype)
             s1_j1 = F.avg_pool2d(s1_j1, 2)
             if x.requires_grad:
                 ctx.save_for_backward(h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b,
@@ -563,47 +763,60 @@ class ScatLayerj2_rot_f(torch.autograd.Function):
                                       z, z, z, z, z, z)
 
             del reals, imags
-            Z = torch.cat((s0, s1_j1, s1_j2[:, :, 0], s2_j1), dim=1)
+            Z = cat_like((s0, s1_j1, s1_j2[:, :, 0], s2_j1), x)
         else:
-            s1_j1 = torch.sqrt(reals**2 + imags**2 + bias**2)
-            if x.requires_grad:
+            s1_j1 = smooth_mag(reals, imags, bias)
+            if x.requires_grad and compact:
+                θ1 = pack_phase(reals, imags)
+            elif x.requires_grad:
                 dsdx1 = reals/s1_j1
                 dsdy1 = imags/s1_j1
-            s1_j1 = s1_j1 - bias
+            s1_j1 = (s1_j1 - bias).to(x.dtype)
+            if x.requires_grad and compact:
+                m1 = s1_j1.half()
 
             s0, reals, imags = fwd_j2plus_rot(s0, h0a, h1a, h0b, h1b, h2a, h2b, False, 1, mode)
-            s1_j2 = torch.sqrt(reals**2 + imags**2 + bias**2)
-            if x.requires_grad:
+            s1_j2 = smooth_mag(reals, imags, bias)
+            if x.requires_grad and compact:
+                θ2 = pack_phase(reals, imags)
+            elif x.requires_grad:
                 dsdx2 = reals/s1_j2
                 dsdy2 = imags/s1_j2
-            s1_j2 = s1_j2 - bias
+            s1_j2 = (s1_j2 - bias).to(x.dtype)
             s0 = F.avg_pool2d(s0, 2)
 
             # Second order scattering
             p = s1_j1.shape
             s1_j1 = s1_j1.view(p[0], 6*p[2], p[3], p[4])
-            s1_j1, reals, imags = fwd_j1_rot(s1_j1, h0o, h1o, h2o, False, 1, mode)
-            s2_j1 = torch.sqrt(reals**2 + imags**2 + bias**2)
-            if x.requires_grad:
+            s1_j1, reals, imags = _fwd_j1(s1_j1, h0o, h1o, h2o, mode, fft)
+            s2_j1 = smooth_mag(reals, imags, bias)
+            if x.requires_grad and compact:
+                θ2_1 = pack_phase(reals, imags)
+            elif x.requires_grad:
                 dsdx2_1 = reals/s2_j1
                 dsdy2_1 = imags/s2_j1
             q = s2_j1.shape
             s2_j1 = s2_j1.view(q[0], 36, q[2]//6, q[3], q[4])
-            s2_j1 = s2_j1 - bias
+            s2_j1 = (s2_j1 - bias).to(x.dtype)
             s1_j1 = F.avg_pool2d(s1_j1, 2)
             s1_j1 = s1_j1.view(p[0], 6, p[2], p[3]//2, p[4]//2)
 
-            if x.requires_grad:
+            if x.requires_grad and not compact:
                 ctx.save_for_backward(h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b,
                                       dsdx1, dsdy1, dsdx2, dsdy2, dsdx2_1,
                                       dsdy2_1)
-            else:
+            elif not x.requires_grad:
                 z = x.new_zeros(1)
                 ctx.save_for_backward(h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b,
                                       z, z, z, z, z, z)
 
             del reals, imags
-            Z = torch.cat((s0[:, None], s1_j1, s1_j2, s2_j1), dim=1)
+            Z = cat_like((s0[:, None], s1_j1, s1_j2, s2_j1), x)
+            if x.requires_grad and compact:
+                # The j=2 and second order magnitudes are in the output, so
+                # only need to keep their phases
+                ctx.save_for_backward(h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b,
+                                      θ1, m1, θ2, θ2_1, Z)
 
         return Z
 
@@ -611,6 +824,7 @@ class ScatLayerj2_rot_f(torch.autograd.Function):
     def backward(ctx, dZ):
         dX = None
         mode = ctx.mode
+        fft = ctx.fft
 
         if ctx.needs_input_grad[0]:
             # Input has shape N, L, C, H, W
@@ -619,8 +833,16 @@ class ScatLayerj2_rot_f(torch.autograd.Function):
             w_dim = 4
 
             # Retrieve phase info
-            (h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, dsdx1, dsdy1, dsdx2,
-             dsdy2, dsdx2_1, dsdy2_1) = ctx.saved_tensors
+            if ctx.compact:
+                (h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, θ1, m1, θ2, θ2_1,
+                 Z) = ctx.saved_tensors
+                dsdx1, dsdy1 = unpack_phase(θ1, m1, ctx.bias)
+                dsdx2, dsdy2 = unpack_phase(θ2, Z[:, 7:13], ctx.bias)
+                dsdx2_1, dsdy2_1 = unpack_phase(
+                    θ2_1, Z[:, 13:].reshape(θ2_1.shape), ctx.bias)
+            else:
+                (h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, dsdx1, dsdy1, dsdx2,
+                 dsdy2, dsdx2_1, dsdy2_1) = ctx.saved_tensors
 
             # Use the special properties of the filters to get the time reverse
             h0o_t = h0o
@@ -645,29 +867,27 @@ class ScatLayerj2_rot_f(torch.autograd.Function):
                 ds2_j1 = ds2_j1.view(q[0], 6, 6, q[2], q[3])
 
                 # Inverse second order scattering
-                reals = ds2_j1 * dsdx2_1
-                imags = ds2_j1 * dsdy2_1
-                ds1_j1 = inv_j1_rot(
-                    ds1_j1, reals, imags, h0o_t, h1o_t, h2o_t,
-                    o_dim, h_dim, w_dim, mode)
+                reals = (ds2_j1 * dsdx2_1).to(ds2_j1.dtype)
+                imags = (ds2_j1 * dsdy2_1).to(ds2_j1.dtype)
+                ds1_j1 = _inv_j1(
+                    ds1_j1, reals, imags, h0o_t, h1o_t, h2o_t, mode, fft)
                 ds1_j1 = ds1_j1[:, :, None]
 
                 # Inverse first order scattering j=2
                 ds0 = 1/4 * F.interpolate(ds0, scale_factor=2, mode="nearest")
                 #  s = ds1_j2.shape
                 #  ds1_j2 = ds1_j2.view(s[0], 6, s[1]//6, s[2], s[3])
-                reals = ds1_j2 * dsdx2
-                imags = ds1_j2 * dsdy2
+                reals = (ds1_j2 * dsdx2).to(ds1_j2.dtype)
+                imags = (ds1_j2 * dsdy2).to(ds1_j2.dtype)
                 ds0 = inv_j2plus_rot(
                     ds0, reals, imags, h0a_t, h1a_t, h0b_t, h1b_t, h2a_t, h2b_t,
                     o_dim, h_dim, w_dim, mode)
 
                 # Inverse first order scattering j=1
-                reals = ds1_j1 * dsdx1
-                imags = ds1_j1 * dsdy1
-                dX = inv_j1_rot(
-                    ds0, reals, imags, h0o_t, h1o_t, h2o_t,
-                    o_dim, h_dim, w_dim, mode)
+                reals = (ds1_j1 * dsdx1).to(ds1_j1.dtype)
+                imags = (ds1_j1 * dsdy1).to(ds1_j1.dtype)
+                dX = _inv_j1(
+                    ds0, reals, imags, h0o_t, h1o_t, h2o_t, mode, fft)
             else:
                 ds0, ds1_j1, ds1_j2, ds2_j1 = \
                     dZ[:,0], dZ[:,1:7], dZ[:,7:13], dZ[:,13:]
@@ -678,31 +898,355 @@ class ScatLayerj2_rot_f(torch.autograd.Function):
                 ds1_j1 = 1/4 * F.interpolate(ds1_j1, scale_factor=2, mode="nearest")
                 q = ds2_j1.shape
                 ds2_j1 = ds2_j1.view(q[0], 6, q[2]*6, q[3], q[4])
-                reals = ds2_j1 * dsdx2_1
-                imags = ds2_j1 * dsdy2_1
-                ds1_j1 = inv_j1_rot(
-                    ds1_j1, reals, imags, h0o_t, h1o_t, h2o_t,
-                    o_dim, h_dim, w_dim, mode)
+                reals = (ds2_j1 * dsdx2_1).to(ds2_j1.dtype)
+                imags = (ds2_j1 * dsdy2_1).to(ds2_j1.dtype)
+                ds1_j1 = _inv_j1(
+                    ds1_j1, reals, imags, h0o_t, h1o_t, h2o_t, mode, fft)
                 ds1_j1 = ds1_j1.view(p[0], 6, p[2], p[3]*2, p[4]*2)
 
                 # Inverse first order scattering j=2
                 ds0 = 1/4 * F.interpolate(ds0, scale_factor=2, mode="nearest")
                 #  s = ds1_j2.shape
                 #  ds1_j2 = ds1_j2.view(s[0], 6, s[1]//6, s[2], s[3])
-                reals = ds1_j2 * dsdx2
-                imags = ds1_j2 * dsdy2
+                reals = (ds1_j2 * dsdx2).to(ds1_j2.dtype)
+                imags = (ds1_j2 * dsdy2).to(ds1_j2.dtype)
                 ds0 = inv_j2plus_rot(
                     ds0, reals, imags, h0a_t, h1a_t, h0b_t, h1b_t, h2a_t, h2b_t,
                     o_dim, h_dim, w_dim, mode)
 
                 # Inverse first order scattering j=1
-                reals = ds1_j1 * dsdx1
-                imags = ds1_j1 * dsdy1
-                dX = inv_j1_rot(
-                    ds0, reals, imags, h0o_t, h1o_t, h2o_t,
-                    o_dim, h_dim, w_dim, mode)
+                reals = (ds1_j1 * dsdx1).to(ds1_j1.dtype)
+                imags = (ds1_j1 * dsdy1).to(ds1_j1.dtype)
+                dX = _inv_j1(
+                    ds0, reals, imags, h0o_t, h1o_t, h2o_t, mode, fft)
+
+        return (dX,) + (None,) * 14
+
+
+def _fwd_level(x, j, filts, skip_hps, mode):
+    """ Does level j of the DTCWT on x, the lowpass output of level j-1 (or
+    the input if j == 1). Level 1 uses the biorthogonal filters, the rest use
+    the qshift filters. """
+    h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b = filts
+    if j == 1 and h2o is None:
+        return fwd_j1(x, h0o, h1o, skip_hps, 1, mode)
+    elif j == 1:
+        return fwd_j1_rot(x, h0o, h1o, h2o, skip_hps, 1, mode)
+    elif h2o is None:
+        return fwd_j2plus(x, h0a, h1a, h0b, h1b, skip_hps, 1, mode)
+    else:
+        return fwd_j2plus_rot(x, h0a, h1a, h0b, h1b, h2a, h2b, skip_hps, 1,
+                              mode)
+
+
+def _inv_level(lo, reals, imags, j, filts, mode):
+    """ Backward pass of :func:`_fwd_level`. If reals and imags are None, only
+    the lowpass is passed back. """
+    h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b = filts
+    if reals is None:
+        reals = imags = lo.new_zeros([])
+    # Use the special properties of the filters to get the time reverse
+    if j == 1 and h2o is None:
+        return inv_j1(lo, reals, imags, h0o, h1o, 1, 3, 4, mode)
+    elif j == 1:
+        return inv_j1_rot(lo, reals, imags, h0o, h1o, h2o, 1, 3, 4, mode)
+    elif h2o is None:
+        return inv_j2plus(lo, reals, imags, h0b, h1b, h0a, h1a, 1, 3, 4, mode)
+    else:
+        return inv_j2plus_rot(lo, reals, imags, h0b, h1b, h0a, h1a, h2b, h2a,
+                              1, 3, 4, mode)
+
+
+def _smooth(x, k, filts, mode):
+    """ Lowpasses x through k levels of the DTCWT and average pools the
+    result, taking a signal at scale j to the output scale j+k. """
+    if k == 0:
+        return x
+    for l in range(1, k+1):
+        x, _, _ = _fwd_level(x, l, filts, True, mode)
+    return F.avg_pool2d(x, 2)
+
+
+def _smooth_grad(dy, k, filts, mode):
+    """ Backward pass of :func:`_smooth` """
+    if k == 0:
+        return dy
+    dx = 1/4 * F.interpolate(dy, scale_factor=2, mode="nearest")
+    for l in range(k, 0, -1):
+        dx = _inv_level(dx, None, None, l, filts, mode)
+    return dx
+
+
+class ScatLayerJ_f(torch.autograd.Function):
+    """ Function to do forward and backward passes of a J scale scattering
+    layer of order 1 or 2.
+
+    Walks the DTCWT tree: the first order coefficients are the magnitudes of
+    the J bandpass scales of the input, and the second order coefficients are
+    the magnitudes of the bandpasses of each first order magnitude at the
+    coarser scales j2 > j1 only. The finer scales carry little energy so are
+    never computed. Every output is lowpassed down to scale J.
+
+    The output has shape (N, 1+6J+36P, C, H/2**J, W/2**J) where P is the
+    number of second order paths, J(J-1)/2 (or 0 for order 1). It is ordered
+    as the lowpass, the first order terms for j=1..J, then the second order
+    terms sorted by (j1, j2). For J=2 this matches :class:`ScatLayerj2_f`.
+
+    The rotationally symmetric filters are used if h2o is not None. Only the
+    gradient terms of the magnitudes are saved for the backward pass, the
+    lowpass smoothing is linear so needs nothing. """
+
+    @staticmethod
+    def forward(ctx, x, h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, J, order,
+                mode, bias):
+        ctx.in_shape = x.shape
+        batch, ch, r, c = x.shape
+        assert r % 2**J == c % 2**J == 0
+        assert order in (1, 2)
+        mode = int_to_mode(mode)
+        ctx.mode = mode
+        ctx.J = J
+        ctx.order = order
+        filts = (h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b)
+        grads = []
+
+        def mag(reals, imags):
+            r = smooth_mag(reals, imags, bias)
+            if x.requires_grad:
+                grads.extend((reals/r, imags/r))
+            return (r - bias).to(x.dtype)
+
+        # First order scattering
+        lo = x
+        U1 = []
+        for j in range(1, J+1):
+            lo, reals, imags = _fwd_level(lo, j, filts, False, mode)
+            U1.append(mag(reals, imags))
+        S0 = F.avg_pool2d(lo, 2)
+        del reals, imags
+
+        # Second order scattering. Walk the tree below each first order
+        # magnitude to get its lowpass and its j2 > j1 bandpasses
+        S1 = []
+        S2 = []
+        for j1 in range(1, J+1):
+            u = U1[j1-1]
+            if j1 == J:
+                S1.append(u)
+                continue
+            p = u.shape
+            lo = u.view(p[0], 6*p[2], p[3], p[4])
+            for k in range(1, J-j1+1):
+                lo, reals, imags = _fwd_level(lo, k, filts, order == 1, mode)
+                if order == 2:
+                    u2 = mag(reals, imags)
+                    q = u2.shape
+                    u2 = _smooth(u2.view(q[0], 6*q[2], q[3], q[4]), J-j1-k,
+                                 filts, mode)
+                    S2.append(u2.view(q[0], 36, p[2], *u2.shape[-2:]))
+            lo = F.avg_pool2d(lo, 2)
+            S1.append(lo.view(p[0], 6, p[2], *lo.shape[-2:]))
+        del U1
+
+        if x.requires_grad:
+            ctx.save_for_backward(*filts, *grads)
+        Z = cat_like([S0[:, None]] + S1 + S2, x)
+
+        return Z
+
+    @staticmethod
+    def backward(ctx, dZ):
+        dX = None
+        mode = ctx.mode
+        J = ctx.J
+
+        if ctx.needs_input_grad[0]:
+            saved = ctx.saved_tensors
+            filts, grads = saved[:9], saved[9:]
+            N, _, C, h, w = dZ.shape
+
+            # Backward through the tree below each first order magnitude
+            dU1 = []
+            path = 0
+            for j1 in range(1, J+1):
+                dS1 = dZ[:, 1+6*(j1-1):1+6*j1]
+                if j1 == J:
+                    dU1.append(dS1)
+                    continue
+                K = J - j1
+                dlo = dS1.reshape(N, 6*C, h, w)
+                dlo = 1/4 * F.interpolate(dlo, scale_factor=2, mode="nearest")
+                for k in range(K, 0, -1):
+                    reals = imags = None
+                    if ctx.order == 2:
+                        i = path + k - 1
+                        dS2 = dZ[:, 1+6*J+36*i:1+6*J+36*(i+1)]
+                        du2 = _smooth_grad(dS2.reshape(N, 36*C, h, w),
+                                           J-j1-k, filts, mode)
+                        du2 = du2.view(N, 6, 6*C, *du2.shape[-2:])
+                        dsdx, dsdy = grads[2*(J+i):2*(J+i+1)]
+                        reals = (du2 * dsdx).to(du2.dtype)
+                        imags = (du2 * dsdy).to(du2.dtype)
+                    dlo = _inv_level(dlo, reals, imags, k, filts, mode)
+                if ctx.order == 2:
+                    path += K
+                dU1.append(dlo.view(N, 6, C, *dlo.shape[-2:]))
+
+            # Backward through the first order scattering
+            dlo = 1/4 * F.interpolate(dZ[:, 0], scale_factor=2, mode="nearest")
+            for j in range(J, 0, -1):
+                du = dU1[j-1]
+                dsdx, dsdy = grads[2*(j-1):2*j]
+                reals = (du * dsdx).to(du.dtype)
+                imags = (du * dsdy).to(du.dtype)
+                dlo = _inv_level(dlo, reals, imags, j, filts, mode)
+            dX = dlo
+
+        return (dX,) + (None,) * 13
+
+
+def _check_out(out, shape, x):
+    """ Allocates the output of the inference functions, or checks that the
+    one given can be written into. """
+    if out is None:
+        return torch.empty(shape, dtype=x.dtype, device=x.device,
+                           memory_format=suggest_format(x))
+    if tuple(out.shape) != tuple(shape) or out.dtype != x.dtype or \
+            out.device != x.device:
+        raise ValueError(
+            'out should be a {} tensor on {} with shape {}, got a {} tensor '
+            'on {} with shape {}'.format(x.dtype, x.device, tuple(shape),
+                                         out.dtype, out.device,
+                                         tuple(out.shape)))
+    return out
+
+
+def _avg_pool2_into(x, out):
+    """ Does a 2x2 average pool of x into out. Works for any number of
+    leading dimensions, and out can be a view. """
+    torch.add(x[..., ::2, ::2], x[..., 1::2, ::2], out=out)
+    out.add_(x[..., ::2, 1::2]).add_(x[..., 1::2, 1::2]).mul_(0.25)
+
+
+def _smooth_mag_into(reals, imags, bias, out, combine_colour=False):
+    """ Writes sqrt(x**2 + y**2 + b**2) - b into out. out can be a view, or
+    reals itself. See :func:`smooth_mag` for combine_colour. """
+    if combine_colour:
+        torch.mul(reals[:,:,0], reals[:,:,0], out=out)
+        out.addcmul_(imags[:,:,0], imags[:,:,0])
+        for c in (1, 2):
+            out.addcmul_(reals[:,:,c], reals[:,:,c])
+            out.addcmul_(imags[:,:,c], imags[:,:,c])
+    else:
+        torch.mul(reals, reals, out=out)
+        out.addcmul_(imags, imags)
+    out.add_(bias**2).sqrt_().sub_(bias)
+
+
+def scatj1_inference(x, h0o, h1o, h2o, mode, bias, combine_colour, out=None,
+                     fft=None):
+    """ Forward pass of :class:`ScatLayerj1_f` (or :class:`ScatLayerj1_rot_f`
+    if h2o is not None) for when no gradients are needed.
+
+    The lowpass and magnitudes are written straight into their slices of the
+    output rather than being built up and concatenated, and nothing is kept
+    for a backward pass. The magnitudes are calculated in the dtype of x, so
+    this shouldn't be used for half precision inputs.
+
+    Inputs:
+        x (torch.tensor): input of shape (N, C, H, W). H and W must be even.
+        out (torch.tensor): optional output to write into. Should have shape
+            (N, 7*C, H/2, W/2), or (N, 9, H/2, W/2) if combine_colour is true.
+        fft (FFTj1): optional frequency domain level 1 transform to use instead
+            of the spatial filters.
+
+    Returns:
+        out (torch.tensor): the output
+    """
+    N, C, H, W = x.shape
+    assert H % 2 == W % 2 == 0
+    mode = int_to_mode(mode)
+    if combine_colour:
+        out = _check_out(out, (N, 9, H//2, W//2), x)
+        Z = out
+    else:
+        out = _check_out(out, (N, 7*C, H//2, W//2), x)
+        Z = out.view(N, 7, C, H//2, W//2)
+
+    ll, reals, imags = _fwd_j1(x, h0o, h1o, h2o, mode, fft)
+    if combine_colour:
+        _avg_pool2_into(ll, Z[:, :3])
+        _smooth_mag_into(reals, imags, bias, Z[:, 3:], True)
+    else:
+        _avg_pool2_into(ll, Z[:, 0])
+        _smooth_mag_into(reals, imags, bias, Z[:, 1:])
+
+    return out
+
+
+def scatj2_inference(x, h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b, mode,
+                     bias, combine_colour, out=None, fft=None):
+    """ Forward pass of :class:`ScatLayerj2_f` (or :class:`ScatLayerj2_rot_f`
+    if h2o is not None) for when no gradients are needed. See
+    :func:`scatj1_inference`.
+
+    Inputs:
+        x (torch.tensor): input of shape (N, C, H, W). H and W must be
+            multiples of 8.
+        out (torch.tensor): optional output to write into. Should have shape
+            (N, 49*C, H/4, W/4), or (N, 51, H/4, W/4) if combine_colour is
+            true.
+        fft (FFTj1): optional frequency domain level 1 transform.
+
+    Returns:
+        out (torch.tensor): the output
+    """
+    N, C, H, W = x.shape
+    assert H % 8 == W % 8 == 0
+    mode = int_to_mode(mode)
+    filts = (h0o, h1o, h2o, h0a, h0b, h1a, h1b, h2a, h2b)
+    h, w = H//4, W//4
+    if combine_colour:
+        out = _check_out(out, (N, 51, h, w), x)
+        Z = out
+    else:
+        out = _check_out(out, (N, 49*C, h, w), x)
+        Z = out.view(N, 49, C, h, w)
+
+    # First order scattering. The j=1 magnitudes overwrite the real part of
+    # the bandpasses as they are only needed for the second order
+    s0, reals, imags = _fwd_j1(x, h0o, h1o, h2o, mode, fft)
+    if combine_colour:
+        s1_j1 = reals[:, :, 0]
+        _smooth_mag_into(reals, imags, bias, s1_j1, True)
+    else:
+        s1_j1 = reals
+        _smooth_mag_into(reals, imags, bias, s1_j1)
+
+    s0, reals, imags = _fwd_level(s0, 2, filts, False, mode)
+    if combine_colour:
+        _avg_pool2_into(s0, Z[:, :3])
+        _smooth_mag_into(reals, imags, bias, Z[:, 9:15], True)
+    else:
+        _avg_pool2_into(s0, Z[:, 0])
+        _smooth_mag_into(reals, imags, bias, Z[:, 7:13])
+    del s0
+
+    # Second order scattering
+    if not combine_colour:
+        s1_j1 = s1_j1.reshape(N, 6*C, H//2, W//2)
+    ll, reals, imags = _fwd_j1(s1_j1, h0o, h1o, h2o, mode, fft)
+    del s1_j1
+    if combine_colour:
+        _avg_pool2_into(ll, Z[:, 3:9])
+        _smooth_mag_into(reals.view(N, 36, h, w), imags.view(N, 36, h, w),
+                         bias, Z[:, 15:])
+    else:
+        _avg_pool2_into(ll.view(N, 6, C, 2*h, 2*w), Z[:, 1:7])
+        _smooth_mag_into(reals.view(N, 36, C, h, w),
+                         imags.view(N, 36, C, h, w), bias, Z[:, 13:])
 
-        return (dX,) + (None,) * 12
+    return out
 
 
 def correct_phases(reals, imags, dim, inv=False):
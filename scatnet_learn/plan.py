@@ -0,0 +1,152 @@
+""" Execution plans for the scattering layers.
+
+The scattering layers are usually run on a small, fixed set of input shapes.
+Everything that only depends on the shape, dtype and device of the input, and
+on the layer's filters and padding mode, is worked out once and kept in a
+:class:`ScatPlan`. Each layer keeps the plans for the shapes it has seen in a
+:class:`PlanCache`.
+"""
+from __future__ import absolute_import
+from collections import OrderedDict
+
+import torch
+
+from scatnet_learn.lowlevel import suggest_format
+
+
+def _pad_sizes(n, multiple, centre):
+    """ Returns the number of samples to add before and after a signal of
+    length n to make its length a multiple of multiple. If centre is false,
+    all the padding goes at the end. """
+    rem = n % multiple
+    if rem == 0:
+        return 0, 0
+    if not centre:
+        return 0, multiple - rem
+    return (multiple - rem) // 2, (multiple + 1 - rem) // 2
+
+
+class ScatPlan(object):
+    """ The shape dependent state for running a scattering layer on inputs of
+    one shape, dtype, device and memory format.
+
+    Holds the filters already cast to the dtype and device, the padding to
+    apply to the input and a workspace for the padded input when no
+    gradients are needed.
+
+    The padding matches what the layers used to do with torch.cat: the input
+    is extended to a multiple of multiple by repeating its first and last
+    rows/columns (or only its last ones if centre is false) in order.
+
+    Inputs:
+        shape (tuple): input shape (N, C, H, W)
+        dtype (torch.dtype): the datatype the transform is done in
+        device (torch.device): the input device
+        memory_format (torch.memory_format): the memory format of the input
+        filts (sequence): the layer's filters. Can contain None for unused
+            filters.
+        multiple (int): the input height and width are padded to a multiple
+            of this
+        centre (bool): whether to split the padding between the start and the
+            end
+    """
+    def __init__(self, shape, dtype, device, memory_format, filts, multiple,
+                 centre=True):
+        N, C, H, W = shape
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.device = device
+        self.memory_format = memory_format
+        self.filts = tuple(None if h is None else
+                           h.detach().to(device=device, dtype=dtype)
+                           for h in filts)
+        self.rows = _pad_sizes(H, multiple, centre)
+        self.cols = _pad_sizes(W, multiple, centre)
+        self.padded_shape = (N, C, H + sum(self.rows), W + sum(self.cols))
+        self.needs_pad = self.padded_shape != self.shape
+        self._workspace = None
+
+    def pad(self, x, reuse=False):
+        """ Pads x to the planned size.
+
+        Inputs:
+            x (torch.tensor): input of the planned shape
+            reuse (bool): if true, the padded input is written into a
+                workspace kept by the plan, so is overwritten by the next
+                call. Only use this when the result isn't saved for a
+                backward pass.
+
+        Returns:
+            y (torch.tensor): the padded input. Is x if no padding is needed.
+        """
+        if not self.needs_pad:
+            return x
+        if reuse and self._workspace is not None:
+            y = self._workspace
+        else:
+            y = torch.empty(self.padded_shape, dtype=x.dtype,
+                            device=x.device, memory_format=self.memory_format)
+            if reuse:
+                self._workspace = y
+
+        H, W = self.shape[2:]
+        rb, ra = self.rows
+        cb, ca = self.cols
+        # Copy the input into the middle, then the rows, then the columns so
+        # the corners come from the padded rows
+        y[:, :, rb:rb+H, cb:cb+W].copy_(x)
+        if rb > 0:
+            y[:, :, :rb, cb:cb+W].copy_(x[:, :, :rb])
+        if ra > 0:
+            y[:, :, rb+H:, cb:cb+W].copy_(x[:, :, H-ra:])
+        if cb > 0:
+            y[:, :, :, :cb].copy_(y[:, :, :, cb:2*cb])
+        if ca > 0:
+            y[:, :, :, cb+W:].copy_(y[:, :, :, cb+W-ca:cb+W])
+        return y
+
+    def __repr__(self):
+        return 'ScatPlan(shape={}, padded_shape={}, dtype={}, device={})'.format(
+            self.shape, self.padded_shape, self.dtype, self.device)
+
+
+class PlanCache(object):
+    """ A least recently used cache of :class:`ScatPlan` objects, keyed by the
+    input shape, dtype, device and memory format. The filters and padding
+    mode are fixed for a layer, so each layer keeps its own cache.
+
+    Inputs:
+        maxsize (int): the number of plans to keep
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, x, dtype, build):
+        """ Returns the plan for x, calling build(shape, dtype, device,
+        memory_format) to make a new one if there isn't one cached. """
+        fmt = suggest_format(x)
+        key = (tuple(x.shape), dtype, x.device, fmt)
+        plan = self.plans.get(key)
+        if plan is None:
+            self.misses += 1
+            plan = build(tuple(x.shape), dtype, x.device, fmt)
+            self.plans[key] = plan
+            if len(self.plans) > self.maxsize:
+                self.plans.popitem(last=False)
+        else:
+            self.hits += 1
+            self.plans.move_to_end(key)
+        return plan
+
+    def clear(self):
+        self.plans.clear()
+
+    def __len__(self):
+        return len(self.plans)
+
+    def __repr__(self):
+        return 'PlanCache(size={}/{}, hits={}, misses={})'.format(
+            len(self.plans), self.maxsize, self.hits, self.misses)
@@ -0,0 +1,186 @@
+""" Tiled scattering of images too large to transform in one go.
+
+The input is split into overlapping tiles. Each tile is run through the
+layer's normal forward pass and the outputs are cropped and stitched back
+together. The halo around each tile is sized from the support of the layer's
+filters and its number of scales, so the stitched output is the same as
+transforming the whole image, while the peak memory only depends on the tile
+size.
+"""
+from __future__ import absolute_import
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+from scatnet_learn.layers import ScatLayerj1, ScatLayerj2, ScatLayerJ
+from scatnet_learn.plan import _pad_sizes
+
+
+Window = namedtuple('Window', ['rows', 'cols', 'out_rows', 'out_cols',
+                               'crop_rows', 'crop_cols'])
+Window.__doc__ = """ One tile of a tiled transform. rows and cols are the
+slices of the (padded) input to transform, crop_rows and crop_cols the part of
+the tile's output to keep, and out_rows and out_cols where it goes in the
+full output. """
+
+
+def _round_up(n, m):
+    return -(-n // m) * m
+
+
+def _geometry(layer):
+    """ Returns the number of DTCWT levels, the output stride, and the
+    multiple the layer pads its input to along with whether that padding is
+    centred. """
+    if isinstance(layer, ScatLayerj1):
+        return 1, 2, 2, False
+    elif isinstance(layer, ScatLayerj2):
+        return max(layer.J, 2), 2**layer.J, 8, True
+    elif isinstance(layer, ScatLayerJ):
+        return layer.J, 2**layer.J, 2**layer.J, True
+    raise TypeError('Can only tile ScatLayerj1, ScatLayerj2 and ScatLayerJ '
+                    'layers, got {}'.format(type(layer).__name__))
+
+
+def halo_size(layer):
+    """ Returns the number of input pixels a tile needs either side of it for
+    the layer's output to be unaffected by the tile edges.
+
+    Each level of the DTCWT at input stride s is assumed to depend on the
+    samples within (L + 2)s of its output, where L is the longest filter
+    length. Summed over the levels, plus the final averaging, this is a
+    slightly conservative bound on the support of every scattering path. """
+    J, stride, multiple, _ = _geometry(layer)
+    L = max(h.numel() for h in (
+        getattr(layer, name, None) for name in (
+            'h0o', 'h1o', 'h2o', 'h0a', 'h0b', 'h1a', 'h1b', 'h2a', 'h2b'))
+        if h is not None)
+    halo = (L + 2) * (2**J - 1) + stride
+    return _round_up(halo, max(stride, multiple))
+
+
+def _pad_map(n, multiple, centre):
+    """ Maps each row of the padded input to the row of the input it is a
+    copy of, for the padding the layers do (see :class:`ScatPlan`). """
+    before, after = _pad_sizes(n, multiple, centre)
+    return np.concatenate((np.arange(before), np.arange(n),
+                           np.arange(n - after, n)))
+
+
+class TiledScat(object):
+    """ Runs a scattering layer over a large image tile by tile.
+
+    The output is the same as calling the layer on the whole image, but only
+    one tile (plus its halo) and its output are on the layer's device at any
+    time. As this is for inference, no gradients are calculated.
+
+    Inputs:
+        layer (nn.Module): a :class:`ScatLayerj1`, :class:`ScatLayerj2` or
+            :class:`ScatLayerJ`
+        tile (int): the size of the tiles, not counting the halo. Is rounded
+            up to a multiple of the layer's alignment.
+        halo (int): the overlap added to each side of a tile. By default is
+            :func:`halo_size` of the layer. Smaller values use less memory
+            but the output will no longer match the untiled layer.
+    """
+    def __init__(self, layer, tile=512, halo=None):
+        self.layer = layer
+        self.J, self.stride, self.multiple, self.centre = _geometry(layer)
+        # Tiles must start at multiples of the output stride to keep the
+        # decimation phase, and be a multiple of the layer's padding size so
+        # the layer doesn't pad them again
+        self.align = max(self.stride, self.multiple)
+        self.tile = _round_up(tile, self.align)
+        if halo is None:
+            halo = halo_size(layer)
+        self.halo = _round_up(halo, self.align)
+
+    def padded_shape(self, shape):
+        """ The size the layer pads an input of the given shape to. """
+        N, C, H, W = shape
+        return (N, C, len(_pad_map(H, self.multiple, self.centre)),
+                len(_pad_map(W, self.multiple, self.centre)))
+
+    def windows(self, shape):
+        """ Yields the :class:`Window` of each tile, in row major order, for an
+        input of the given shape. The input slices are into the padded
+        input. """
+        _, _, H, W = self.padded_shape(shape)
+        s = self.stride
+
+        def split(n):
+            for a in range(0, n, self.tile):
+                b = min(a + self.tile, n)
+                a0, b0 = max(0, a - self.halo), min(n, b + self.halo)
+                yield (slice(a0, b0), slice(a // s, b // s),
+                       slice((a - a0) // s, (b - a0) // s))
+
+        for rows, out_rows, crop_rows in split(H):
+            for cols, out_cols, crop_cols in split(W):
+                yield Window(rows, cols, out_rows, out_cols, crop_rows,
+                             crop_cols)
+
+    def _read(self, x, w, rmap, cmap):
+        """ Reads the tile w from x, doing the layer's padding at the image
+        borders. Only the rows and columns needed are read, so x can be a
+        memory mapped array. """
+        ri, ci = rmap[w.rows], cmap[w.cols]
+        r0, c0 = ri.min(), ci.min()
+        block = x[:, :, r0:ri.max()+1, c0:ci.max()+1]
+        if isinstance(block, torch.Tensor):
+            ri = torch.from_numpy(ri - r0).to(block.device)
+            ci = torch.from_numpy(ci - c0).to(block.device)
+            return block.index_select(2, ri).index_select(3, ci)
+        return torch.from_numpy(
+            np.ascontiguousarray(block[:, :, ri - r0][:, :, :, ci - c0]))
+
+    def __call__(self, x, shape=None, out=None):
+        """ Does the tiled scattering.
+
+        Inputs:
+            x: the input of shape (N, C, H, W). Can be a torch tensor, a numpy
+                array or memmap, or an iterable of input tiles in the order
+                given by :meth:`windows`, in which case shape must be given
+                and H and W must not need padding.
+            shape (tuple): the input shape, needed if x is an iterable
+            out: optional torch tensor or numpy array (e.g. a memmap) to write
+                the output into.
+
+        Returns:
+            out: the output, the same as self.layer(x)
+        """
+        if shape is None:
+            shape = tuple(x.shape)
+        N, C, H, W = shape
+        padded = self.padded_shape(shape)
+        tiles = None
+        if not (isinstance(x, (torch.Tensor, np.ndarray))):
+            if padded != tuple(shape):
+                raise ValueError(
+                    'Tiles can only be given for inputs that need no '
+                    'padding, i.e. of size {}'.format(padded[2:]))
+            tiles = iter(x)
+        rmap = _pad_map(H, self.multiple, self.centre)
+        cmap = _pad_map(W, self.multiple, self.centre)
+
+        p = next(self.layer.parameters())
+        with torch.no_grad():
+            for w in self.windows(shape):
+                t = next(tiles) if tiles is not None else \
+                    self._read(x, w, rmap, cmap)
+                t = torch.as_tensor(t).to(device=p.device, dtype=p.dtype)
+                z = self.layer(t)[:, :, w.crop_rows, w.crop_cols]
+                if out is None:
+                    out = z.new_empty(
+                        (N, z.shape[1], padded[2] // self.stride,
+                         padded[3] // self.stride), device='cpu')
+                if isinstance(out, torch.Tensor):
+                    out[:, :, w.out_rows, w.out_cols] = z.to(out.device)
+                else:
+                    out[:, :, w.out_rows, w.out_cols] = z.cpu().numpy()
+        return out
+
+    def __repr__(self):
+        return 'TiledScat({}, tile={}, halo={})'.format(
+            type(self.layer).__name__, self.tile, self.halo)
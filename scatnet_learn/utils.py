@@ -2,6 +2,8 @@ import os
 import hashlib
 from six.moves import urllib
 import numpy as np
+import torch
+import torch.distributed as dist
 import sys
 
 
@@ -93,3 +95,57 @@ def convert_to_one_hot(vector, num_classes=None):
             result = np.split(result, len(result))
             result = [np.squeeze(x) for x in result]
         return result
+
+
+def shard(dataset):
+    """ Returns every world_size'th item of the dataset, starting at this
+    process's rank. Unlike a DistributedSampler, no items are repeated to make
+    the shards the same size, so metrics summed over the shards are exact. """
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    return torch.utils.data.Subset(
+        dataset, np.arange(rank, len(dataset), world_size))
+
+
+# The per class orders made by stratified_indices, keyed by the hash of the
+# labels and the seed
+_class_orders = {}
+
+
+def stratified_indices(labels, size, seed=0):
+    """ Picks a training subset with the same number of samples from each
+    class.
+
+    Each class's samples are put in a random order drawn from seed and the
+    first size // num_classes of each are taken, so the subsets for a seed
+    are nested: a smaller size gives a subset of a larger one. The orders are
+    cached in memory by the hash of the labels, so sweeping over sizes only
+    costs a slice each.
+
+    Args:
+        labels (sequence): the label of every sample, e.g. dataset.targets
+        size (int): the size of the subset. Is rounded down to a multiple of
+            the number of classes.
+        seed (int): the seed for the choice of samples
+
+    Returns:
+        idx (ndarray): the sorted indices of the subset, for a Subset
+    """
+    labels = np.asarray(labels)
+    key = (hashlib.sha1(labels.tobytes()).hexdigest(), labels.dtype.str,
+           len(labels), seed)
+    if key not in _class_orders:
+        rng = np.random.RandomState(seed)
+        by_class = np.argsort(labels, kind='stable')
+        counts = np.unique(labels, return_counts=True)[1]
+        _class_orders[key] = [rng.permutation(idx) for idx in
+                              np.split(by_class, np.cumsum(counts)[:-1])]
+    orders = _class_orders[key]
+    per_class = size // len(orders)
+    smallest = min(len(o) for o in orders)
+    if not 0 < per_class <= smallest:
+        raise ValueError(
+            'Can only take 1 to {} samples from each of the {} classes, a '
+            'size of {} to {}. Got {}'.format(
+                smallest, len(orders), len(orders), smallest * len(orders),
+                size))
+    return np.sort(np.concatenate([o[:per_class] for o in orders]))
@@ -0,0 +1,339 @@
+""" Benchmarks the scattering layers.
+
+Times the forward and backward passes of each layer separately over a sweep
+of batch sizes, channels and spatial sizes, and records the peak resident
+memory and the size of the activations saved for the backward pass. Each
+configuration is run in its own subprocess so the peak RSS of one doesn't
+hide the next. Runs on the cpu by default, so it can be used on any machine.
+The results are written as JSON so runs on different commits can be
+compared with --compare.
+
+--backend and --autocast take several values. With both backends, the
+spatial and fft times of the layers that have an fft backend are compared
+over the size sweep, and the smallest size at which fft is faster is
+reported. With several autocast modes, the times and saved activations of
+each mode are compared with float32.
+
+Example::
+
+    python tests/benchmark.py -o before.json
+    git checkout my-branch
+    python tests/benchmark.py -o after.json --compare before.json
+
+    python tests/benchmark.py --cases 'ScatLayerj[12]$' -s 32 64 128 256 512 \\
+        --backend spatial fft --autocast off bf16
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from scatnet_learn.layers import ScatLayerj1, ScatLayerj1a, ScatLayerj2
+from scatnet_learn.layers import ScatLayerj2_corners, InvariantLayerj1
+
+ALPHAS = [None, 'impulse', 'smooth', 'random', 'full', 'dct']
+# The cases that take the backend keyword. The others are only run with the
+# spatial backend
+BACKEND_CASES = ('ScatLayerj1', 'ScatLayerj1_rot', 'ScatLayerj2',
+                 'ScatLayerj2_rot')
+
+# Each case makes its layer from the number of input channels and the extra
+# keyword arguments for ScatLayerj1/j2 (e.g. backend)
+CASES = OrderedDict([
+    ('ScatLayerj1', lambda C, kw: ScatLayerj1(**kw)),
+    ('ScatLayerj1_rot', lambda C, kw: ScatLayerj1(biort='near_sym_b_bp',
+                                                  **kw)),
+    ('ScatLayerj1a', lambda C, kw: ScatLayerj1a()),
+    ('ScatLayerj2', lambda C, kw: ScatLayerj2(**kw)),
+    ('ScatLayerj2_rot', lambda C, kw: ScatLayerj2(
+        biort='near_sym_b_bp', qshift='qshift_b_bp', **kw)),
+    ('ScatLayerj2_corners', lambda C, kw: ScatLayerj2_corners()),
+] + [
+    ('InvariantLayerj1_{}'.format(alpha),
+     (lambda a: lambda C, kw: InvariantLayerj1(C, alpha=a))(alpha))
+    for alpha in ALPHAS
+])
+
+parser = argparse.ArgumentParser('Benchmark the scattering layers')
+parser.add_argument('-o', '--output', type=str, default=None,
+                    help='JSON file to write the results to')
+parser.add_argument('--compare', type=str, default=None,
+                    help='JSON file from a previous run to compare against')
+parser.add_argument('--cases', type=str, default='.*',
+                    help='regex of the cases to run. Can be any of: ' +
+                         ', '.join(CASES))
+parser.add_argument('--batch', type=int, nargs='+', default=[8],
+                    help='batch sizes to test')
+parser.add_argument('-C', '--channels', type=int, nargs='+', default=[3, 16],
+                    help='numbers of input channels to test')
+parser.add_argument('-s', '--size', type=int, nargs='+', default=[32, 64, 128],
+                    help='spatial sizes to test')
+parser.add_argument('--device', default='cpu', choices=['cpu', 'cuda'],
+                    help='which device to test')
+parser.add_argument('--threads', type=int, default=None,
+                    help='number of cpu threads. Defaults to the torch '
+                         'default')
+parser.add_argument('--warmup', type=int, default=2,
+                    help='untimed iterations before timing')
+parser.add_argument('--repeat', type=int, default=10,
+                    help='timed iterations. The median is reported')
+parser.add_argument('--backend', nargs='+', default=['spatial'],
+                    choices=['spatial', 'fft'],
+                    help='backends for ScatLayerj1 and ScatLayerj2. Give '
+                         'both to find where fft becomes faster')
+parser.add_argument('--autocast', nargs='+', default=['off'],
+                    choices=['off', 'bf16', 'fp16'],
+                    help='run the layers under torch.autocast with these '
+                         'dtypes. Give several to compare them')
+parser.add_argument('--worker', type=str, default=None,
+                    help=argparse.SUPPRESS)
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MiB. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    if sys.platform == 'darwin':
+        return rss / 2**20
+    return rss / 2**10
+
+
+def run_case(cfg):
+    """ Times one configuration. Is run in a fresh process. """
+    if cfg['threads'] is not None:
+        torch.set_num_threads(cfg['threads'])
+    dev = cfg['device']
+    base_rss = peak_rss_mb()
+    kw = {'backend': cfg['backend']} if cfg['backend'] != 'spatial' else {}
+    layer = CASES[cfg['case']](cfg['C'], kw).to(dev)
+    x = torch.randn(cfg['batch'], cfg['C'], cfg['size'], cfg['size'],
+                    device=dev, requires_grad=True)
+    dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(
+        cfg['autocast'])
+
+    def sync():
+        if dev == 'cuda':
+            torch.cuda.synchronize()
+
+    def fwd():
+        with torch.autocast(dev, dtype=dtype, enabled=(dtype is not None)):
+            return layer(x)
+
+    fwd_t, bwd_t, inf_t = [], [], []
+    for i in range(cfg['warmup'] + cfg['repeat']):
+        sync()
+        t0 = time.perf_counter()
+        y = fwd()
+        sync()
+        t1 = time.perf_counter()
+        y.backward(torch.ones_like(y))
+        sync()
+        t2 = time.perf_counter()
+        with torch.no_grad():
+            fwd()
+        sync()
+        t3 = time.perf_counter()
+        if i >= cfg['warmup']:
+            fwd_t.append(t1 - t0)
+            bwd_t.append(t2 - t1)
+            inf_t.append(t3 - t2)
+        x.grad = None
+        del y
+
+    # Count the bytes saved for the backward pass in an untimed pass. Works
+    # on the cpu too, as it doesn't rely on the cuda allocator
+    saved = []
+
+    def pack(t):
+        saved.append(t.numel() * t.element_size())
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        y = fwd()
+    del y
+
+    return {
+        'saved_mb': sum(saved) / 2**20,
+        'fwd_ms': 1000 * float(np.median(fwd_t)),
+        'bwd_ms': 1000 * float(np.median(bwd_t)),
+        'inference_ms': 1000 * float(np.median(inf_t)),
+        'peak_rss_mb': peak_rss_mb(),
+        'base_rss_mb': base_rss,
+    }
+
+
+def spawn(cfg):
+    """ Runs a configuration in a subprocess and returns its results. """
+    p = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker',
+         json.dumps(cfg)], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    res = dict(cfg)
+    if p.returncode != 0:
+        res['error'] = p.stderr.strip().split('\n')[-1]
+    else:
+        res.update(json.loads(p.stdout.strip().split('\n')[-1]))
+    return res
+
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'threads': args.threads or torch.get_num_threads(),
+        'device': args.device,
+        'backend': args.backend,
+        'autocast': args.autocast,
+        'warmup': args.warmup,
+        'repeat': args.repeat,
+    }
+
+
+def _key(r):
+    # Results from before several backends and dtypes could be run in one go
+    # only had one of each
+    return (r['case'], r['batch'], r['C'], r['size'],
+            r.get('backend', 'spatial'), r.get('autocast', 'off'))
+
+
+def _total_ms(r):
+    return r['fwd_ms'] + r['bwd_ms']
+
+
+def crossover(results):
+    """ Prints the spatial and fft forward + backward times of each layer
+    with both, and the smallest size at which fft is faster. """
+    times = {_key(r): _total_ms(r) for r in results if 'error' not in r}
+    groups = OrderedDict()
+    for case, N, C, sz, backend, amp in times:
+        groups.setdefault((case, N, C, amp), []).append(sz)
+    print('\nSpatial vs fft backend (fwd + bwd):')
+    for (case, N, C, amp), sizes in groups.items():
+        sizes = sorted(sz for sz in set(sizes)
+                       if (case, N, C, sz, 'spatial', amp) in times and
+                       (case, N, C, sz, 'fft', amp) in times)
+        if not sizes:
+            continue
+        print('{} N={} C={} autocast={}:'.format(case, N, C, amp))
+        for sz in sizes:
+            print('  {:>5}: spatial {:8.2f}ms fft {:8.2f}ms'.format(
+                sz, times[case, N, C, sz, 'spatial', amp],
+                times[case, N, C, sz, 'fft', amp]))
+        faster = [sz for sz in sizes if times[case, N, C, sz, 'fft', amp] <
+                  times[case, N, C, sz, 'spatial', amp]]
+        if faster:
+            print('  fft is faster from size {}'.format(faster[0]))
+        else:
+            print('  fft is not faster for any size tested')
+
+
+def precision(results):
+    """ Prints the forward + backward time and saved activations of each
+    autocast mode relative to float32. """
+    res = {_key(r): r for r in results if 'error' not in r}
+    print('\nAutocast vs float32 (fwd + bwd time, saved activations):')
+    for key, r in res.items():
+        amp = key[-1]
+        base = res.get(key[:-1] + ('off',))
+        if amp == 'off' or base is None:
+            continue
+        print('{:<28} N={:<3} C={:<3} {:>4} {:<7} {}: time {:8.2f}ms '
+              '({:.2f}x) saved {:7.1f}MiB ({:.2f}x)'.format(
+                  key[0], key[1], key[2], key[3], key[4], amp,
+                  _total_ms(r), _total_ms(r) / _total_ms(base),
+                  r['saved_mb'], r['saved_mb'] / max(base['saved_mb'],
+                                                     1e-9)))
+
+
+def compare(results, base):
+    """ Prints the ratio of the new times to the old ones. """
+    old = {_key(r): r for r in base['results']}
+    print('\nCompared to {} (new/old, <1 is faster):'.format(
+        base['meta'].get('commit')))
+    for r in results:
+        o = old.get(_key(r))
+        if o is None or 'error' in r or 'error' in o:
+            continue
+        print('{:<28} N={:<3} C={:<3} {:>4} {:<7} {:<4}: fwd {:.2f} '
+              'bwd {:.2f} inference {:.2f} rss {:.2f}'.format(
+                  r['case'], r['batch'], r['C'], r['size'], _key(r)[4],
+                  _key(r)[5],
+                  r['fwd_ms'] / o['fwd_ms'], r['bwd_ms'] / o['bwd_ms'],
+                  r['inference_ms'] / o['inference_ms'],
+                  r['peak_rss_mb'] / o['peak_rss_mb']))
+
+
+def _print(r):
+    name = '{:<28} N={:<3} C={:<3} {:>4} {:<7} {:<4}'.format(
+        r['case'], r['batch'], r['C'], r['size'], r['backend'],
+        r['autocast'])
+    if 'error' in r:
+        print('{}: failed: {}'.format(name, r['error']))
+    else:
+        print('{}: fwd {:8.2f}ms bwd {:8.2f}ms inference {:8.2f}ms peak rss '
+              '{:7.1f}MiB saved {:7.1f}MiB'.format(
+                  name, r['fwd_ms'], r['bwd_ms'], r['inference_ms'],
+                  r['peak_rss_mb'], r['saved_mb']))
+
+
+def main(args):
+    cases = [c for c in CASES if re.search(args.cases, c)]
+    results = []
+    for case in cases:
+        backends = args.backend if case in BACKEND_CASES else ['spatial']
+        for backend in backends:
+            for amp in args.autocast:
+                for N in args.batch:
+                    for C in args.channels:
+                        for sz in args.size:
+                            r = spawn({
+                                'case': case, 'batch': N, 'C': C,
+                                'size': sz, 'device': args.device,
+                                'threads': args.threads,
+                                'warmup': args.warmup,
+                                'repeat': args.repeat, 'backend': backend,
+                                'autocast': amp})
+                            results.append(r)
+                            _print(r)
+
+    out = {'meta': metadata(args), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
+    if len(args.backend) > 1:
+        crossover(results)
+    if len(args.autocast) > 1:
+        precision(results)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return out
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.worker is not None:
+        print(json.dumps(run_case(json.loads(args.worker))))
+    else:
+        main(args)
@@ -0,0 +1,99 @@
+""" Benchmarks the throughput of the cifar loaders.
+
+Compares the default path of cifar.get_data, which loads, converts to PIL
+and transforms each image separately, with the batched path, which gathers
+whole uint8 batches from a memory map (see scatnet_learn.data.packed) and
+transforms them at once. Both give normalized float batches. The first run
+packs the dataset into --pack_dir. Use --perturb to time the augmentation
+too.
+
+Example::
+
+    python tests/benchmark_loader.py /scratch/share/cifar --num_workers 0 4
+"""
+import argparse
+import time
+
+import numpy as np
+
+from scatnet_learn.data import cifar, packed
+
+parser = argparse.ArgumentParser('Benchmark the cifar loaders')
+parser.add_argument('data_dir', type=str,
+                    help='directory with the cifar python files')
+parser.add_argument('--dataset', default='cifar10',
+                    choices=['cifar10', 'cifar100'])
+parser.add_argument('--pack_dir', type=str, default=None,
+                    help='where to write the packed dataset. Defaults to '
+                         'data_dir/<dataset>_packed')
+parser.add_argument('--batch_size', type=int, default=128)
+parser.add_argument('--num_workers', type=int, nargs='+', default=[0],
+                    help='numbers of loader workers to test')
+parser.add_argument('--epochs', type=int, default=2,
+                    help='epochs to time. The first is also timed, as the '
+                         'page cache is part of the cost')
+parser.add_argument('--perturb', action='store_true',
+                    help='time the loaders with random crops and flips')
+parser.add_argument('--loaders', type=str, nargs='+',
+                    default=['torchvision', 'packed'],
+                    choices=['torchvision', 'packed'])
+
+
+def torchvision_loader(args, num_workers):
+    trainloader, _ = cifar.get_data(
+        32, args.data_dir, args.dataset, args.batch_size, perturb=args.perturb,
+        pin_memory=False, num_workers=num_workers)
+    return trainloader
+
+
+def packed_loader(args, num_workers):
+    trainloader, _ = cifar.get_data(
+        32, args.data_dir, args.dataset, args.batch_size, perturb=args.perturb,
+        pin_memory=False, num_workers=num_workers, batched=True,
+        pack_dir=args.pack_dir)
+    return trainloader
+
+
+LOADERS = {
+    'torchvision': torchvision_loader,
+    'packed': packed_loader,
+}
+
+
+def run(args):
+    if 'packed' in args.loaders:
+        # Pack before timing anything
+        t0 = time.perf_counter()
+        packed.pack_cifar(args.data_dir, args.dataset, args.pack_dir)
+        print('Packing took {:.1f}s (0 if already packed)\n'.format(
+            time.perf_counter() - t0))
+
+    results = {}
+    for name in args.loaders:
+        for num_workers in args.num_workers:
+            loader = LOADERS[name](args, num_workers)
+            rates = []
+            for epoch in range(args.epochs):
+                if hasattr(loader.sampler, 'set_epoch'):
+                    loader.sampler.set_epoch(epoch)
+                n = 0
+                t0 = time.perf_counter()
+                for x, y in loader:
+                    n += len(y)
+                rates.append(n / (time.perf_counter() - t0))
+            results[(name, num_workers)] = rates
+            print('{:<12} workers={:<2} images/s: {}'.format(
+                name, num_workers,
+                ' '.join('{:9.0f}'.format(r) for r in rates)))
+
+    if 'torchvision' in args.loaders and 'packed' in args.loaders:
+        print()
+        for num_workers in args.num_workers:
+            speedup = np.median(results[('packed', num_workers)]) / \
+                np.median(results[('torchvision', num_workers)])
+            print('workers={:<2} packed speedup: {:.1f}x'.format(
+                num_workers, speedup))
+
+
+if __name__ == "__main__":
+    run(parser.parse_args())
@@ -0,0 +1,177 @@
+""" Pytest options for the performance regression tests in test_perf.py.
+
+The perf tests are skipped unless pytest is run with --perf, in which case
+each timing is compared to the one stored in perf_baseline.json and the test
+fails if it is slower by more than the case's tolerance, or has no baseline.
+The baselines are for one reference machine, and --perf stops with an error
+on any other, rather than passing without comparing anything. Run with
+--perf-update to time the cases and overwrite the baselines, e.g. after a
+deliberate change or on a new reference machine::
+
+    pytest tests/test_perf.py --perf
+    pytest tests/test_perf.py --perf-update
+"""
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import pytest
+import torch
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'perf_baseline.json')
+# Allowed slowdown, as a fraction of the baseline time, for cases that don't
+# have their own tolerance in the baseline file
+DEFAULT_TOLERANCE = 0.2
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('perf')
+    group.addoption('--perf', action='store_true',
+                    help='run the performance regression tests')
+    group.addoption('--perf-update', action='store_true',
+                    help='run the performance tests and overwrite the '
+                         'baselines with the new timings')
+    group.addoption('--perf-baseline', default=BASELINE,
+                    help='baseline file to compare against')
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'perf: performance regression test, only run with --perf '
+                   'or --perf-update')
+    if config.getoption('--perf') or config.getoption('--perf-update'):
+        config._perf = PerfBaseline(config.getoption('--perf-baseline'),
+                                    config.getoption('--perf-update'))
+        # Don't let the gate pass by skipping everything
+        if not config._perf.update:
+            if not config._perf.cases:
+                raise pytest.UsageError(
+                    'No perf baselines in {}. Record them on the reference '
+                    'machine with --perf-update'.format(config._perf.path))
+            if config._perf.machine != machine():
+                raise pytest.UsageError(
+                    'The perf baselines in {} were recorded on a different '
+                    'machine:\n  baseline: {}\n  this:     {}\nRun on the '
+                    'reference machine, or refresh them here with '
+                    '--perf-update'.format(config._perf.path,
+                                           config._perf.machine, machine()))
+    else:
+        config._perf = None
+
+
+def pytest_collection_modifyitems(config, items):
+    if config._perf is not None:
+        return
+    skip = pytest.mark.skip(reason='needs --perf or --perf-update')
+    for item in items:
+        if 'perf' in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    perf = getattr(session.config, '_perf', None)
+    if perf is not None and perf.update:
+        perf.save()
+
+
+def _cpu_model():
+    """ Returns the cpu's model name, or the architecture if it can't be
+    found. """
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def machine():
+    """ Describes the machine the timings were taken on. Baselines from a
+    different machine aren't compared against. Only the hardware and the
+    torch version are used, so e.g. a kernel update doesn't invalidate the
+    baselines. """
+    return {
+        'system': platform.system(),
+        'processor': _cpu_model(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__.split('+')[0],
+    }
+
+
+class PerfBaseline(object):
+    """ The stored timings, and the new ones when updating. """
+    def __init__(self, path, update):
+        self.path = path
+        self.update = update
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+        else:
+            data = {}
+        self.machine = data.get('machine')
+        self.cases = data.get('cases', {})
+        if update and self.machine != machine():
+            # Timings from another machine are meaningless here, but keep
+            # the per case tolerances
+            for case in self.cases.values():
+                case.pop('ms', None)
+
+    def check(self, name, ms):
+        """ Records a timing when updating, otherwise compares it to the
+        baseline and fails the test if it is too slow. """
+        if self.update:
+            case = self.cases.setdefault(name, {})
+            case['ms'] = round(ms, 4)
+            return
+        if 'ms' not in self.cases.get(name, {}):
+            pytest.fail('no baseline for {}, record it with '
+                        '--perf-update'.format(name), pytrace=False)
+        case = self.cases[name]
+        tol = case.get('tolerance', DEFAULT_TOLERANCE)
+        change = ms / case['ms'] - 1
+        if change > tol:
+            pytest.fail(
+                '{} has slowed down:\n'
+                '  baseline: {:9.3f}ms\n'
+                '  now:      {:9.3f}ms\n'
+                '  change:   {:+8.1f}% (tolerance {:.0f}%)\n'
+                'If this is expected, refresh the baselines with '
+                '--perf-update'.format(name, case['ms'], ms, 100 * change,
+                                       100 * tol), pytrace=False)
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'machine': machine(), 'cases': self.cases}, f,
+                      indent=2, sort_keys=True)
+            f.write('\n')
+
+
+@pytest.fixture
+def perf(request):
+    """ Returns a function perf(name, fn) that times fn and checks it against
+    the baseline for '<test id>::<name>'. The timing is the median over
+    several runs on a single thread to keep it stable. """
+    baseline = request.config._perf
+    if baseline is None:
+        pytest.skip('needs --perf or --perf-update')
+
+    def check(name, fn, warmup=3, repeat=15):
+        threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            for _ in range(warmup):
+                fn()
+            times = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - t0)
+        finally:
+            torch.set_num_threads(threads)
+        baseline.check('{}::{}'.format(request.node.name, name),
+                       1000 * float(np.median(times)))
+    return check
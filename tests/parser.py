@@ -1,86 +1,121 @@
-# coding: utf-8
-import pandas as pd
-import numpy as np
+""" Aggregates a Chrome trace written by torch.profiler (e.g. by profile.py).
+
+Prints the self time of each op, and the self time spent in each stage of the
+scattering (fwd_j1, fwd_j2plus, magnitude, pooling, inv_j1, inv_j2plus ...),
+split into the forward and backward passes. The stages are the
+'scat::<stage>' ranges profile.py labels the trace with. Ops outside of any
+stage, e.g. the gradient products and torch.cat, are counted as 'other'.
+
+Example::
+
+    python tests/profile.py ScatLayerj2 -o trace.json
+    python tests/parser.py trace.json
+"""
 import argparse
-from io import StringIO
-parser = argparse.ArgumentParser(description='Prof parser')
-parser.add_argument('file', type=str)
-
-# Strip the whitespace on reading
-def strip(text):
-    try:
-        return text.strip()
-    except AttributeError:
-        return text
-
-def convert(x):
-    if x[-2:] == 'ms':
-        x = float(x[:-2])
-    elif x[-2:] == 'us':
-        x = 0.001 * float(x[:-2])
-    elif x[-2:] == 'ns':
-        x = 1e-6 * float(x[:-2])
-    elif x[-1] == 's':
-        x = 1000 * float(x[:-1])
-    return x
-
-def convert_timep(x):
-    return float(x[:-1])
-
-
-def pandify(data):
-    names = ['Type', 'Time (%)', 'Time (ms)', 'Calls', 'Avg', 'Min', 'Max',
-             'Name']
-    convs = {i: strip for i in range(8)}
-    df = pd.read_csv(StringIO(data), names=names, skiprows=0, sep=';',
-                     converters=convs)
-    df.loc[df.loc[:,'Type'] == '', 'Type'] = np.NaN
-    df = df.fillna(method='ffill')
-    df['Time (ms)'] = df['Time (ms)'].apply(convert)
-    df['Time (%)'] = df['Time (%)'].apply(convert_timep)
-    df['Calls'] = df['Calls'].apply(int)
-    df1 = df[df['Type'] == 'GPU activities:']
-    df2 = df[df['Type'] == 'API calls:']
-    idx = df1.Name.str.contains('CUDA memcpy')
-    s1 = pd.Series({'Type': 'Total:',
-                    'Time (%)': df1['Time (%)'].sum(),
-                    'Time (ms)': df1['Time (ms)'].sum(),
-                    'Calls': df1['Calls'].sum(),
-                    'Avg': '', 'Min': '', 'Max': '', 'Name': ''})
-    s2 = pd.Series({'Type': 'Total (no mem):',
-                    'Time (%)': df1.loc[~idx, 'Time (%)'].sum(),
-                    'Time (ms)': df1.loc[~idx, 'Time (ms)'].sum(),
-                    'Calls': df1.loc[~idx, 'Calls'].sum(),
-                    'Avg': '', 'Min': '', 'Max': '', 'Name': ''})
-    s3 = pd.Series({'Type': 'Total:',
-                    'Time (%)': df2['Time (%)'].sum(),
-                    'Time (ms)': df2['Time (ms)'].sum(),
-                    'Calls': df2['Calls'].sum(),
-                    'Avg': '', 'Min': '', 'Max': '', 'Name': ''})
-
-    df3 = pd.concat([df1, pd.concat([s1, s2], axis=1).T,
-                     df2, pd.concat([s3,], axis=1).T],
-                    ignore_index=True, axis=0)
-    return df3
-
-
-def prep_file(file):
-    with open(file, 'r') as f:
-        data = f.readlines()
-
-    header = data[0].split('command: ')[1]
-    for i, l in enumerate(data):
-        if i >= 3:
-            data[i] = ';'.join([l[:16], l[17:25], l[26:35], l[36:45],
-                              l[46:55], l[56:65], l[66:75], l[76:]])
-    data = ''.join(data[4:])
-    return data, header
+import json
+from collections import defaultdict
+
+parser = argparse.ArgumentParser(description='torch.profiler trace parser')
+parser.add_argument('file', type=str, help='chrome trace json file')
+parser.add_argument('-n', '--top', type=int, default=25,
+                    help='number of ops to show')
+
+STAGE_PREFIX = 'scat::'
+# Ops that are always part of a stage, even when not inside a labelled range
+OP_STAGES = {
+    'aten::avg_pool2d': 'pooling',
+    'aten::avg_pool2d_backward': 'pooling',
+    'aten::upsample_nearest2d': 'pooling',
+    'aten::upsample_nearest2d_backward': 'pooling',
+    'aten::max_pool2d_with_indices': 'pooling',
+    'aten::max_pool2d_with_indices_backward': 'pooling',
+}
+
+
+def load_events(file):
+    """ Returns the complete ('X') events of the cpu ops and the user
+    annotations of a trace. """
+    with open(file) as f:
+        trace = json.load(f)
+    events = trace['traceEvents'] if isinstance(trace, dict) else trace
+    return [e for e in events if e.get('ph') == 'X' and
+            e.get('cat') in ('cpu_op', 'user_annotation', 'python_function')
+            and 'dur' in e]
+
+
+def self_times(events):
+    """ Works out the self time of each event, i.e. its duration minus that
+    of its children, along with its stage and whether it is in the backward
+    pass.
+
+    Returns:
+        rows (list): of (name, self time in us, stage, backward)
+    """
+    by_thread = defaultdict(list)
+    for e in events:
+        by_thread[(e.get('pid'), e.get('tid'))].append(e)
+
+    rows = []
+    for evs in by_thread.values():
+        # Parents start before (or with, and last longer than) their children
+        evs.sort(key=lambda e: (e['ts'], -e['dur']))
+        # The stack holds [event, child time, stage, backward]
+        stack = []
+
+        def pop():
+            e, child, stage, bwd = stack.pop()
+            if stack:
+                stack[-1][1] += e['dur']
+            rows.append((e['name'], e['dur'] - child, stage, bwd))
+
+        for e in evs:
+            while stack and stack[-1][0]['ts'] + stack[-1][0]['dur'] <= e['ts']:
+                pop()
+            stage, bwd = (stack[-1][2], stack[-1][3]) if stack else \
+                ('other', False)
+            name = e['name']
+            if name.startswith(STAGE_PREFIX):
+                stage = name[len(STAGE_PREFIX):]
+            elif name in OP_STAGES and stage == 'other':
+                stage = OP_STAGES[name]
+            if name.startswith('autograd::engine::evaluate_function'):
+                bwd = True
+            stack.append([e, 0, stage, bwd])
+        while stack:
+            pop()
+    return rows
+
+
+def aggregate(rows):
+    """ Sums the self times by op and by (stage, pass). """
+    ops = defaultdict(lambda: [0., 0])
+    stages = defaultdict(float)
+    for name, t, stage, bwd in rows:
+        if name.startswith(STAGE_PREFIX):
+            # Time in a stage not spent in an op is python overhead
+            name = '[python] ' + name
+        ops[name][0] += t
+        ops[name][1] += 1
+        stages[(stage, 'backward' if bwd else 'forward')] += t
+    return ops, stages
+
+
+def print_tables(ops, stages, top=25):
+    total = sum(stages.values())
+    print('{:<20} {:<9} {:>12} {:>7}'.format('Stage', 'Pass', 'Self (ms)',
+                                             '%'))
+    for (stage, p), t in sorted(stages.items(), key=lambda x: -x[1]):
+        print('{:<20} {:<9} {:>12.3f} {:>6.1f}%'.format(
+            stage, p, t / 1000, 100 * t / total))
+    print('{:<30} {:>12.3f}'.format('Total', total / 1000))
+    print()
+    print('{:<50} {:>8} {:>12} {:>7}'.format('Op', 'Calls', 'Self (ms)', '%'))
+    for name, (t, n) in sorted(ops.items(), key=lambda x: -x[1][0])[:top]:
+        print('{:<50} {:>8} {:>12.3f} {:>6.1f}%'.format(
+            name[:50], n, t / 1000, 100 * t / total))
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    data, header = prep_file(args.file)
-    df = pandify(data)
-    with open(args.file, 'w') as f:
-        f.write(header)
-        f.write(df.to_string(index=False))
-
+    ops, stages = aggregate(self_times(load_events(args.file)))
+    print_tables(ops, stages, args.top)
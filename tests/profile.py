@@ -1,97 +1,145 @@
+""" Profiles a scattering layer or small network with torch.profiler.
+
+Runs a few training (or inference) steps under the profiler on the cpu and
+writes a Chrome trace, which can be opened in chrome://tracing or Perfetto,
+or summarised with parser.py. The DTCWT, magnitude and pooling stages in
+scatnet_learn.lowlevel are labelled in the trace as 'scat::<stage>' ranges so
+the time can be attributed to them.
+
+Example::
+
+    python tests/profile.py ScatLayerj2 -o trace.json
+    python tests/parser.py trace.json
+"""
+import argparse
+import contextlib
+import functools
+import importlib.util
+import os
+
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-import argparse
-import py3nvml
-import timeit
-from scatnet_learn import ScatLayerj1
+from torch.profiler import profile, record_function, ProfilerActivity
 
-parser = argparse.ArgumentParser('Profile the dwt')
-parser.add_argument('--no-grad', action='store_true',
-                    help='Dont calculate the gradients')
-parser.add_argument('-J', type=int, default=2,
-                    help='number of scales of transform to do')
-parser.add_argument('--batch', default=4, type=int,
+import scatnet_learn.lowlevel as lowlevel
+from scatnet_learn.dtcwt_fft import FFTj1
+from scatnet_learn.layers import ScatLayerj1
+from benchmark import CASES
+
+# Load parser.py by path, as 'parser' is a builtin module in older pythons
+_spec = importlib.util.spec_from_file_location(
+    'trace_parser', os.path.join(os.path.dirname(__file__), 'parser.py'))
+trace_parser = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(trace_parser)
+
+NETS = {
+    # The scattering front end and first conv of a ScatNet
+    'ScatNet': lambda C, kw: nn.Sequential(
+        ScatLayerj1(**kw), ScatLayerj1(**kw), nn.BatchNorm2d(49*C),
+        nn.Conv2d(49*C, 64, 3, padding=1), nn.ReLU()),
+}
+
+parser = argparse.ArgumentParser('Profile the scattering layers')
+parser.add_argument('layer', choices=list(CASES) + list(NETS),
+                    help='layer or network to profile')
+parser.add_argument('-o', '--output', type=str, default='trace.json',
+                    help='chrome trace file to write')
+parser.add_argument('--batch', default=8, type=int,
                     help='Number of images in parallel')
-parser.add_argument('-C', default=100, type=int,
+parser.add_argument('-C', default=3, type=int,
                     help='Number of channels')
-parser.add_argument('-s', '--size', default=0, type=int,
+parser.add_argument('-s', '--size', default=64, type=int,
                     help='spatial size of input')
-parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'],
-                    help='which device to test')
-parser.add_argument('--ref', action='store_true',
-                    help='Compare to doing a similar convolution')
-
-
-def reference(size, no_grad, J=2, dev='cuda'):
-    # prepare transform
-    x = torch.randn(*size, requires_grad=(not no_grad), device=dev)
-    memx = torch.cuda.memory_allocated()
-    cachedx = torch.cuda.memory_cached()
-
-    # Do transform
-    filts = torch.randn(7**J, size[1], 9, 9, device=dev)
-    y = F.conv2d(x, filts, padding=4, stride=2)
-    cachedy = torch.cuda.memory_cached()
-    memy = torch.cuda.memory_allocated() - memx
-
-    # Do backwards pass
-    if not no_grad:
-        y.backward(torch.ones_like(y))
-        cached = torch.cuda.memory_cached()
-        mem = torch.cuda.memory_allocated() - memy
-        mem = memy - torch.cuda.memory_allocated()
-
-    print('input tensor size: {:.1f}MiB'.format(memx / 2**20))
-    print('output tensor (+ saved activations) size: {:.1f}MiB'.format(memy / 2**20))
-    if not no_grad:
-        print('after bwd, freed memory size: {:.1f}MiB'.format(mem / 2**20))
-    print()
-    print('Cached memory before transform: {:.1f}MiB'.format(cachedx / 2**20))
-    print('Cached memory after transform: {:.1f}MiB'.format(cachedy / 2**20))
-    if not no_grad:
-        print('Cached memory after backward: {:.1f}MiB'.format(cached / 2**20))
-
-    return y
-
-
-def fwd(size, no_grad, J=2, dev='cuda'):
-    # Prepare the transform
-    xfm = nn.Sequential(*[ScatLayerj1() for j in range(J)]).to(dev)
-    x = torch.randn(*size, requires_grad=(not no_grad), device=dev)
-    memx = torch.cuda.memory_allocated()
-    cachedx = torch.cuda.memory_cached()
-
-    # Do the transform
-    y = xfm(x)
-    cachedy = torch.cuda.memory_cached()
-    memy = torch.cuda.memory_allocated()
-
-    # Do backwards pass
-    if not no_grad:
-        y.backward(torch.ones_like(y))
-        mem = torch.cuda.memory_allocated()
-        cached = torch.cuda.memory_cached()
-
-    print('input tensor size: {:.1f}MiB'.format(memx / 2**20))
-    print('output tensor (+ saved activations) size: {:.1f}MiB'.format(memy / 2**20))
-    if not no_grad:
-        print('after bwd, freed memory size: {:.1f}MiB'.format(mem / 2**20))
-    print()
-    print('Cached memory before transform: {:.1f}MiB'.format(cachedx / 2**20))
-    print('Cached memory after transform: {:.1f}MiB'.format(cachedy / 2**20))
-    if not no_grad:
-        print('Cached memory after backward: {:.1f}MiB'.format(cached / 2**20))
+parser.add_argument('--steps', default=5, type=int,
+                    help='number of profiled iterations')
+parser.add_argument('--warmup', default=2, type=int,
+                    help='number of iterations to run before profiling')
+parser.add_argument('--no-grad', action='store_true',
+                    help='Dont calculate the gradients')
+parser.add_argument('--threads', type=int, default=None,
+                    help='number of cpu threads')
+parser.add_argument('--backend', default='spatial', choices=['spatial', 'fft'],
+                    help='backend for ScatLayerj1 and ScatLayerj2')
+
+# The functions in lowlevel to label, and the stage they belong to
+STAGES = {
+    'fwd_j1': 'fwd_j1',
+    'fwd_j1_rot': 'fwd_j1',
+    'fwd_j2plus': 'fwd_j2plus',
+    'fwd_j2plus_rot': 'fwd_j2plus',
+    'inv_j1': 'inv_j1',
+    'inv_j1_rot': 'inv_j1',
+    'inv_j2plus': 'inv_j2plus',
+    'inv_j2plus_rot': 'inv_j2plus',
+    'smooth_mag': 'magnitude',
+    '_smooth_mag_into': 'magnitude',
+    'pack_phase': 'magnitude',
+    'unpack_phase': 'magnitude',
+    '_avg_pool2_into': 'pooling',
+    'cat_like': 'concat',
+}
+
+
+def _label(fn, stage):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with record_function('scat::' + stage):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def label_stages():
+    """ Wraps the stages of the scattering in record_function ranges while
+    profiling, and restores the original functions after. The library code
+    is left unchanged so it has no overhead when not profiling. """
+    saved = {}
+    try:
+        for name, stage in STAGES.items():
+            if hasattr(lowlevel, name):
+                saved[(lowlevel, name)] = getattr(lowlevel, name)
+                setattr(lowlevel, name, _label(getattr(lowlevel, name), stage))
+        for name, stage in (('forward', 'fwd_j1'), ('adjoint', 'inv_j1')):
+            saved[(FFTj1, name)] = getattr(FFTj1, name)
+            setattr(FFTj1, name, _label(getattr(FFTj1, name), stage))
+        yield
+    finally:
+        for (obj, name), fn in saved.items():
+            setattr(obj, name, fn)
+
+
+def run(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    kw = {'backend': args.backend} if args.backend != 'spatial' else {}
+    make = NETS.get(args.layer, CASES.get(args.layer))
+    net = make(args.C, kw)
+    x = torch.randn(args.batch, args.C, args.size, args.size,
+                    requires_grad=not args.no_grad)
+
+    def step():
+        if args.no_grad:
+            with torch.no_grad():
+                net(x)
+        else:
+            y = net(x)
+            y.backward(torch.ones_like(y))
+
+    for _ in range(args.warmup):
+        step()
+    with label_stages():
+        with profile(activities=[ProfilerActivity.CPU],
+                     record_shapes=True) as prof:
+            for _ in range(args.steps):
+                with record_function('step'):
+                    step()
+    prof.export_chrome_trace(args.output)
+    print('Wrote {}\n'.format(args.output))
+
+    ops, stages = trace_parser.aggregate(trace_parser.self_times(
+        trace_parser.load_events(args.output)))
+    trace_parser.print_tables(ops, stages)
+
 
 if __name__ == "__main__":
-    args = parser.parse_args()
-    py3nvml.grab_gpus(1)
-    if args.size > 0:
-        size = (args.batch, args.C, args.size, args.size)
-    else:
-        size = (args.batch, args.C, 256, 256)
-
-    if args.ref:
-        y = reference(size, args.no_grad, args.J, args.device)
-    else:
-        y = fwd(size, args.no_grad, args.J, args.device)
+    run(parser.parse_args())
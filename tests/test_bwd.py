@@ -1,6 +1,8 @@
 from torch.autograd import gradcheck
-from scatnet_learn.layers import ScatLayerj1, ScatLayerj2
+from scatnet_learn.layers import ScatLayerj1, ScatLayerj2, InvariantLayerj1
+from scatnet_learn.layers import ScatLayerJ
 from scatnet_learn.lowlevel import SmoothMagFn, SmoothMagFnColour
+import numpy as np
 import torch
 import pytest
 
@@ -21,6 +23,43 @@ def test_grad_scat_colour(biort):
     gradcheck(scat, (x,))
 
 
+@pytest.mark.parametrize('biort', ['near_sym_a', 'near_sym_b', 'near_sym_b_bp'])
+@pytest.mark.parametrize('combine_colour', [False, True])
+def test_grad_scat_checkpoint(biort, combine_colour):
+    x = torch.randn(1, 3, 32, 32, requires_grad=True, dtype=torch.double)
+    scat = ScatLayerj1(biort=biort, combine_colour=combine_colour,
+                       checkpoint=True)
+    scat = scat.to(torch.double)
+    gradcheck(scat, (x,))
+
+
+@pytest.mark.parametrize('biort', ['near_sym_a', 'near_sym_b_bp'])
+def test_checkpoint_equal(biort):
+    x = torch.randn(2, 3, 32, 32, requires_grad=True)
+    scat = ScatLayerj1(biort=biort)
+    scat_chkpt = ScatLayerj1(biort=biort, checkpoint=True)
+    y = scat(x)
+    dy = torch.randn_like(y)
+    dx, = torch.autograd.grad(y, x, dy)
+    y2 = scat_chkpt(x)
+    dx2, = torch.autograd.grad(y2, x, dy)
+    np.testing.assert_array_almost_equal(y.detach(), y2.detach(), decimal=5)
+    np.testing.assert_array_almost_equal(dx, dx2, decimal=5)
+
+    cost = scat_chkpt.memory_cost(x.shape)
+    assert cost['saved_bytes'] == cost['saved_bytes_checkpoint']
+    assert cost['saved_bytes_full'] == 3 * cost['saved_bytes_checkpoint']
+
+
+@pytest.mark.parametrize('biort', ['near_sym_a', 'near_sym_b', 'near_sym_b_bp'])
+def test_grad_scat_compact(biort):
+    # The phase is stored in half precision so loosen the tolerances
+    x = torch.randn(1, 3, 32, 32, requires_grad=True, dtype=torch.double)
+    scat = ScatLayerj1(biort=biort, compact_phase=True)
+    scat = scat.to(torch.double)
+    gradcheck(scat, (x,), atol=1e-2, rtol=1e-2)
+
+
 @pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
                                           ('near_sym_b', 'qshift_b'),
                                           ('near_sym_b_bp', 'qshift_b_bp')])
@@ -41,6 +80,93 @@ def test_grad_scatj2_colour(biort, qshift):
     gradcheck(scat, (x,))
 
 
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b', 'qshift_b'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+def test_grad_scatj2_compact(biort, qshift):
+    x = torch.randn(1, 3, 16, 16, requires_grad=True, dtype=torch.double)
+    scat = ScatLayerj2(biort=biort, qshift=qshift, compact_phase=True)
+    scat = scat.to(torch.double)
+    gradcheck(scat, (x,), atol=1e-2, rtol=1e-2)
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+def test_compact_equal(biort, qshift):
+    x = torch.randn(2, 3, 32, 32, requires_grad=True)
+    for full, compact in (
+            (ScatLayerj1(biort=biort),
+             ScatLayerj1(biort=biort, compact_phase=True)),
+            (ScatLayerj2(biort=biort, qshift=qshift),
+             ScatLayerj2(biort=biort, qshift=qshift, compact_phase=True))):
+        y = full(x)
+        y2 = compact(x)
+        np.testing.assert_array_almost_equal(
+            y.detach(), y2.detach(), decimal=5)
+        dy = torch.randn_like(y)
+        dx, = torch.autograd.grad(y, x, dy)
+        dx2, = torch.autograd.grad(y2, x, dy)
+        np.testing.assert_allclose(
+            dx, dx2, rtol=1e-2, atol=1e-2 * dx.abs().max().item())
+
+    cost = ScatLayerj1(compact_phase=True).memory_cost(x.shape)
+    assert cost['saved_bytes'] == cost['saved_bytes_compact']
+    assert cost['saved_bytes_full'] == 4 * cost['saved_bytes_compact']
+
+
+def test_compact_bad_args():
+    with pytest.raises(ValueError):
+        ScatLayerj1(compact_phase=True, checkpoint=True)
+    with pytest.raises(ValueError):
+        ScatLayerj1(compact_phase=True, combine_colour=True)
+    with pytest.raises(ValueError):
+        ScatLayerj2(compact_phase=True, combine_colour=True)
+
+
+@pytest.mark.parametrize('biort', ['near_sym_a', 'near_sym_b_bp'])
+@pytest.mark.parametrize('compact_phase', [False, True])
+def test_grad_autocast(biort, compact_phase):
+    layer = InvariantLayerj1(3, biort=biort, compact_phase=compact_phase)
+    x = torch.randn(2, 3, 32, 32, requires_grad=True)
+    y = layer(x)
+    dy = torch.randn_like(y)
+    dx, = torch.autograd.grad(y, x, dy)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        y2 = layer(x)
+    assert y2.dtype == torch.bfloat16
+    dx2, = torch.autograd.grad(y2, x, dy.to(y2.dtype))
+    assert dx2.dtype == torch.float32
+    assert torch.isfinite(dx2).all()
+    np.testing.assert_allclose(
+        dx2, dx, rtol=1e-1, atol=1e-1 * dx.abs().max().item())
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+@pytest.mark.parametrize('J,order', [(1, 2), (3, 1), (3, 2)])
+def test_grad_scatJ(biort, qshift, J, order):
+    x = torch.randn(1, 2, 16, 16, requires_grad=True, dtype=torch.double)
+    scat = ScatLayerJ(biort=biort, qshift=qshift, J=J, order=order)
+    scat = scat.to(torch.double)
+    gradcheck(scat, (x,))
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+@pytest.mark.parametrize('mode', ['symmetric', 'zero'])
+def test_grad_scat_fft(biort, qshift, mode):
+    x = torch.randn(1, 2, 16, 16, requires_grad=True, dtype=torch.double)
+    scat = ScatLayerj1(biort=biort, mode=mode, backend='fft')
+    scat = scat.to(torch.double)
+    gradcheck(scat, (x,))
+    # pytorch_wavelets only has symmetric padding for the qshift levels
+    if mode != 'symmetric':
+        return
+    scat = ScatLayerj2(biort=biort, qshift=qshift, mode=mode, backend='fft')
+    scat = scat.to(torch.double)
+    gradcheck(scat, (x,))
+
+
 @pytest.mark.parametrize('sz', [32, 30, 31, 29, 28])
 def test_grad_odd_size(sz):
     x = torch.randn(1, 3, sz, sz, requires_grad=True, dtype=torch.double)
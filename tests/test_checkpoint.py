@@ -0,0 +1,100 @@
+from scatnet_learn import checkpoint
+from scatnet_learn.layers import ScatLayerj1
+import os
+import torch
+import torch.nn as nn
+import pytest
+
+
+def _net():
+    # Like the start of a ScatNet, each ScatLayerj1 has its own frozen h0o
+    # and h1o
+    torch.manual_seed(0)
+    return nn.Sequential(ScatLayerj1(), ScatLayerj1(), nn.BatchNorm2d(147),
+                         nn.Conv2d(147, 4, 3))
+
+
+def test_frozen_shared(tmp_path):
+    net = _net()
+    state = checkpoint.snapshot(net)
+    assert state['net']['0.h0o'] is state['net']['1.h0o']
+    assert state['net']['0.h1o'] is state['net']['1.h1o']
+    # The trained weights are copies, not views of the net's
+    assert state['net']['3.weight'].data_ptr() != net[3].weight.data_ptr()
+
+    copied = dict(state, net={k: v.clone() for k, v in state['net'].items()})
+    with checkpoint.AsyncCheckpointer() as c:
+        c.save(state, str(tmp_path / 'shared.t7'))
+        c.save(copied, str(tmp_path / 'copied.t7'))
+    assert os.path.getsize(str(tmp_path / 'shared.t7')) < \
+        os.path.getsize(str(tmp_path / 'copied.t7'))
+
+    loaded = checkpoint.load(str(tmp_path / 'shared.t7'))
+    assert loaded['net']['0.h0o'].data_ptr() == \
+        loaded['net']['1.h0o'].data_ptr()
+
+
+def test_roundtrip(tmp_path):
+    net = _net()
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 10)
+    y = net(torch.randn(2, 3, 32, 32))
+    y.sum().backward()
+    optimizer.step()
+    scheduler.step()
+
+    path = str(tmp_path / 'chkpt.t7')
+    with checkpoint.AsyncCheckpointer() as c:
+        c.save(checkpoint.snapshot(net, optimizer, scheduler, epoch=3), path)
+    state = checkpoint.load(path)
+    assert state['epoch'] == 3
+
+    net2 = _net()
+    for p in net2.parameters():
+        p.data.zero_()
+    net2.load_state_dict(state['net'], strict=True)
+    for k, v in net.state_dict().items():
+        assert torch.equal(v, net2.state_dict()[k])
+    optimizer2 = torch.optim.SGD(net2.parameters(), lr=0.1, momentum=0.9)
+    optimizer2.load_state_dict(state['optimizer'])
+    scheduler2 = torch.optim.lr_scheduler.StepLR(optimizer2, 10)
+    scheduler2.load_state_dict(state['scheduler'])
+    assert scheduler2.last_epoch == scheduler.last_epoch
+
+
+def test_rng(tmp_path):
+    state = checkpoint.get_rng_state()
+    a = torch.rand(3)
+    checkpoint.set_rng_state(state)
+    assert torch.equal(a, torch.rand(3))
+
+
+@pytest.mark.parametrize('wrap', [False, True])
+def test_legacy(tmp_path, wrap):
+    net = _net()
+    path = str(tmp_path / 'legacy.t7')
+    torch.save({'net': nn.DataParallel(net) if wrap else net, 'acc1': 50.,
+                'epoch': 2}, path)
+    state = checkpoint.load(path)
+    assert isinstance(state['net'], dict)
+    _net().load_state_dict(state['net'], strict=True)
+    assert state['epoch'] == 2
+
+
+def test_no_tmp_left(tmp_path):
+    paths = [str(tmp_path / 'latest.t7'), str(tmp_path / 'best.t7')]
+    with checkpoint.AsyncCheckpointer() as c:
+        for epoch in range(3):
+            c.save(checkpoint.snapshot(_net(), epoch=epoch), *paths)
+    assert sorted(os.listdir(str(tmp_path))) == ['best.t7', 'latest.t7']
+    assert checkpoint.load(paths[0])['epoch'] == 2
+
+    # A failed write raises and cleans up after itself
+    bad = tmp_path / 'bad.t7'
+    bad.mkdir()
+    c = checkpoint.AsyncCheckpointer()
+    c.save(checkpoint.snapshot(_net()), str(bad))
+    with pytest.raises(OSError):
+        c.wait()
+    c.close()
+    assert not os.path.exists(str(bad) + '.tmp')
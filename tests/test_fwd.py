@@ -1,8 +1,13 @@
 from dtcwt_slim.numpy import Transform2d
-from scatnet_learn.layers import ScatLayerj1, ScatLayerj2
+from scatnet_learn.layers import ScatLayerj1, ScatLayerj2, ScatLayerJ
+from scatnet_learn.layers import InvariantLayerj1
+from scatnet_learn.plan import ScatPlan
+from scatnet_learn.tiled import TiledScat
 import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils._python_dispatch import TorchDispatchMode
 import pytest
 
 
@@ -134,9 +139,240 @@ def test_equal_j2_colour(biort, qshift):
     np.testing.assert_array_almost_equal(z.numpy(), z2, decimal=4)
 
 
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b', 'qshift_b'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+def test_equal_J2(biort, qshift):
+    scat = ScatLayerJ(biort=biort, qshift=qshift, J=2)
+    scat2 = ScatLayerj2(biort=biort, qshift=qshift)
+    x = torch.randn(3, 4, 32, 32)
+    np.testing.assert_array_almost_equal(scat(x), scat2(x), decimal=4)
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b', 'qshift_b')])
+def test_equal_J3_order1(biort, qshift):
+    b = 1e-2
+
+    scat = ScatLayerJ(biort=biort, qshift=qshift, magbias=b, J=3, order=1)
+    xfm = Transform2d(biort=biort, qshift=qshift)
+    x = torch.randn(3, 4, 32, 32)
+    z = scat(x)
+
+    X = x.data.numpy()
+    yl, yh = xfm.forward(X, nlevels=3)
+    S0 = F.avg_pool2d(torch.tensor(yl), 2).numpy()
+
+    # Lowpass each first order magnitude down to the 3rd scale
+    S1 = []
+    for j in range(3):
+        M = np.sqrt(yh[j].real**2 + yh[j].imag**2 + b**2) - b
+        M = M.transpose(0, 2, 1, 3, 4)
+        s = M.shape
+        M = M.reshape(3, 24, s[3], s[4])
+        if j < 2:
+            M, _ = xfm.forward(M, nlevels=2-j)
+            M = F.avg_pool2d(torch.tensor(M), 2).numpy()
+        S1.append(M.reshape(3, 6, 4, 4, 4))
+
+    z2 = np.concatenate([S0[:, None]] + S1, axis=1)
+    z2 = z2.reshape(3, (1+18)*4, 4, 4)
+    np.testing.assert_array_almost_equal(z.numpy(), z2, decimal=4)
+
+
+@pytest.mark.parametrize('J,order', [(1, 1), (1, 2), (3, 1), (3, 2), (4, 2)])
+def test_shape_J(J, order):
+    scat = ScatLayerJ(J=J, order=order)
+    x = torch.randn(2, 3, 64, 60)
+    z = scat(x)
+    K = 1 + 6*J + (36*J*(J-1)//2 if order == 2 else 0)
+    assert z.shape == (2, K*3, 64//2**J, (60 + 2**J - 1)//2**J)
+
+
 @pytest.mark.parametrize('sz', [32, 30, 31, 29, 28])
 def test_odd_size_j2(sz):
     scat = ScatLayerj2(biort='near_sym_a', qshift='qshift_a')
     x = torch.randn(5, 5, sz, sz)
     z = scat(x)
     assert z.shape[-1] == 8
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+def test_autocast(biort, qshift):
+    x = torch.randn(2, 3, 32, 32)
+    for scat in (ScatLayerj1(biort=biort),
+                 ScatLayerj2(biort=biort, qshift=qshift)):
+        z = scat(x)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            z2 = scat(x)
+        assert z2.dtype == torch.bfloat16
+        np.testing.assert_allclose(
+            z2.float(), z, rtol=5e-2, atol=5e-2 * z.abs().max().item())
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+@pytest.mark.parametrize('combine_colour', [False, True])
+def test_inference(biort, qshift, combine_colour):
+    x = torch.randn(2, 3, 32, 32)
+    for scat in (ScatLayerj1(biort=biort, combine_colour=combine_colour),
+                 ScatLayerj2(biort=biort, qshift=qshift,
+                             combine_colour=combine_colour)):
+        # The autograd path
+        z = scat(x.clone().requires_grad_(True)).detach()
+        with torch.inference_mode():
+            z2 = scat(x)
+            out = torch.empty_like(z)
+            z3 = scat(x, out=out)
+        assert z3.data_ptr() == out.data_ptr()
+        np.testing.assert_array_almost_equal(z, z2, decimal=5)
+        np.testing.assert_array_almost_equal(z, z3, decimal=5)
+
+
+def test_inference_bad_out():
+    scat = ScatLayerj1()
+    x = torch.randn(2, 3, 32, 32, requires_grad=True)
+    with pytest.raises(ValueError):
+        scat(x, out=torch.empty(2, 21, 16, 16))
+    with torch.no_grad():
+        with pytest.raises(ValueError):
+            scat(x, out=torch.empty(2, 21, 16, 15))
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b', 'qshift_b'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+@pytest.mark.parametrize('mode', ['symmetric', 'zero'])
+def test_fft_equal(biort, qshift, mode):
+    x = torch.randn(2, 3, 32, 32)
+    for kwargs in ({}, {'combine_colour': True}):
+        scat = ScatLayerj1(biort=biort, mode=mode, **kwargs)
+        scat_fft = ScatLayerj1(biort=biort, mode=mode, backend='fft', **kwargs)
+        np.testing.assert_array_almost_equal(scat(x), scat_fft(x), decimal=4)
+
+        # pytorch_wavelets only has symmetric padding for the qshift levels
+        if mode != 'symmetric':
+            continue
+        scat = ScatLayerj2(biort=biort, qshift=qshift, mode=mode, **kwargs)
+        scat_fft = ScatLayerj2(biort=biort, qshift=qshift, mode=mode,
+                               backend='fft', **kwargs)
+        np.testing.assert_array_almost_equal(scat(x), scat_fft(x), decimal=4)
+
+
+def test_fft_bad_args():
+    with pytest.raises(ValueError):
+        ScatLayerj1(backend='fft', mode='periodization')
+    with pytest.raises(ValueError):
+        ScatLayerj2(backend='winograd')
+
+
+@pytest.mark.parametrize('sz', [32, 30, 31, 29, 28, 5])
+@pytest.mark.parametrize('multiple,centre', [(2, False), (8, True)])
+def test_plan_pad(sz, multiple, centre):
+    x = torch.randn(2, 3, sz, sz + 1)
+    plan = ScatPlan(x.shape, x.dtype, x.device, torch.contiguous_format,
+                    [], multiple, centre)
+    # The padding the layers used to do
+    y = x
+    for d in (2, 3):
+        rem = y.shape[d] % multiple
+        if rem != 0:
+            after = (multiple+1-rem)//2 if centre else multiple-rem
+            before = (multiple-rem)//2 if centre else 0
+            y = torch.cat((y.narrow(d, 0, before), y,
+                           y.narrow(d, y.shape[d]-after, after)), dim=d)
+    assert plan.padded_shape == y.shape
+    np.testing.assert_array_equal(plan.pad(x), y)
+    np.testing.assert_array_equal(plan.pad(x, reuse=True), y)
+    np.testing.assert_array_equal(plan.pad(2*x, reuse=True), 2*y)
+
+
+def test_plan_cache():
+    scat = ScatLayerj2()
+    scat.plans.maxsize = 2
+    for sz in (32, 30, 32, 28, 32):
+        with torch.no_grad():
+            scat(torch.randn(1, 3, sz, sz))
+    assert scat.plans.hits == 2
+    assert scat.plans.misses == 3
+    # 30 was the least recently used so has been dropped
+    assert [k[0][2] for k in scat.plans.plans] == [28, 32]
+    scat.double()
+    assert len(scat.plans) == 0
+
+
+@pytest.mark.parametrize('layer', [
+    lambda: ScatLayerj1(biort='near_sym_a'),
+    lambda: ScatLayerj1(biort='near_sym_b_bp', mode='zero'),
+    lambda: ScatLayerj2(biort='near_sym_a', qshift='qshift_a'),
+    lambda: ScatLayerj2(biort='near_sym_b_bp', qshift='qshift_b_bp', J=3),
+    lambda: ScatLayerJ(J=3)])
+def test_tiled(layer, tmpdir):
+    scat = layer()
+    x = torch.randn(1, 2, 150, 133)
+    with torch.no_grad():
+        z = scat(x)
+    tiled = TiledScat(scat, tile=32)
+    np.testing.assert_array_almost_equal(tiled(x), z, decimal=5)
+
+    # From a memory mapped array into another one
+    X = np.lib.format.open_memmap(str(tmpdir.join('x.npy')), mode='w+',
+                                  dtype=np.float32, shape=x.shape)
+    X[:] = x.numpy()
+    Z = np.lib.format.open_memmap(str(tmpdir.join('z.npy')), mode='w+',
+                                  dtype=np.float32, shape=z.shape)
+    assert tiled(X, out=Z) is Z
+    np.testing.assert_array_almost_equal(Z, z, decimal=5)
+
+
+def test_tiled_generator():
+    scat = ScatLayerj2()
+    x = torch.randn(1, 3, 128, 96)
+    tiled = TiledScat(scat, tile=32)
+    tiles = (x[:, :, w.rows, w.cols] for w in tiled.windows(x.shape))
+    z = tiled(tiles, shape=x.shape)
+    with torch.no_grad():
+        np.testing.assert_array_almost_equal(z, scat(x), decimal=5)
+    with pytest.raises(ValueError):
+        tiled(iter([]), shape=(1, 3, 100, 96))
+
+
+class NoChannelsLastCopies(TorchDispatchMode):
+    """ Fails if a channels_last tensor is copied to a contiguous one, e.g.
+    by .contiguous() or a .reshape() that can't be a view """
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func in (torch.ops.aten.clone.default,
+                    torch.ops.aten._to_copy.default) and \
+                kwargs.get('memory_format') == torch.contiguous_format:
+            x = args[0]
+            assert x.is_contiguous() or \
+                not x.is_contiguous(memory_format=torch.channels_last), \
+                'channels_last tensor converted to contiguous in {}'.format(
+                    func)
+        return func(*args, **kwargs)
+
+
+@pytest.mark.parametrize('grad', [True, False])
+def test_channels_last(grad):
+    # A small MixedNet style network
+    net = nn.Sequential(
+        nn.Conv2d(3, 8, 3, padding=1), nn.BatchNorm2d(8), nn.ReLU(),
+        InvariantLayerj1(8, 16), nn.BatchNorm2d(16), nn.ReLU(),
+        InvariantLayerj1(16, 16, alpha='full', biort='near_sym_b_bp'),
+        nn.BatchNorm2d(16), nn.ReLU(),
+        ScatLayerj1(), ScatLayerj2(), ScatLayerJ(J=1))
+    net = net.to(memory_format=torch.channels_last)
+
+    def check(mod, inp, out):
+        assert out.is_contiguous(memory_format=torch.channels_last), \
+            '{} output is not channels_last'.format(mod)
+    for mod in net:
+        if not isinstance(mod, (nn.BatchNorm2d, nn.ReLU)):
+            mod.register_forward_hook(check)
+
+    x = torch.randn(2, 3, 64, 64).to(memory_format=torch.channels_last)
+    with torch.set_grad_enabled(grad), NoChannelsLastCopies():
+        y = net(x)
+    assert y.shape == (2, 7*7*49*16, 1, 1)
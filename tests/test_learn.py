@@ -0,0 +1,73 @@
+from scatnet_learn import learn
+from scatnet_learn.data import transforms
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data
+import torchvision.transforms as tv
+import pytest
+
+
+def _batches(n, bad=None):
+    torch.manual_seed(0)
+    batches = [(torch.randn(4, 12), torch.randint(0, 10, (4,)))
+               for _ in range(n)]
+    if bad is not None:
+        batches[bad][0][0, 0] = float('nan')
+    return batches
+
+
+def test_watchdog_accumulation():
+    # iter_size doesn't divide check_freq, and the nan is in the step after
+    # a passing check. The replay has to start from before that step to find
+    # the fault
+    net = nn.Linear(12, 10)
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1)
+    with pytest.raises(RuntimeError, match='nan'):
+        learn.train(_batches(16, bad=10), net, nn.CrossEntropyLoss(),
+                    optimizer, use_cuda=False, check_freq=5, iter_size=4)
+
+
+def test_watchdog_clean():
+    net = nn.Linear(12, 10)
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1)
+    learn.train(_batches(16), net, nn.CrossEntropyLoss(), optimizer,
+                use_cuda=False, check_freq=5, iter_size=3)
+    assert all(torch.isfinite(p).all() for p in net.parameters())
+
+
+def test_watchdog_keeps_cpu_batches():
+    net = nn.Linear(12, 10)
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1)
+    watchdog = learn.NaNWatchdog(check_freq=50)
+    watchdog.start_step(net, optimizer)
+    x, y = _batches(1)[0]
+    watchdog.step(0, nn.CrossEntropyLoss()(net(x), y), net, (x, y))
+    assert watchdog.batches[0][1][0] is x
+
+
+def _epoch(loader):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    batches = []
+    for x, y in learn.Prefetcher(loader, depth=2):
+        # Draw from the global generators while the thread is loading, as
+        # dropout would
+        np.random.rand(100)
+        torch.rand(100)
+        batches.append((x, y))
+    return batches
+
+
+def test_prefetcher_reproducible():
+    x = torch.randint(0, 256, (64, 3, 32, 32), dtype=torch.uint8)
+    dataset = torch.utils.data.TensorDataset(x, torch.arange(64))
+    collate = transforms.BatchCollate(tv.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.RandomHorizontalFlip()]))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=8, shuffle=True,
+                                         num_workers=0, collate_fn=collate)
+    a, b = _epoch(loader), _epoch(loader)
+    assert len(a) == len(loader)
+    for (x1, y1), (x2, y2) in zip(a, b):
+        assert torch.equal(x1, x2) and torch.equal(y1, y2)
@@ -0,0 +1,56 @@
+""" Performance regression tests for the layer configurations covered by
+test_fwd.py and test_bwd.py. Only run with --perf or --perf-update, see
+conftest.py. """
+from scatnet_learn.layers import ScatLayerj1, ScatLayerj2, ScatLayerJ
+import torch
+import pytest
+
+pytestmark = pytest.mark.perf
+
+
+def _check(perf, scat, x):
+    """ Times the forward pass with and without gradients, and the forward
+    and backward pass together. """
+    def inference():
+        with torch.no_grad():
+            scat(x)
+
+    def fwd():
+        scat(x)
+
+    def fwd_bwd():
+        y = scat(x)
+        y.backward(torch.ones_like(y))
+
+    perf('inference', inference)
+    perf('fwd', fwd)
+    perf('fwd_bwd', fwd_bwd)
+
+
+@pytest.mark.parametrize('biort', ['near_sym_a', 'near_sym_b', 'near_sym_b_bp'])
+@pytest.mark.parametrize('combine_colour', [False, True])
+def test_perf_scat(perf, biort, combine_colour):
+    x = torch.randn(8, 3, 64, 64, requires_grad=True)
+    _check(perf, ScatLayerj1(biort=biort, combine_colour=combine_colour), x)
+
+
+@pytest.mark.parametrize('option', ['checkpoint', 'compact_phase'])
+def test_perf_scat_memory(perf, option):
+    x = torch.randn(8, 3, 64, 64, requires_grad=True)
+    _check(perf, ScatLayerj1(**{option: True}), x)
+
+
+@pytest.mark.parametrize('biort,qshift', [('near_sym_a', 'qshift_a'),
+                                          ('near_sym_b', 'qshift_b'),
+                                          ('near_sym_b_bp', 'qshift_b_bp')])
+@pytest.mark.parametrize('combine_colour', [False, True])
+def test_perf_scatj2(perf, biort, qshift, combine_colour):
+    x = torch.randn(8, 3, 64, 64, requires_grad=True)
+    _check(perf, ScatLayerj2(biort=biort, qshift=qshift,
+                             combine_colour=combine_colour), x)
+
+
+@pytest.mark.parametrize('J,order', [(3, 1), (3, 2)])
+def test_perf_scatJ(perf, J, order):
+    x = torch.randn(8, 3, 64, 64, requires_grad=True)
+    _check(perf, ScatLayerJ(J=J, order=order), x)
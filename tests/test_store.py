@@ -0,0 +1,40 @@
+from scatnet_learn.data.store import precompute, FeatureStore
+from scatnet_learn.layers import ScatLayerj1
+import numpy as np
+import torch
+import torch.utils.data
+import pytest
+
+
+@pytest.mark.parametrize('batch_size,shard_size', [(3, 4), (5, 4), (16, 7)])
+def test_roundtrip(tmp_path, batch_size, shard_size):
+    # The batches cross the shard boundaries
+    N = 10
+    x = torch.randn(N, 3, 16, 16)
+    y = torch.arange(N)
+    dataset = torch.utils.data.TensorDataset(x, y)
+    scat = ScatLayerj1()
+
+    meta = precompute(scat, dataset, str(tmp_path), batch_size=batch_size,
+                      shard_size=shard_size)
+    assert meta['length'] == N
+    assert len(meta['shards']) == -(-N // shard_size)
+
+    store = FeatureStore(str(tmp_path))
+    assert len(store) == N
+    with torch.no_grad():
+        for i in range(N):
+            z, label = store[i]
+            np.testing.assert_array_almost_equal(
+                z, scat(x[i:i+1])[0], decimal=5)
+            assert label == i
+    z, label = store[-1]
+    assert label == N - 1
+
+
+def test_empty(tmp_path):
+    dataset = torch.utils.data.TensorDataset(torch.zeros(0, 3, 16, 16),
+                                             torch.zeros(0))
+    with pytest.raises(ValueError):
+        precompute(ScatLayerj1(), dataset, str(tmp_path / 'store'))
+    assert not (tmp_path / 'store').exists()
@@ -0,0 +1,82 @@
+from scatnet_learn.data import transforms
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as tv
+import pytest
+
+MEAN = (0.4914, 0.4822, 0.4465)
+STD = (0.2470, 0.2435, 0.2616)
+
+
+def _batch(N=8, H=32, W=32):
+    return torch.randint(0, 256, (N, 3, H, W), dtype=torch.uint8)
+
+
+@pytest.mark.parametrize('H,W', [(32, 32), (33, 35)])
+def test_center_crop_normalize(H, W):
+    x = _batch(H=H, W=W)
+    batched = transforms.ToFloatNormalize(MEAN, STD)(
+        transforms.CenterCrop(24)(x))
+    per_image = tv.Compose([tv.ToTensor(), tv.CenterCrop(24),
+                            tv.Normalize(MEAN, STD)])
+    ref = torch.stack([per_image(im.permute(1, 2, 0).numpy()) for im in x])
+    np.testing.assert_array_almost_equal(batched, ref, decimal=5)
+
+
+def test_random_crop_is_window():
+    x = _batch()
+    y = transforms.RandomCrop(32, padding=4)(x)
+    assert y.shape == x.shape
+    xp = F.pad(x, (4, 4, 4, 4))
+    for im, crop in zip(xp, y):
+        windows = [(i, j) for i in range(9) for j in range(9)
+                   if torch.equal(im[:, i:i+32, j:j+32], crop)]
+        assert len(windows) > 0
+
+
+def test_flip():
+    np.random.seed(0)
+    x = _batch(N=32)
+    y = transforms.RandomHorizontalFlip()(x)
+    flipped = [torch.equal(b, a.flip(-1)) for a, b in zip(x, y)]
+    same = [torch.equal(b, a) for a, b in zip(x, y)]
+    assert all(f or s for f, s in zip(flipped, same))
+    assert any(flipped) and any(same)
+
+
+def test_reseed():
+    x = _batch()
+    t = tv.Compose([transforms.RandomCrop(32, padding=4),
+                    transforms.RandomHorizontalFlip()])
+    np.random.seed(0)
+    y1 = t(x)
+    np.random.seed(0)
+    y2 = t(x)
+    assert torch.equal(y1, y2)
+
+
+def test_thread_rng():
+    x = _batch()
+    t = tv.Compose([transforms.RandomCrop(32, padding=4),
+                    transforms.RandomHorizontalFlip()])
+    with transforms.thread_rng(np.random.RandomState(0)):
+        y1 = t(x)
+    np.random.rand(10)
+    with transforms.thread_rng(np.random.RandomState(0)):
+        y2 = t(x)
+    assert torch.equal(y1, y2)
+    assert transforms.get_rng() is np.random
+
+
+def test_image_random_crop_flip():
+    img = tv.ToPILImage()(_batch(N=1)[0])
+    pad = F.pad(tv.PILToTensor()(img), (4, 4, 4, 4))
+    t = tv.Compose([transforms.ImageRandomCrop(32, padding=4),
+                    transforms.ImageRandomHorizontalFlip()])
+    for seed in range(5):
+        with transforms.thread_rng(np.random.RandomState(seed)):
+            crop = tv.PILToTensor()(t(img))
+        assert any(torch.equal(pad[:, i:i+32, j:j+32], c)
+                   for i in range(9) for j in range(9)
+                   for c in (crop, crop.flip(-1)))